@@ -8,6 +8,14 @@ __all__ = [
     "bcrypt_hash",
     "bcrypt_verify",
     "limiter",
+    "route_cost",
+    "Cost",
+    "client_ip",
+    "is_admin",
+    "require_admin",
+    "profile_dir",
+    "encode_key",
+    "decode_key",
     "generate_id",
     "parse_id",
     "User",
@@ -31,6 +39,23 @@ __all__ = [
     "UCHTTPExceptions",
     "Token",
     "InvalidDevmodeValue",
+    "authenticate",
+    "Gateway",
+    "GatewayConnection",
+    "room_channel",
+    "user_channel",
+    "Message",
+    "InboxEnvelope",
+    "Device",
+    "id_from_datetime",
+    "SingleFlight",
+    "user_flight",
+    "ban_flight",
+    "key_flight",
+    "OutboxEvent",
+    "server_overloaded",
+    "AdmissionController",
+    "Priority",
 ]
 
 from .helpers import (
@@ -44,12 +69,28 @@ from .helpers import (
     bcrypt_verify,
     generate_id,
     parse_id,
+    id_from_datetime,
     user_is_banned,
+    SingleFlight,
+    user_flight,
+    ban_flight,
+    key_flight,
+    server_overloaded,
+    client_ip,
+    is_admin,
+    require_admin,
+    profile_dir,
+    encode_key,
+    decode_key,
+    AdmissionController,
+    Priority,
 )
 from .models import (
     ChatAPI,
     NewUserForm,
     limiter,
+    route_cost,
+    Cost,
     User,
     user_pyd,
     UserCache,
@@ -59,6 +100,7 @@ from .models import (
     Token,
     PasswordRequestForm,
     check_auth_token,
+    authenticate,
     AuthToken,
     KDCData,
     Permissions,
@@ -67,6 +109,14 @@ from .models import (
     PreKeyBundle,
     SignedPreKey,
     PreKey,
+    Gateway,
+    GatewayConnection,
+    room_channel,
+    user_channel,
+    Message,
+    InboxEnvelope,
+    OutboxEvent,
+    Device,
 )
 from .db import TORTOISE_CONFIG
 
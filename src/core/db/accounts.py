@@ -0,0 +1,196 @@
+""" (module) accounts
+Deleting accounts
+
+Deleting an account only marks it: deleted_at is set, its refresh token families are revoked,
+its cached keys are dropped and a marker is put in redis that authenticate checks in the same
+round trip as the access token (and refresh checks before rotating), so the account stops working
+straight away on every worker. A worker that sees the marker drops the user from its cache.
+
+Everything the account owns is removed later by purge_deleted_users in the maintenance job.
+Each table is emptied in small batches with a pause in between and the user row goes last,
+when there is nothing left for ON DELETE CASCADE to do. A deletion never turns into one big
+transaction holding locks on the key tables.
+"""
+
+__all__ = [
+    "mark_deleted",
+    "deleted_key",
+    "purge_deleted_users",
+]
+
+import asyncio
+import logging
+from typing import Final
+
+from aioredis import Redis
+from tortoise import connections
+
+from core.helpers.token_families import revoke_user_families
+from core.helpers.conditional import bump_versions
+from .keys import invalidate_entry, stock_key
+from .rooms import members_key, bump_generations
+from .inbox import inbox_key
+
+# longer than an access token lives, after that the deleted_at column is enough
+DELETED_MARKER_TTL: Final = 60 * 60  # seconds
+PURGE_USERS_PER_RUN: Final = 100
+
+logger = logging.getLogger(__name__)
+
+# (table, statement deleting up to $2 rows owned by user $1), in the order they are emptied.
+# every statement returns the column the redis side needs cleaning up for
+DEPENDENTS: Final = [
+    (
+        "inbox_spill",
+        'DELETE FROM "inbox_spill" WHERE ctid IN ('
+        'SELECT "inbox_spill".ctid FROM "inbox_spill" '
+        'JOIN "devices" ON "devices"."id" = "inbox_spill"."device_id" '
+        'WHERE "devices"."owner_id" = $1 LIMIT $2) RETURNING "device_id"',
+    ),
+    (
+        "devices",
+        'DELETE FROM "devices" WHERE ctid IN ('
+        'SELECT ctid FROM "devices" WHERE "owner_id" = $1 LIMIT $2) RETURNING "id"',
+    ),
+    (
+        "room_members",
+        'DELETE FROM "room_members" WHERE ctid IN ('
+        'SELECT ctid FROM "room_members" WHERE "user_id" = $1 LIMIT $2) RETURNING "room_id"',
+    ),
+    (
+        "one_time_pre_keys",
+        'DELETE FROM "one_time_pre_keys" WHERE ctid IN ('
+        'SELECT ctid FROM "one_time_pre_keys" WHERE "owner_id" = $1 LIMIT $2) RETURNING "id"',
+    ),
+    (
+        "signed_pre_keys",
+        'DELETE FROM "signed_pre_keys" WHERE ctid IN ('
+        'SELECT ctid FROM "signed_pre_keys" WHERE "owner_id" = $1 LIMIT $2) RETURNING "id"',
+    ),
+    (
+        "tokens",
+        'DELETE FROM "tokens" WHERE ctid IN ('
+        'SELECT ctid FROM "tokens" WHERE "owner_id" = $1 LIMIT $2) RETURNING "token_id"',
+    ),
+]
+
+
+def deleted_key(user_id: int) -> str:
+    return f"user:{user_id}:deleted"
+
+
+async def mark_deleted(redis: Redis, user_id: int) -> bool:
+    """
+    Delete an account, it can't be used from now on and is purged by the maintenance job
+
+    Parameters:
+        redis (Redis): The redis connection
+        user_id (int): The user
+
+    Returns:
+        bool: False if there is no such user or it was already deleted
+    """
+
+    rows = await connections.get("default").execute_query_dict(
+        'UPDATE "users" SET "deleted_at" = CURRENT_TIMESTAMP '
+        'WHERE "id" = $1 AND "deleted_at" IS NULL RETURNING "id"',
+        [user_id],
+    )
+    if not rows:
+        return False
+
+    await redis.set(deleted_key(user_id), 1, ex=DELETED_MARKER_TTL)
+    await revoke_user_families(redis, user_id)
+    await invalidate_entry(redis, user_id)
+    await redis.delete(stock_key(user_id))
+    await bump_versions(redis, "user", [user_id])
+
+    return True
+
+
+async def forget_in_redis(redis: Redis, user_id: int, table: str, ids: list) -> None:
+    """Clean up what redis holds for rows that were just purged"""
+
+    if table == "one_time_pre_keys":
+        await bump_versions(redis, "prekey", ids)
+    elif table == "devices":
+        await redis.delete(*(inbox_key(device_id) for device_id in ids))
+    elif table == "room_members":
+        # cached member sets would keep the user until they expire otherwise
+        async with redis.pipeline(transaction=False) as pipe:
+            for room_id in ids:
+                pipe.srem(members_key(room_id), user_id)
+            await pipe.execute()
+        await bump_generations(redis, ids)
+
+
+async def purge_user(
+    redis: Redis, user_id: int, batch_size: int = 500, pause: float = 0.1
+) -> int:
+    """
+    Remove everything a deleted user owns and then the user
+
+    Returns:
+        int: The number of rows deleted
+    """
+
+    conn = connections.get("default")
+    deleted = 0
+    for table, statement in DEPENDENTS:
+        while True:
+            rows = await conn.execute_query_dict(statement, [user_id, batch_size])
+            if rows:
+                ids = [next(iter(row.values())) for row in rows]
+                await forget_in_redis(redis, user_id, table, ids)
+
+            deleted += len(rows)
+            if len(rows) < batch_size:
+                break
+            await asyncio.sleep(pause)
+
+    # the account could only have been restored by hand, never purge a live one
+    rows = await conn.execute_query_dict(
+        'DELETE FROM "users" WHERE "id" = $1 AND "deleted_at" IS NOT NULL RETURNING "id"',
+        [user_id],
+    )
+    return deleted + len(rows)
+
+
+async def purge_deleted_users(
+    redis: Redis,
+    limit: int = PURGE_USERS_PER_RUN,
+    batch_size: int = 500,
+    pause: float = 0.1,
+) -> int:
+    """
+    Purge accounts marked as deleted, oldest first
+
+    Parameters:
+        redis (Redis): The redis connection
+        limit (int): Max users purged per call, the rest wait for the next run
+        batch_size (int): Rows deleted per statement
+        pause (float): Seconds to wait between batches
+
+    Returns:
+        int: The number of users purged
+    """
+
+    users = await connections.get("default").execute_query_dict(
+        'SELECT "id" FROM "users" WHERE "deleted_at" IS NOT NULL '
+        'ORDER BY "deleted_at" LIMIT $1',
+        [limit],
+    )
+
+    purged = 0
+    for user in users:
+        try:
+            rows = await purge_user(redis, user["id"], batch_size, pause)
+        except Exception:
+            logger.exception("Failed to purge user %s", user["id"])
+            continue
+
+        logger.debug("Purged user %s (%d rows)", user["id"], rows)
+        purged += 1
+        await asyncio.sleep(pause)
+
+    return purged
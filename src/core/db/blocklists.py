@@ -0,0 +1,284 @@
+""" (module) blocklists
+Bulk loading and dumping the ip and email blocklists, and the ban cache the middleware reads
+
+Imports are parsed as the upload streams in, one entry per line or the first column of a csv.
+Every batch is COPYed into a temporary table and moved into the blocklist with one
+INSERT ... ON CONFLICT DO NOTHING, so entries already listed (or listed twice in the feed) are skipped.
+Exports page through the table by id and are sent as they are read.
+
+Every worker caches ban lookups in memory. After an import the cache is swapped for an empty one
+in a single assignment and the other workers are told to do the same over redis pub/sub.
+"""
+
+__all__ = [
+    "Blocklist",
+    "BanCache",
+    "import_blocklist",
+    "export_blocklist",
+]
+
+import csv
+import codecs
+import asyncio
+import logging
+import ipaddress
+from enum import Enum
+from collections import OrderedDict
+from typing import AsyncIterator, Callable, Final, Optional
+
+import aioredis.exceptions
+from aioredis import Redis
+from tortoise import connections
+
+from core.helpers import ban_flight
+from .routing import ReadReplicaRouter
+
+IMPORT_BATCH_SIZE: Final = 10000
+EXPORT_BATCH_SIZE: Final = 10000
+MAX_EMAIL_LENGTH: Final = 256
+MAX_IP_LENGTH: Final = 40  # blacklisted_ips.ip is a VARCHAR(40)
+REFRESH_CHANNEL: Final = "bans:refresh"
+
+logger = logging.getLogger(__name__)
+
+
+class Blocklist(str, Enum):
+    ips = "ips"
+    emails = "emails"
+
+
+async def ip_is_listed(ip: str) -> bool:
+    rows = await connections.get("default").execute_query_dict(
+        'SELECT 1 FROM "blacklisted_ips" WHERE "ip" = $1', [ip]
+    )
+    return bool(rows)
+
+
+def normalize_ip(value: str) -> Optional[str]:
+    try:
+        ip = ipaddress.ip_address(value)
+    except ValueError:
+        return None
+
+    # a scoped address (fe80::1%eth0) is only meaningful on one host and can be too long to store
+    if getattr(ip, "scope_id", None) is not None or len(str(ip)) > MAX_IP_LENGTH:
+        return None
+    return str(ip)
+
+
+def normalize_email(value: str) -> Optional[str]:
+    email = value.lower()
+    if "@" not in email or len(email) > MAX_EMAIL_LENGTH:
+        return None
+    return email
+
+
+# blocklist -> (table, column, normalizer)
+TABLES: Final[dict[Blocklist, tuple[str, str, Callable[[str], Optional[str]]]]] = {
+    Blocklist.ips: ("blacklisted_ips", "ip", normalize_ip),
+    Blocklist.emails: ("blacklisted_emails", "email", normalize_email),
+}
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a stream of bytes into lines without reading all of it"""
+
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending = ""
+    async for chunk in chunks:
+        pending += decoder.decode(chunk)
+        *lines, pending = pending.split("\n")
+        for line in lines:
+            yield line
+
+    pending += decoder.decode(b"", final=True)
+    if pending:
+        yield pending
+
+
+async def insert_batch(table: str, column: str, values: list[str]) -> int:
+    """
+    COPY a batch into a temporary table and add the entries the blocklist doesn't have yet.
+    A connection is only taken from the pool for the batch, not while the upload is read
+
+    Returns:
+        int: The number of entries added
+    """
+
+    conn = connections.get("default")
+    async with conn.acquire_connection() as connection, connection.transaction():
+        await connection.execute(
+            "CREATE TEMPORARY TABLE blocklist_import (value TEXT) ON COMMIT DROP"
+        )
+        await connection.copy_records_to_table(
+            "blocklist_import", records=[(value,) for value in values]
+        )
+        status = await connection.execute(
+            f'INSERT INTO "{table}" ("{column}") '
+            "SELECT DISTINCT value FROM blocklist_import "
+            f'ON CONFLICT ("{column}") DO NOTHING'
+        )
+
+    # eg: INSERT 0 42
+    return int(status.rpartition(" ")[2])
+
+
+async def import_blocklist(
+    blocklist: Blocklist,
+    chunks: AsyncIterator[bytes],
+    batch_size: int = IMPORT_BATCH_SIZE,
+) -> dict:
+    """
+    Load a newline delimited list or a csv (first column) into a blocklist.
+    Blank lines, lines starting with # and entries that aren't valid are skipped
+
+    Parameters:
+        blocklist (Blocklist): The list to load into
+        chunks (AsyncIterator[bytes]): The upload, eg: request.stream()
+        batch_size (int): Entries per COPY
+
+    Returns:
+        dict: received, added and rejected counts
+    """
+
+    table, column, normalize = TABLES[blocklist]
+    counts = {"received": 0, "added": 0, "rejected": 0}
+    batch: list[str] = []
+
+    async for line in iter_lines(chunks):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        counts["received"] += 1
+        row = next(csv.reader([line]), [""])
+        value = normalize(row[0].strip()) if row else None
+        if value is None:  # includes a csv header
+            counts["rejected"] += 1
+            continue
+
+        batch.append(value)
+        if len(batch) >= batch_size:
+            counts["added"] += await insert_batch(table, column, batch)
+            batch = []
+
+    if batch:
+        counts["added"] += await insert_batch(table, column, batch)
+
+    return counts
+
+
+async def export_blocklist(
+    blocklist: Blocklist, batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[str]:
+    """
+    Dump a blocklist one page at a time, newline delimited
+
+    Parameters:
+        blocklist (Blocklist): The list to dump
+        batch_size (int): Rows read per query
+
+    Yields:
+        str: A page of entries, each followed by a newline
+    """
+
+    table, column, _ = TABLES[blocklist]
+    conn = connections.get(ReadReplicaRouter().db_for_read(None))
+
+    after = 0
+    while True:
+        rows = await conn.execute_query_dict(
+            f'SELECT "id", "{column}" FROM "{table}" WHERE "id" > $1 ORDER BY "id" LIMIT $2',
+            [after, batch_size],
+        )
+        if not rows:
+            return
+
+        yield "".join(f"{row[column]}\n" for row in rows)
+        if len(rows) < batch_size:
+            return
+        after = rows[-1]["id"]
+
+
+class BanCache:
+    """
+    Remembers which ips are banned (and which aren't) so most requests don't query the blocklist
+
+    Parameters:
+        redis (Redis): The redis connection refreshes are broadcast over
+        maxsize (int): Ips remembered per worker
+
+    Attributes:
+        entries (OrderedDict[str, bool]): ip -> banned, least recently used first
+        generation (int): Bumped on every refresh, lookups started before one aren't cached
+    """
+
+    def __init__(self, redis: Redis, maxsize: int = 4096) -> None:
+        self.redis = redis
+        self.maxsize = maxsize
+
+        self.entries: OrderedDict[str, bool] = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.listener: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self.listener is not None:
+            self.listener.cancel()
+
+    async def is_banned(self, ip: str) -> bool:
+        banned = self.entries.get(ip)
+        if banned is not None:
+            self.entries.move_to_end(ip)
+            self.hits += 1
+            return banned
+
+        generation = self.generation
+        # keyed by generation too, a lookup started before a refresh is never shared after it
+        banned = await ban_flight.do((generation, ip), lambda: ip_is_listed(ip))
+        if generation == self.generation:
+            self.entries[ip] = banned
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+        return banned
+
+    def refresh(self) -> None:
+        """Forget every cached lookup on this worker"""
+
+        # replaced rather than cleared, so nothing ever sees a half emptied cache
+        self.entries = OrderedDict()
+        self.generation += 1
+
+    async def refresh_all(self) -> None:
+        """Forget every cached lookup on every worker, call after changing the ip blocklist"""
+
+        self.refresh()
+        await self.redis.publish(REFRESH_CHANNEL, self.generation)
+
+    def stats(self) -> dict:
+        return {
+            "cached": len(self.entries),
+            "hits": self.hits,
+            "generation": self.generation,
+        }
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(REFRESH_CHANNEL)
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self.refresh()
+            except aioredis.exceptions.ConnectionError:
+                logger.warning("Lost the ban refresh subscription, reconnecting")
+                # a refresh may have been missed while disconnected
+                self.refresh()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
@@ -0,0 +1,377 @@
+""" (module) inbox
+Per device inboxes, where ciphertext waits until the device comes online to collect it
+
+Each device has a redis stream (inbox:{device_id}). Sending is one XADD per device, all pipelined
+together, and every send pushes the inbox's expiry back so inboxes nobody comes back for go away.
+A device drains its inbox with batched XREADs and acknowledges cumulatively: acking an entry id
+trims everything up to and including it with XTRIM MINID, so one ack clears a whole batch.
+
+Streams are capped. Once one grows past max_length its oldest entries are moved to postgres
+(inbox_spill) in one statement instead of being dropped, and when redis memory use goes over
+spill_ratio of maxmemory every inbox is moved there. Reads return the spilled entries first,
+they are always older than what is still in the stream. The stream is read before postgres so
+a spill running at the same time can't hide entries from a read.
+"""
+
+__all__ = [
+    "DeviceInbox",
+    "inbox_options",
+    "parse_entry_id",
+    "prune_inbox_spill",
+]
+
+import os
+import asyncio
+import secrets
+import logging
+from itertools import islice
+from datetime import datetime
+from typing import Final, Optional
+
+import aioredis.exceptions
+from aioredis import Redis
+from tortoise import connections
+
+READ_BATCH_SIZE: Final = 500
+SPILL_BATCH_SIZE: Final = 1000
+SPILL_LOCK: Final = "inbox:spill_lock"
+SPILL_LOCK_TTL: Final = 60  # seconds, extended after every inbox while a spill runs
+
+# KEYS: lock
+# ARGV: token, ttl (0 to release)
+RENEW_IF_HELD = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+    return 0
+end
+if ARGV[2] == '0' then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 1
+"""
+
+logger = logging.getLogger(__name__)
+
+
+def inbox_options() -> dict:
+    """
+    Reads the inbox settings from the environment
+
+    Returns:
+        dict: Keyword arguments for DeviceInbox
+    """
+
+    return {
+        "max_length": int(os.environ.get("INBOX_MAX_LENGTH", 10000)),
+        "ttl": int(os.environ.get("INBOX_TTL_DAYS", 30)) * 24 * 60 * 60,
+        "spill_ratio": float(os.environ.get("INBOX_SPILL_MEMORY_RATIO", 0.8)),
+    }
+
+
+def inbox_key(device_id: int) -> str:
+    return f"inbox:{device_id}"
+
+
+def parse_entry_id(entry_id: str) -> tuple[int, int]:
+    """
+    Split a stream entry id, eg: "1700000000000-3" into its time and sequence number
+
+    Raises:
+        ValueError: If it isn't an entry id
+    """
+
+    ms, separator, seq = entry_id.partition("-")
+    if not separator or not ms.isdigit() or not seq.isdigit():
+        raise ValueError(f"invalid entry id: {entry_id}")
+
+    return int(ms), int(seq)
+
+
+def next_entry_id(entry_id: str) -> str:
+    ms, seq = parse_entry_id(entry_id)
+    return f"{ms}-{seq + 1}"
+
+
+async def spill_entries(device_id: int, entries: list[tuple[str, dict]]) -> None:
+    """
+    Write stream entries to inbox_spill in one statement, created_at is when the entry was queued.
+    An entry that is already there (a spill that died before trimming the stream) is skipped
+    """
+
+    ids = [parse_entry_id(entry_id) for entry_id, _ in entries]
+    await connections.get("default").execute_query(
+        'INSERT INTO "inbox_spill" '
+        '("device_id", "entry_ms", "entry_seq", "sender_id", "envelope", "created_at") '
+        "SELECT $1, ms, seq, sender_id, envelope, to_timestamp(ms / 1000.0) AT TIME ZONE 'UTC' "
+        "FROM unnest($2::BIGINT[], $3::BIGINT[], $4::BIGINT[], $5::TEXT[]) "
+        "AS entries (ms, seq, sender_id, envelope) "
+        "ON CONFLICT DO NOTHING",
+        [
+            device_id,
+            [ms for ms, _ in ids],
+            [seq for _, seq in ids],
+            [int(fields["sender_id"]) for _, fields in entries],
+            [fields["envelope"] for _, fields in entries],
+        ],
+    )
+
+
+async def prune_inbox_spill(
+    created_before: datetime, batch_size: int = 1000, pause: float = 0.1
+) -> int:
+    """
+    Delete spilled envelopes that were never collected, in small batches
+
+    Parameters:
+        created_before (datetime): Envelopes queued before this are deleted
+        batch_size (int): Rows deleted per statement
+        pause (float): Seconds to wait between batches
+
+    Returns:
+        int: The number of envelopes deleted
+    """
+
+    conn = connections.get("default")
+    deleted = 0
+    while True:
+        rows = await conn.execute_query_dict(
+            'DELETE FROM "inbox_spill" WHERE ctid IN ('
+            'SELECT ctid FROM "inbox_spill" WHERE "created_at" < $1 LIMIT $2'
+            ') RETURNING "device_id"',
+            [created_before, batch_size],
+        )
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            return deleted
+
+        await asyncio.sleep(pause)
+
+
+class DeviceInbox:
+    """
+    Parameters:
+        redis (Redis): The redis connection holding the streams
+        max_length (int): Entries a stream can hold before its oldest half is moved to postgres
+        ttl (int): Seconds an inbox is kept after the last envelope was sent to it
+        spill_ratio (float): Share of redis maxmemory in use that makes every inbox move to postgres
+        check_interval (float): Seconds between redis memory checks
+
+    Attributes:
+        spilled (int): Entries moved to postgres by this worker
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        max_length: int = 10000,
+        ttl: int = 30 * 24 * 60 * 60,
+        spill_ratio: float = 0.8,
+        check_interval: float = 5.0,
+    ) -> None:
+        self.redis = redis
+        self.max_length = max_length
+        self.ttl = ttl
+        self.spill_ratio = spill_ratio
+        self.check_interval = check_interval
+
+        self.pushed = 0
+        self.spilled = 0
+        self.memory_ratio = 0.0
+        self.watcher: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.watcher = asyncio.create_task(self._watch_memory())
+
+    async def close(self) -> None:
+        if self.watcher is not None:
+            self.watcher.cancel()
+
+    async def push(self, envelopes: list[tuple[int, int, str]]) -> None:
+        """
+        Queue envelopes for devices, in one round trip however many there are
+
+        Parameters:
+            envelopes (list[tuple[int, int, str]]): (device_id, sender_id, envelope) for each envelope
+        """
+
+        if not envelopes:
+            return
+
+        devices = list(dict.fromkeys(device_id for device_id, _, _ in envelopes))
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for device_id, sender_id, envelope in envelopes:
+                pipe.xadd(
+                    inbox_key(device_id),
+                    {"sender_id": sender_id, "envelope": envelope},
+                )
+            for device_id in devices:
+                pipe.expire(inbox_key(device_id), self.ttl)
+                pipe.xlen(inbox_key(device_id))
+            results = await pipe.execute()
+
+        self.pushed += len(envelopes)
+        # every device has an expire then an xlen result after the xadds
+        lengths = islice(results, len(envelopes) + 1, None, 2)
+        for device_id, length in zip(devices, lengths):
+            if length > self.max_length:
+                await self.spill(device_id, keep=self.max_length // 2)
+
+    async def read(self, device_id: int, after: str = "0-0", limit: int = 1000) -> list:
+        """
+        Get the oldest envelopes queued for a device
+
+        Parameters:
+            device_id (int): The device
+            after (str): Only entries after this entry id, the last id of the previous read
+            limit (int): Max entries to return
+
+        Returns:
+            list[dict]: id, sender_id and envelope of each entry, oldest first
+        """
+
+        # the stream is read before postgres. a spill writes to postgres before trimming the stream,
+        # so an entry spilled in between turns up in both reads and none in neither
+        streamed = []
+        cursor = after
+        while len(streamed) < limit:
+            count = min(READ_BATCH_SIZE, limit - len(streamed))
+            response = await self.redis.xread(
+                {inbox_key(device_id): cursor}, count=count
+            )
+            batch = response[0][1] if response else []
+
+            streamed.extend(
+                {
+                    "id": entry_id,
+                    "sender_id": fields["sender_id"],
+                    "envelope": fields["envelope"],
+                }
+                for entry_id, fields in batch
+            )
+            if len(batch) < count:
+                break
+            cursor = batch[-1][0]
+
+        after_ms, after_seq = parse_entry_id(after)
+        rows = await connections.get("default").execute_query_dict(
+            'SELECT "entry_ms", "entry_seq", "sender_id", "envelope" FROM "inbox_spill" '
+            'WHERE "device_id" = $1 AND ("entry_ms", "entry_seq") > ($2, $3) '
+            'ORDER BY "entry_ms", "entry_seq" LIMIT $4',
+            [device_id, after_ms, after_seq, limit],
+        )
+        spilled = [
+            {
+                "id": f"{row['entry_ms']}-{row['entry_seq']}",
+                "sender_id": str(row["sender_id"]),
+                "envelope": row["envelope"],
+            }
+            for row in rows
+        ]
+
+        # spilled entries are always older, with the duplicates dropped the oldest
+        # entries of both reads are a gapless run after the cursor
+        entries = {entry["id"]: entry for entry in spilled + streamed}
+        return sorted(entries.values(), key=lambda entry: parse_entry_id(entry["id"]))[
+            :limit
+        ]
+
+    async def ack(self, device_id: int, up_to: str) -> None:
+        """
+        Acknowledge every entry up to and including an entry id, they are deleted
+
+        Parameters:
+            device_id (int): The device
+            up_to (str): The id of the last entry the device has stored
+        """
+
+        up_to_ms, up_to_seq = parse_entry_id(up_to)
+        await self.redis.execute_command(
+            "XTRIM", inbox_key(device_id), "MINID", next_entry_id(up_to)
+        )
+        await connections.get("default").execute_query(
+            'DELETE FROM "inbox_spill" '
+            'WHERE "device_id" = $1 AND ("entry_ms", "entry_seq") <= ($2, $3)',
+            [device_id, up_to_ms, up_to_seq],
+        )
+
+    async def spill(self, device_id: int, keep: int = 0) -> int:
+        """
+        Move the oldest entries of a device's stream to postgres
+
+        Parameters:
+            device_id (int): The device
+            keep (int): Entries left in the stream
+
+        Returns:
+            int: The number of entries moved
+        """
+
+        key = inbox_key(device_id)
+        remaining = await self.redis.xlen(key) - keep
+        moved = 0
+
+        start = "-"
+        while remaining > 0:
+            batch = await self.redis.xrange(
+                key, min=start, count=min(SPILL_BATCH_SIZE, remaining)
+            )
+            if not batch:
+                break
+
+            await spill_entries(device_id, batch)
+            # trimmed only once they are in postgres, newer entries have bigger ids and stay
+            last_id = batch[-1][0]
+            await self.redis.execute_command(
+                "XTRIM", key, "MINID", next_entry_id(last_id)
+            )
+
+            moved += len(batch)
+            remaining -= len(batch)
+            start = next_entry_id(last_id)
+
+        self.spilled += moved
+        return moved
+
+    def stats(self) -> dict:
+        return {
+            "pushed": self.pushed,
+            "spilled": self.spilled,
+            "redis_memory_ratio": round(self.memory_ratio, 3),
+        }
+
+    async def _spill_all(self) -> None:
+        # one worker at a time, the others would only be moving the same streams
+        token = secrets.token_hex(8)
+        if not await self.redis.set(SPILL_LOCK, token, nx=True, ex=SPILL_LOCK_TTL):
+            return
+
+        # only ever extended or released by the worker holding it
+        renew = self.redis.register_script(RENEW_IF_HELD)
+        try:
+            async for key in self.redis.scan_iter(match="inbox:[0-9]*", count=1000):
+                await self.spill(int(key.partition(":")[2]))
+                if not await renew(keys=[SPILL_LOCK], args=[token, SPILL_LOCK_TTL]):
+                    logger.warning("Lost the inbox spill lock, stopping")
+                    return
+        finally:
+            await renew(keys=[SPILL_LOCK], args=[token, 0])
+
+    async def _watch_memory(self) -> None:
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                memory = await self.redis.info("memory")
+                maxmemory = int(memory.get("maxmemory", 0))
+                if not maxmemory:  # no limit set, nothing to compare against
+                    continue
+
+                self.memory_ratio = int(memory["used_memory"]) / maxmemory
+                if self.memory_ratio > self.spill_ratio:
+                    logger.warning(
+                        "Redis is using %.0f%% of maxmemory, moving inboxes to postgres",
+                        self.memory_ratio * 100,
+                    )
+                    await self._spill_all()
+            except aioredis.exceptions.ConnectionError:
+                logger.warning("Couldn't check redis memory use")
@@ -0,0 +1,507 @@
+""" (module) keys
+The key directory, a read through cache of each user's identity key and signed prekey
+
+Keys are read on every bundle fetch but only change when their owner uploads or rotates them.
+Entries are cached in process (L1) and in redis (L2). Every write bumps the user's version
+in redis, deletes the L2 entry and publishes the new version so every worker drops its L1 entry.
+The identity key and signed prekey are cached together as one versioned entry,
+so a reader never gets a new identity key with the signature of an old one.
+
+Rotating a signed prekey marks the current one as superseded instead of deleting it,
+sessions started with it just before the rotation can still be completed.
+Superseded keys are pruned in bulk by the maintenance job once their grace period is over.
+
+How many one time prekeys each user has left is counted in redis, so checking doesn't need
+a COUNT(*) over rows that every bundle fetch deletes. The counters are adjusted with every
+insert and delete, reconciled against postgres by the maintenance job, and when a user's
+stock drops below PREKEY_LOW_STOCK a prekeys_low event is queued for the worker to push to them.
+"""
+
+__all__ = [
+    "KeyDirectory",
+    "invalidate_entry",
+    "consume_prekey",
+    "add_prekeys",
+    "rotate_signed_prekey",
+    "prune_signed_prekeys",
+    "prekey_stock",
+    "adjust_prekey_stock",
+    "reconcile_prekey_stock",
+]
+
+import os
+import json
+import time
+import asyncio
+import logging
+from datetime import datetime
+from collections import OrderedDict
+from typing import Final, Optional
+
+import aioredis.exceptions
+from aioredis import Redis
+from tortoise import connections
+from tortoise.transactions import in_transaction
+
+from core.helpers import key_flight, encode_key
+
+INVALIDATION_CHANNEL: Final = "keys:invalidate"
+L1_TTL: Final = 60  # seconds, in case an invalidation is missed while reconnecting
+L2_TTL: Final = 60 * 60  # seconds
+PREKEY_LOW_STOCK: Final = int(os.environ.get("PREKEY_LOW_STOCK", 10))
+RECONCILE_BATCH_SIZE: Final = 500
+
+logger = logging.getLogger(__name__)
+
+# KEYS: version, entry
+# ARGV: the version the entry was loaded at, the entry, ttl
+SET_IF_CURRENT = """
+if (redis.call('GET', KEYS[1]) or '0') ~= ARGV[1] then
+    return 0
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+return 1
+"""
+
+# KEYS: version, entry
+# ARGV: channel, user id
+INVALIDATE = """
+local version = redis.call('INCR', KEYS[1])
+redis.call('DEL', KEYS[2])
+redis.call('PUBLISH', ARGV[1], ARGV[2] .. ':' .. version)
+return version
+"""
+
+
+# KEYS: stock counter
+# ARGV: change
+ADJUST_IF_COUNTED = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return false
+"""
+
+# KEYS: stock counter
+# ARGV: the value it was read at, the recount
+SET_IF_UNCHANGED = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2])
+    return 1
+end
+return 0
+"""
+
+
+def stock_key(user_id: int) -> str:
+    return f"prekeys:{user_id}:count"
+
+
+def version_key(user_id: int) -> str:
+    return f"keys:{user_id}:version"
+
+
+def entry_key(user_id: int) -> str:
+    return f"keys:{user_id}"
+
+
+async def load_entry(user_id: int) -> Optional[dict]:
+    conn = connections.get("default")
+    users = await conn.execute_query_dict(
+        'SELECT "identity_key" FROM "users" WHERE "id" = $1 AND "deleted_at" IS NULL',
+        [user_id],
+    )
+    if not users:
+        return None
+
+    signed_prekeys = await conn.execute_query_dict(
+        'SELECT "id", "public_key", "signature" FROM "signed_pre_keys" '
+        'WHERE "owner_id" = $1 AND "superseded_at" IS NULL ORDER BY "id" DESC LIMIT 1',
+        [user_id],
+    )
+
+    signed_prekey = None
+    if signed_prekeys:
+        signed_prekey = {
+            "key_id": signed_prekeys[0]["id"],
+            "public_key": encode_key(signed_prekeys[0]["public_key"]),
+            "signature": encode_key(signed_prekeys[0]["signature"]),
+        }
+
+    # cached entries hold the api (base64) form so a cache hit needs no encoding
+    identity_key = users[0]["identity_key"]
+    return {
+        "identity_key": identity_key and encode_key(identity_key),
+        "signed_prekey": signed_prekey,
+    }
+
+
+async def invalidate_entry(redis: Redis, user_id: int) -> int:
+    """
+    Bump a user's key version, drop their cached entry and tell every worker to drop theirs.
+    For processes that don't have a KeyDirectory, eg: the rabbitmq worker
+
+    Returns:
+        int: The new version
+    """
+
+    script = redis.register_script(INVALIDATE)
+    version = await script(
+        keys=[version_key(user_id), entry_key(user_id)],
+        args=[INVALIDATION_CHANNEL, user_id],
+    )
+    return int(version)
+
+
+async def consume_prekey(owner_id: int) -> Optional[dict]:
+    """
+    Take one of a user's one time prekeys, it is deleted so it is only ever handed out once.
+    SKIP LOCKED lets concurrent bundle fetches for the same user each take a different key
+    instead of queueing on the same row
+
+    Parameters:
+        owner_id (int): The user whose prekey to take
+
+    Returns:
+        Optional[dict]: id and public_key (base64) of the prekey, None if the user has none left
+    """
+
+    rows = await connections.get("default").execute_query_dict(
+        'DELETE FROM "one_time_pre_keys" WHERE "id" = ('
+        'SELECT "id" FROM "one_time_pre_keys" WHERE "owner_id" = $1 '
+        "LIMIT 1 FOR UPDATE SKIP LOCKED"
+        ') RETURNING "id", "public_key"',
+        [owner_id],
+    )
+    if not rows:
+        return None
+
+    return {"id": rows[0]["id"], "public_key": encode_key(rows[0]["public_key"])}
+
+
+async def add_prekeys(
+    redis: Redis, owner_id: int, prekeys: list[tuple[int, bytes]]
+) -> int:
+    """
+    Store a batch of one time prekeys in one statement, so either all of them are added or
+    none are (eg: when one of the ids is taken) and the counter is only adjusted for a full batch
+
+    Parameters:
+        redis (Redis): The redis connection holding the counters
+        owner_id (int): The user the keys belong to
+        prekeys (list[tuple[int, bytes]]): (key id, public key) of each prekey
+
+    Returns:
+        int: The number of prekeys the user has now
+    """
+
+    rows = await connections.get("default").execute_query_dict(
+        'INSERT INTO "one_time_pre_keys" ("id", "public_key", "owner_id") '
+        'SELECT "id", "public_key", $3 FROM unnest($1::BIGINT[], $2::BYTEA[]) '
+        'AS "prekeys" ("id", "public_key") RETURNING "id"',
+        [[key_id for key_id, _ in prekeys], [key for _, key in prekeys], owner_id],
+    )
+    return await adjust_prekey_stock(redis, owner_id, len(rows))
+
+
+async def rotate_signed_prekey(
+    owner_id: int, key_id: int, public_key: bytes, signature: bytes
+) -> None:
+    """
+    Make a new signed prekey the current one, the previous key is kept until it is pruned
+
+    Parameters:
+        owner_id (int): The user the key belongs to
+        key_id (int): The id of the new key
+        public_key (bytes): The new public key
+        signature (bytes): The signature of the new key
+    """
+
+    async with in_transaction("default") as connection:
+        # concurrent rotations for the same user queue here so only one key ends up current
+        await connection.execute_query(
+            'SELECT 1 FROM "users" WHERE "id" = $1 FOR UPDATE', [owner_id]
+        )
+        await connection.execute_query(
+            'UPDATE "signed_pre_keys" SET "superseded_at" = CURRENT_TIMESTAMP '
+            'WHERE "owner_id" = $1 AND "superseded_at" IS NULL',
+            [owner_id],
+        )
+        await connection.execute_query(
+            'INSERT INTO "signed_pre_keys" ("id", "public_key", "signature", "owner_id") '
+            "VALUES ($1, $2, $3, $4)",
+            [key_id, public_key, signature, owner_id],
+        )
+
+
+async def prune_signed_prekeys(
+    superseded_before: datetime, batch_size: int = 1000, pause: float = 0.1
+) -> int:
+    """
+    Delete signed prekeys that were replaced before a cutoff.
+    Deletes in small batches with a pause in between so it never holds locks for long
+
+    Parameters:
+        superseded_before (datetime): Keys replaced before this are deleted
+        batch_size (int): Rows deleted per statement
+        pause (float): Seconds to wait between batches
+
+    Returns:
+        int: The number of keys deleted
+    """
+
+    conn = connections.get("default")
+    deleted = 0
+    while True:
+        rows = await conn.execute_query_dict(
+            'DELETE FROM "signed_pre_keys" WHERE "id" IN ('
+            'SELECT "id" FROM "signed_pre_keys" WHERE "superseded_at" < $1 LIMIT $2'
+            ') RETURNING "id"',
+            [superseded_before, batch_size],
+        )
+        deleted += len(rows)
+        if len(rows) < batch_size:
+            return deleted
+
+        await asyncio.sleep(pause)
+
+
+async def count_prekeys(owner_id: int) -> int:
+    rows = await connections.get("default").execute_query_dict(
+        'SELECT COUNT(*) AS "count" FROM "one_time_pre_keys" WHERE "owner_id" = $1',
+        [owner_id],
+    )
+    return rows[0]["count"]
+
+
+async def prekey_stock(redis: Redis, owner_id: int) -> int:
+    """
+    Get how many one time prekeys a user has left
+
+    Parameters:
+        redis (Redis): The redis connection holding the counters
+        owner_id (int): The user
+
+    Returns:
+        int: The number of prekeys
+    """
+
+    count = await redis.get(stock_key(owner_id))
+    if count is not None:
+        return int(count)
+
+    count = await count_prekeys(owner_id)
+    # NX so a counter another request already started isn't overwritten with an older count
+    await redis.set(stock_key(owner_id), count, nx=True)
+    return count
+
+
+async def adjust_prekey_stock(redis: Redis, owner_id: int, change: int) -> int:
+    """
+    Update a user's prekey counter after their prekeys were inserted or deleted.
+    Queues a prekeys_low event when this change took the stock below PREKEY_LOW_STOCK
+
+    Parameters:
+        redis (Redis): The redis connection holding the counters
+        owner_id (int): The user
+        change (int): How many prekeys were added, negative if they were deleted
+
+    Returns:
+        int: The number of prekeys the user has left
+    """
+
+    script = redis.register_script(ADJUST_IF_COUNTED)
+    count = await script(keys=[stock_key(owner_id)], args=[change])
+    if count is None:
+        # not counted yet, the count from postgres already includes this change
+        return await prekey_stock(redis, owner_id)
+
+    count = int(count)
+    # only the request that crosses the threshold sees this exact count, so one event per crossing
+    if change < 0 and count < PREKEY_LOW_STOCK <= count - change:
+        await connections.get("default").execute_query(
+            'INSERT INTO "outbox" ("channel", "payload") VALUES ($1, $2::JSONB)',
+            ["prekeys_low", json.dumps({"user_id": owner_id, "remaining": count})],
+        )
+
+    return count
+
+
+async def reconcile_stock_batch(redis: Redis, keys: list[str]) -> int:
+    owner_ids = [int(key.split(":")[1]) for key in keys]
+    # read before counting, a counter that changes after this isn't touched
+    cached = await redis.mget(*keys)
+    rows = await connections.get("default").execute_query_dict(
+        'SELECT "owner_id", COUNT(*) AS "count" FROM "one_time_pre_keys" '
+        'WHERE "owner_id" = ANY($1::BIGINT[]) GROUP BY "owner_id"',
+        [owner_ids],
+    )
+    counts = {row["owner_id"]: row["count"] for row in rows}
+
+    script = redis.register_script(SET_IF_UNCHANGED)
+    wrong = 0
+    for owner_id, key, current in zip(owner_ids, keys, cached):
+        count = counts.get(owner_id, 0)
+        if current is not None and int(current) != count:
+            # a claim or upload adjusted it since the read, the next run checks it again
+            wrong += await script(keys=[key], args=[current, count])
+
+    return wrong
+
+
+async def reconcile_prekey_stock(redis: Redis) -> int:
+    """
+    Recount every counted user's prekeys in postgres and correct the counters,
+    they can drift when a change races with a counter being started
+
+    Parameters:
+        redis (Redis): The redis connection holding the counters
+
+    Returns:
+        int: The number of counters that were wrong
+    """
+
+    corrected = 0
+    keys: list[str] = []
+
+    async for key in redis.scan_iter(
+        match="prekeys:*:count", count=RECONCILE_BATCH_SIZE
+    ):
+        keys.append(key)
+        if len(keys) >= RECONCILE_BATCH_SIZE:
+            corrected += await reconcile_stock_batch(redis, keys)
+            keys = []
+
+    if keys:
+        corrected += await reconcile_stock_batch(redis, keys)
+
+    return corrected
+
+
+class KeyDirectory:
+    """
+    Parameters:
+        redis (Redis): The redis connection used for the L2 cache and invalidations
+        capacity (int): Entries kept in the L1 cache
+
+    Attributes:
+        hits (dict[str, int]): Lookups answered by each tier, l1, l2 and db
+    """
+
+    def __init__(self, redis: Redis, capacity: int = 10000) -> None:
+        self.redis = redis
+        self.capacity = capacity
+
+        # user id -> (entry, cached at)
+        self.entries: OrderedDict[int, tuple[dict, float]] = OrderedDict()
+        # user id -> the newest version we have been told about, so a slow reader
+        # can't put an entry in L1 after its invalidation has already arrived
+        self.versions: OrderedDict[int, int] = OrderedDict()
+
+        self.hits = {"l1": 0, "l2": 0, "db": 0}
+        self.listener: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self.listener is not None:
+            self.listener.cancel()
+
+    async def get(self, user_id: int) -> Optional[dict]:
+        """
+        Get a user's identity key and signed prekey
+
+        Parameters:
+            user_id (int): The user
+
+        Returns:
+            Optional[dict]: version, identity_key and signed_prekey (key_id, public_key, signature).
+                None if the user doesn't exist
+        """
+
+        cached = self.entries.get(user_id)
+        if cached is not None and time.monotonic() - cached[1] < L1_TTL:
+            self.entries.move_to_end(user_id)
+            self.hits["l1"] += 1
+            return cached[0]
+
+        return await key_flight.do(("directory", user_id), lambda: self._fetch(user_id))
+
+    async def invalidate(self, user_id: int) -> None:
+        """
+        Call after changing a user's identity key or signed prekey, once the change is committed
+
+        Parameters:
+            user_id (int): The user whose keys changed
+        """
+
+        self._evict(user_id, await invalidate_entry(self.redis, user_id))
+
+    def stats(self) -> dict:
+        return {"cached": len(self.entries), "hits": self.hits}
+
+    async def _fetch(self, user_id: int) -> Optional[dict]:
+        version, raw = await self.redis.mget(version_key(user_id), entry_key(user_id))
+        version = int(version or 0)
+
+        if raw is not None:
+            entry = json.loads(raw)
+            if entry["version"] == version:
+                self.hits["l2"] += 1
+                self._remember(user_id, entry)
+                return entry
+
+        self.hits["db"] += 1
+        entry = await load_entry(user_id)
+        if entry is None:
+            return None
+
+        entry["version"] = version
+        # only cached if nobody changed the keys while we were reading them
+        script = self.redis.register_script(SET_IF_CURRENT)
+        stored = await script(
+            keys=[version_key(user_id), entry_key(user_id)],
+            args=[version, json.dumps(entry), L2_TTL],
+        )
+        if stored:
+            self._remember(user_id, entry)
+
+        return entry
+
+    def _remember(self, user_id: int, entry: dict) -> None:
+        if entry["version"] < self.versions.get(user_id, 0):
+            return
+
+        self.entries[user_id] = (entry, time.monotonic())
+        self.entries.move_to_end(user_id)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def _evict(self, user_id: int, version: int) -> None:
+        self.entries.pop(user_id, None)
+
+        self.versions[user_id] = max(version, self.versions.get(user_id, 0))
+        self.versions.move_to_end(user_id)
+        if len(self.versions) > self.capacity:
+            self.versions.popitem(last=False)
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    if message is None:
+                        continue
+
+                    user_id, _, version = message["data"].partition(":")
+                    self._evict(int(user_id), int(version))
+            except aioredis.exceptions.ConnectionError:
+                logger.warning("Lost the key invalidation subscription, reconnecting")
+                # invalidations may have been missed while disconnected
+                self.entries.clear()
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.close()
@@ -0,0 +1,230 @@
+""" (module) messages
+Storage for chat messages
+
+The messages table is range partitioned on the snowflake id. Snowflakes start with their timestamp
+so every partition holds one month of messages and time bounded queries only touch the partitions
+they need. Old months are removed by dropping the whole partition instead of deleting rows.
+History is paginated with before/after snowflake cursors on the (room_id, id) primary key.
+"""
+
+__all__ = [
+    "MessageStore",
+    "append_messages",
+    "fetch_history",
+    "ensure_partitions",
+    "drop_partitions_before",
+]
+
+import re
+import asyncio
+from typing import Optional
+from datetime import datetime
+
+from tortoise import connections
+
+from core.helpers import id_from_datetime
+
+COLUMNS = ("id", "room_id", "author_id", "envelope")
+PARTITION_NAME = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+
+
+def month_start(when: datetime) -> datetime:
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(when: datetime) -> datetime:
+    return datetime(when.year + when.month // 12, when.month % 12 + 1, 1)
+
+
+def partition_name(start: datetime) -> str:
+    return f"messages_y{start.year}m{start.month:02d}"
+
+
+async def append_messages(records: list[tuple[int, int, int, str]]) -> None:
+    """
+    Bulk insert messages with COPY
+
+    Parameters:
+        records (list[tuple[int, int, int, str]]): (id, room_id, author_id, envelope) for each message
+    """
+
+    conn = connections.get("default")
+    async with conn.acquire_connection() as connection:
+        await connection.copy_records_to_table(
+            "messages", records=records, columns=COLUMNS
+        )
+
+
+async def fetch_history(
+    room_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = 50,
+) -> list[dict]:
+    """
+    Get a page of a room's messages using snowflake cursors instead of OFFSET
+
+    Parameters:
+        room_id (int): The room to get messages from
+        before (Optional[int]): Only messages older than this message id
+        after (Optional[int]): Only messages newer than this message id
+        limit (int): Max amount of messages to return
+
+    Returns:
+        list[dict]: The messages. Oldest first when only after is given, otherwise newest first
+    """
+
+    params: list = [room_id]
+    clauses = ['"room_id" = $1']
+
+    if before is not None:
+        params.append(before)
+        clauses.append(f'"id" < ${len(params)}')
+    if after is not None:
+        params.append(after)
+        clauses.append(f'"id" > ${len(params)}')
+
+    # paging forwards from a cursor reads oldest first, everything else reads back from the newest
+    order = "ASC" if after is not None and before is None else "DESC"
+    params.append(limit)
+
+    query = (
+        'SELECT "id", "room_id", "author_id", "envelope" FROM "messages" '
+        f'WHERE {" AND ".join(clauses)} ORDER BY "id" {order} LIMIT ${len(params)}'
+    )
+    return await connections.get("default").execute_query_dict(query, params)
+
+
+async def ensure_partitions(months_ahead: int = 2) -> list[str]:
+    """
+    Create the partitions for this month and the next few months if they don't exist
+
+    Parameters:
+        months_ahead (int): How many months after the current one to create
+
+    Returns:
+        list[str]: The names of the partitions that are guaranteed to exist
+    """
+
+    conn = connections.get("default")
+    start = month_start(datetime.utcnow())
+    names = []
+
+    for _ in range(months_ahead + 1):
+        end = next_month(start)
+        name = partition_name(start)
+        await conn.execute_script(
+            f'CREATE TABLE IF NOT EXISTS "{name}" PARTITION OF "messages" '
+            f"FOR VALUES FROM ({id_from_datetime(start)}) TO ({id_from_datetime(end)})"
+        )
+        names.append(name)
+        start = end
+
+    return names
+
+
+async def drop_partitions_before(cutoff: datetime) -> list[str]:
+    """
+    Drop every monthly partition that only contains messages older than the cutoff
+
+    Parameters:
+        cutoff (datetime): Messages before this time can be removed
+
+    Returns:
+        list[str]: The names of the dropped partitions
+    """
+
+    conn = connections.get("default")
+    rows = await conn.execute_query_dict(
+        "SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass"
+    )
+
+    dropped = []
+    for row in rows:
+        match = PARTITION_NAME.match(row["name"])
+        if match is None:
+            continue
+
+        end = next_month(datetime(int(match[1]), int(match[2]), 1))
+        if end > cutoff:
+            continue
+
+        # detaching concurrently doesn't block inserts into the other partitions
+        await conn.execute_script(
+            f'ALTER TABLE "messages" DETACH PARTITION "{row["name"]}" CONCURRENTLY'
+        )
+        await conn.execute_script(f'DROP TABLE "{row["name"]}"')
+        dropped.append(row["name"])
+
+    return dropped
+
+
+class MessageStore:
+    """
+    Batches message writes. Messages appended within flush_interval of each other
+    are written with a single COPY and every appender is resumed once the batch is saved
+
+    Parameters:
+        batch_size (int): Flush straight away once this many messages are waiting
+        flush_interval (float): Max seconds a message waits before being written
+    """
+
+    def __init__(self, batch_size: int = 500, flush_interval: float = 0.05) -> None:
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.pending: list[tuple[tuple, asyncio.Future]] = []
+        self.wakeup = asyncio.Event()
+        self.flusher: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.flusher = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self.flush()
+
+    async def append(
+        self, message_id: int, room_id: int, author_id: int, envelope: str
+    ) -> None:
+        """
+        Queue a message and wait until the batch it is in has been written
+
+        Raises:
+            Exception: Whatever the database raised if the batch failed to save
+        """
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(((message_id, room_id, author_id, envelope), future))
+        if len(self.pending) >= self.batch_size:
+            self.wakeup.set()
+
+        await future
+
+    async def flush(self) -> None:
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+
+        try:
+            await append_messages([record for record, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for _, future in batch:
+                if not future.done():
+                    future.set_result(None)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            self.wakeup.clear()
+            await self.flush()
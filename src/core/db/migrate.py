@@ -0,0 +1,96 @@
+""" (module) migrate
+Applies the versioned migrations in core.db.migrations and checks the schema version on boot
+"""
+
+__all__ = ["apply_migrations", "schema_version", "verify_schema_version"]
+
+from typing import Optional
+
+from rich.console import Console
+from tortoise import connections
+from tortoise.transactions import in_transaction
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from core.helpers import OutdatedDatabaseSchema
+from .migrations import MIGRATIONS, LATEST_VERSION
+
+CREATE_VERSION_TABLE = """CREATE TABLE IF NOT EXISTS "schema_migrations" (
+    "version" INT NOT NULL PRIMARY KEY,
+    "name" TEXT NOT NULL,
+    "applied_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+)"""
+RECORD_VERSION = 'INSERT INTO "schema_migrations" ("version", "name") VALUES ($1, $2)'
+
+
+async def schema_version(conn: Optional[BaseDBAsyncClient] = None) -> int:
+    """
+    Get the version of the database schema
+
+    Parameters:
+        conn (Optional[BaseDBAsyncClient]): The connection to use, defaults to the primary
+
+    Returns:
+        int: The last applied migration version, 0 if migrations have never been run
+    """
+
+    conn = conn or connections.get("default")
+    rows = await conn.execute_query_dict(
+        "SELECT to_regclass('schema_migrations') IS NOT NULL AS exists"
+    )
+    if not rows[0]["exists"]:
+        return 0
+
+    rows = await conn.execute_query_dict(
+        'SELECT COALESCE(MAX("version"), 0) AS version FROM "schema_migrations"'
+    )
+    return rows[0]["version"]
+
+
+async def apply_migrations() -> int:
+    """
+    Applies every migration newer than the current schema version. Tortoise has to be initialised first
+
+    Returns:
+        int: The number of migrations applied
+    """
+
+    console = Console()
+    conn = connections.get("default")
+    await conn.execute_script(CREATE_VERSION_TABLE)
+    current = await schema_version(conn)
+
+    pending = sorted(
+        (m for m in MIGRATIONS if m.VERSION > current), key=lambda m: m.VERSION
+    )
+    for migration in pending:
+        name = migration.__name__.rsplit(".", 1)[-1]
+        console.print(f"[yellow]Applying migration {name}")
+
+        if migration.ATOMIC:
+            async with in_transaction("default") as transaction:
+                for statement in migration.UP:
+                    await transaction.execute_script(statement)
+                await transaction.execute_query(
+                    RECORD_VERSION, [migration.VERSION, name]
+                )
+        else:
+            # statements like CREATE INDEX CONCURRENTLY can't run inside a transaction
+            for statement in migration.UP:
+                await conn.execute_script(statement)
+            await conn.execute_query(RECORD_VERSION, [migration.VERSION, name])
+
+    console.print(f"[green]Database schema is at version {LATEST_VERSION}")
+    return len(pending)
+
+
+async def verify_schema_version() -> None:
+    """
+    Makes sure the database has every migration this version of the api needs
+
+    Raises:
+        OutdatedDatabaseSchema: If there are migrations that have not been applied
+    """
+
+    current = await schema_version()
+    if current < LATEST_VERSION:
+        raise OutdatedDatabaseSchema(current, LATEST_VERSION)
@@ -0,0 +1,38 @@
+""" (module) migrations
+Versioned schema changes. Each migration module has:
+    VERSION (int): The schema version after the migration is applied
+    ATOMIC (bool): If the statements run in a single transaction.
+        Has to be False for statements like CREATE INDEX CONCURRENTLY
+    UP (list[str]): The sql statements to run, in order
+"""
+
+__all__ = ["MIGRATIONS", "LATEST_VERSION"]
+
+from . import (
+    m0001_baseline,
+    m0002_hot_path_indexes,
+    m0003_messages,
+    m0004_room_members,
+    m0005_avatar_urls,
+    m0006_outbox,
+    m0007_signed_prekey_rotation,
+    m0008_binary_keys,
+    m0009_username_search,
+    m0010_device_inbox,
+    m0011_soft_delete,
+)
+
+MIGRATIONS = [
+    m0001_baseline,
+    m0002_hot_path_indexes,
+    m0003_messages,
+    m0004_room_members,
+    m0005_avatar_urls,
+    m0006_outbox,
+    m0007_signed_prekey_rotation,
+    m0008_binary_keys,
+    m0009_username_search,
+    m0010_device_inbox,
+    m0011_soft_delete,
+]
+LATEST_VERSION = max(migration.VERSION for migration in MIGRATIONS)
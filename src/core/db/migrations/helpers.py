@@ -0,0 +1,30 @@
+from typing import Optional
+
+
+def concurrent_index(
+    name: str,
+    table: str,
+    columns: str,
+    unique: bool = False,
+    where: Optional[str] = None,
+) -> list[str]:
+    """
+    Statements to build an index without locking the table for writes.
+    A failed concurrent build leaves an invalid index behind, so it gets dropped first to make reruns safe
+
+    Parameters:
+        name (str): The name of the index
+        table (str): The table to index
+        columns (str): The column list / expressions, eg: '"owner_id", "id" DESC'
+        unique (bool): If it should be a unique index
+        where (Optional[str]): Makes it a partial index of the rows matching this condition
+
+    Returns:
+        list[str]: The statements to put in a non atomic migration
+    """
+
+    create = f'CREATE {"UNIQUE " if unique else ""}INDEX CONCURRENTLY "{name}" ON "{table}" ({columns})'
+    if where is not None:
+        create += f" WHERE {where}"
+
+    return [f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"', create]
@@ -0,0 +1,48 @@
+""" (migration) 0001
+The schema that used to be created by generate_schemas on boot.
+Uses IF NOT EXISTS so databases that were created that way can adopt migrations
+"""
+
+VERSION = 1
+ATOMIC = True
+UP = [
+    """CREATE TABLE IF NOT EXISTS "users" (
+        "id" BIGINT NOT NULL PRIMARY KEY,
+        "username" VARCHAR(32) NOT NULL UNIQUE,
+        "password" TEXT NOT NULL,
+        "email" VARCHAR(256) NOT NULL UNIQUE,
+        "firstname" VARCHAR(64) NOT NULL,
+        "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        "verified" BOOL NOT NULL DEFAULT False,
+        "lastname" VARCHAR(64),
+        "avatar" TEXT,
+        "rooms" BIGINT[],
+        "display_name" TEXT,
+        "identity_key" TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS "blacklisted_ips" (
+        "id" BIGSERIAL NOT NULL PRIMARY KEY,
+        "ip" VARCHAR(40) NOT NULL UNIQUE
+    )""",
+    """CREATE TABLE IF NOT EXISTS "blacklisted_emails" (
+        "id" BIGSERIAL NOT NULL PRIMARY KEY,
+        "email" VARCHAR(256) NOT NULL UNIQUE
+    )""",
+    """CREATE TABLE IF NOT EXISTS "tokens" (
+        "token_id" BIGINT NOT NULL PRIMARY KEY,
+        "token_type" VARCHAR(16) NOT NULL,
+        "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        "owner_id" BIGINT NOT NULL REFERENCES "users" ("id") ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS "one_time_pre_keys" (
+        "id" BIGINT NOT NULL PRIMARY KEY,
+        "public_key" TEXT NOT NULL,
+        "owner_id" BIGINT NOT NULL REFERENCES "users" ("id") ON DELETE CASCADE
+    )""",
+    """CREATE TABLE IF NOT EXISTS "signed_pre_keys" (
+        "id" BIGINT NOT NULL PRIMARY KEY,
+        "public_key" TEXT NOT NULL,
+        "signature" TEXT NOT NULL,
+        "owner_id" BIGINT NOT NULL REFERENCES "users" ("id") ON DELETE CASCADE
+    )""",
+]
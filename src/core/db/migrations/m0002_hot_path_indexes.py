@@ -0,0 +1,20 @@
+""" (migration) 0002
+Composite indexes for the lookups done on every login, refresh and bundle fetch
+"""
+
+from .helpers import concurrent_index
+
+VERSION = 2
+ATOMIC = False
+UP = [
+    # tok_gen: revoke refresh tokens by owner and type
+    *concurrent_index("tokens_owner_type_idx", "tokens", '"owner_id", "token_type"'),
+    # get_user_keys: any prekey for an owner
+    *concurrent_index(
+        "one_time_pre_keys_owner_idx", "one_time_pre_keys", '"owner_id", "id"'
+    ),
+    # get_user_keys: newest signed prekey for an owner
+    *concurrent_index(
+        "signed_pre_keys_owner_id_desc_idx", "signed_pre_keys", '"owner_id", "id" DESC'
+    ),
+]
@@ -0,0 +1,17 @@
+""" (migration) 0003
+Message store. Range partitioned on the snowflake id (which starts with the timestamp)
+so each partition holds a month of messages, see core.db.messages for partition management.
+The (room_id, id) primary key keeps a room's messages together for keyset pagination
+"""
+
+VERSION = 3
+ATOMIC = True
+UP = [
+    """CREATE TABLE IF NOT EXISTS "messages" (
+        "id" BIGINT NOT NULL,
+        "room_id" BIGINT NOT NULL,
+        "author_id" BIGINT NOT NULL,
+        "envelope" TEXT NOT NULL,
+        PRIMARY KEY ("room_id", "id")
+    ) PARTITION BY RANGE ("id")""",
+]
@@ -0,0 +1,22 @@
+""" (migration) 0004
+Moves room membership out of the users.rooms array into its own table.
+The primary key looks up the members of a room and the (user_id, room_id) index
+looks up the rooms of a user. Rooms in the old array were the ones the user owned or administered
+"""
+
+VERSION = 4
+ATOMIC = True
+UP = [
+    """CREATE TABLE IF NOT EXISTS "room_members" (
+        "room_id" BIGINT NOT NULL,
+        "user_id" BIGINT NOT NULL REFERENCES "users" ("id") ON DELETE CASCADE,
+        "role" VARCHAR(16) NOT NULL DEFAULT 'member',
+        "joined_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY ("room_id", "user_id")
+    )""",
+    'CREATE INDEX IF NOT EXISTS "room_members_user_idx" ON "room_members" ("user_id", "room_id")',
+    """INSERT INTO "room_members" ("room_id", "user_id", "role")
+        SELECT DISTINCT unnest("rooms"), "id", 'admin' FROM "users" WHERE "rooms" IS NOT NULL
+        ON CONFLICT DO NOTHING""",
+    'ALTER TABLE "users" DROP COLUMN IF EXISTS "rooms"',
+]
@@ -0,0 +1,10 @@
+""" (migration) 0005
+Avatars are stored as a url per size. Existing single links become the full size url
+"""
+
+VERSION = 5
+ATOMIC = True
+UP = [
+    """ALTER TABLE "users" ALTER COLUMN "avatar" TYPE JSONB
+        USING CASE WHEN "avatar" IS NULL THEN NULL ELSE jsonb_build_object('1000', "avatar") END""",
+]
@@ -0,0 +1,14 @@
+""" (migration) 0006
+Transactional outbox for messages to rabbitmq
+"""
+
+VERSION = 6
+ATOMIC = True
+UP = [
+    """CREATE TABLE IF NOT EXISTS "outbox" (
+        "id" BIGSERIAL NOT NULL PRIMARY KEY,
+        "channel" VARCHAR(64) NOT NULL,
+        "payload" JSONB NOT NULL,
+        "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )""",
+]
@@ -0,0 +1,24 @@
+""" (migration) 0007
+Signed prekey rotation, replaced keys are kept for a grace period and then pruned
+"""
+
+from .helpers import concurrent_index
+
+VERSION = 7
+ATOMIC = False
+UP = [
+    'ALTER TABLE "signed_pre_keys" ADD COLUMN IF NOT EXISTS "superseded_at" TIMESTAMP',
+    # existing owners may have several keys from before rotation, only the newest stays current
+    """UPDATE "signed_pre_keys" SET "superseded_at" = CURRENT_TIMESTAMP
+    WHERE "superseded_at" IS NULL AND "id" NOT IN (
+        SELECT DISTINCT ON ("owner_id") "id" FROM "signed_pre_keys"
+        ORDER BY "owner_id", "id" DESC
+    )""",
+    # prune job: replaced keys by age, current keys aren't in the index at all
+    *concurrent_index(
+        "signed_pre_keys_superseded_idx",
+        "signed_pre_keys",
+        '"superseded_at"',
+        where='"superseded_at" IS NOT NULL',
+    ),
+]
@@ -0,0 +1,45 @@
+""" (migration) 0008
+Public keys and signatures are stored as raw bytes instead of base64 text,
+about a quarter smaller and compared byte for byte.
+Rewrites the key tables so it holds a lock on them until it is done
+
+Keys were stored without any validation before this, rows that aren't base64 or don't decode
+to a key of the right size are dropped (identity keys are cleared) instead of failing the upgrade
+"""
+
+
+def stripped(column: str) -> str:
+    return f"regexp_replace(\"{column}\", '\\s', '', 'g')"
+
+
+def is_base64(column: str) -> str:
+    value = stripped(column)
+    return f"({value} ~ '^[A-Za-z0-9+/]*={{0,2}}$' AND length({value}) % 4 = 0)"
+
+
+def decoded(column: str) -> str:
+    return f"decode({stripped(column)}, 'base64')"
+
+
+VERSION = 8
+ATOMIC = True
+UP = [
+    f"""UPDATE "users" SET "identity_key" = NULL
+    WHERE "identity_key" IS NOT NULL AND NOT {is_base64("identity_key")}""",
+    f'DELETE FROM "one_time_pre_keys" WHERE NOT {is_base64("public_key")}',
+    f"""DELETE FROM "signed_pre_keys"
+    WHERE NOT {is_base64("public_key")} OR NOT {is_base64("signature")}""",
+    f"""ALTER TABLE "users"
+    ALTER COLUMN "identity_key" TYPE BYTEA USING {decoded("identity_key")}""",
+    f"""ALTER TABLE "one_time_pre_keys"
+    ALTER COLUMN "public_key" TYPE BYTEA USING {decoded("public_key")}""",
+    f"""ALTER TABLE "signed_pre_keys"
+    ALTER COLUMN "public_key" TYPE BYTEA USING {decoded("public_key")},
+    ALTER COLUMN "signature" TYPE BYTEA USING {decoded("signature")}""",
+    # the sizes core.helpers.key_encoding accepts
+    """UPDATE "users" SET "identity_key" = NULL
+    WHERE length("identity_key") NOT IN (32, 33)""",
+    'DELETE FROM "one_time_pre_keys" WHERE length("public_key") NOT IN (32, 33)',
+    """DELETE FROM "signed_pre_keys"
+    WHERE length("public_key") NOT IN (32, 33) OR length("signature") <> 64""",
+]
@@ -0,0 +1,17 @@
+""" (migration) 0009
+Index for username prefix search. The C collation makes LIKE 'prefix%' and the
+keyset pagination order both use the index, only verified users can be found
+"""
+
+from .helpers import concurrent_index
+
+VERSION = 9
+ATOMIC = False
+UP = [
+    *concurrent_index(
+        "users_username_search_idx",
+        "users",
+        'lower("username") COLLATE "C", "id"',
+        where='"verified"',
+    ),
+]
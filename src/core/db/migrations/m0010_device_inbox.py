@@ -0,0 +1,27 @@
+""" (migration) 0010
+Devices and the postgres side of their inboxes. Envelopes queue in a redis stream per device
+and are moved here when the stream gets too long or redis runs low on memory, see core.db.inbox.
+Spilled envelopes keep their stream entry id (ms, seq) so they are read and acked in stream order
+"""
+
+VERSION = 10
+ATOMIC = True
+UP = [
+    """CREATE TABLE IF NOT EXISTS "devices" (
+        "id" BIGINT NOT NULL PRIMARY KEY,
+        "owner_id" BIGINT NOT NULL REFERENCES "users" ("id") ON DELETE CASCADE,
+        "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    )""",
+    'CREATE INDEX IF NOT EXISTS "devices_owner_idx" ON "devices" ("owner_id")',
+    """CREATE TABLE IF NOT EXISTS "inbox_spill" (
+        "device_id" BIGINT NOT NULL REFERENCES "devices" ("id") ON DELETE CASCADE,
+        "entry_ms" BIGINT NOT NULL,
+        "entry_seq" BIGINT NOT NULL,
+        "sender_id" BIGINT NOT NULL,
+        "envelope" TEXT NOT NULL,
+        "created_at" TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY ("device_id", "entry_ms", "entry_seq")
+    )""",
+    # expiry of envelopes nobody came back for
+    'CREATE INDEX IF NOT EXISTS "inbox_spill_created_at_idx" ON "inbox_spill" ("created_at")',
+]
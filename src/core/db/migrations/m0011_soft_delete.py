@@ -0,0 +1,19 @@
+""" (migration) 0011
+Accounts are marked as deleted and purged later in batches, see core.db.accounts.
+Adding a nullable column without a default doesn't rewrite the table
+"""
+
+from .helpers import concurrent_index
+
+VERSION = 11
+ATOMIC = False
+UP = [
+    'ALTER TABLE "users" ADD COLUMN IF NOT EXISTS "deleted_at" TIMESTAMP NULL',
+    # the purger's queue, only ever holds the few accounts waiting to be purged
+    *concurrent_index(
+        "users_deleted_at_idx",
+        "users",
+        '"deleted_at"',
+        where='"deleted_at" IS NOT NULL',
+    ),
+]
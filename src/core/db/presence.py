@@ -0,0 +1,247 @@
+""" (module) presence
+Who is online, kept only in redis and never written to postgres
+
+Every user gets a small dense offset the first time they connect. Time is cut into slots as
+long as the gateway heartbeat interval and each slot has a bitmap (presence:slot:{n}) with the
+bit at a user's offset set while they are connected. A user is online if their bit is set in the
+current or the previous slot, so a million users cost 125KB a slot and old slots simply expire.
+The user id -> offset map is split over hashes by the last OFFSET_BUCKET_DIGITS decimal digits
+of the user id, so each one stays small enough for redis to store it compactly. The bucket is
+taken from the id as text because Lua numbers are doubles and can't hold a snowflake exactly,
+a modulo in the script would put most users in the wrong bucket.
+
+Heartbeats are not written as they come in. They are collected and each worker writes them
+every flush_interval as one pipeline, at most once per user per slot.
+Presence of a whole room is one script call: the room's member set, their offsets and their bits
+are all read inside redis.
+"""
+
+__all__ = ["Presence"]
+
+import time
+import asyncio
+import logging
+from typing import Final, Optional
+
+import aioredis.exceptions
+from aioredis import Redis
+
+from .rooms import members_key, get_members
+
+OFFSET_BUCKET_DIGITS: Final = 4  # 10000 buckets
+OFFSET_COUNTER: Final = "presence:next_offset"
+OFFSET_CACHE_SIZE: Final = 100000
+
+logger = logging.getLogger(__name__)
+
+# KEYS: offset bucket, counter
+# ARGV: user id
+ALLOCATE_OFFSET = """
+local offset = redis.call('HGET', KEYS[1], ARGV[1])
+if offset then
+    return tonumber(offset)
+end
+offset = redis.call('INCR', KEYS[2]) - 1
+redis.call('HSET', KEYS[1], ARGV[1], offset)
+return offset
+"""
+
+# KEYS: current slot, previous slot, room member set (optional)
+# ARGV: bucket digits, user ids (when there is no member set)
+# returns the online users, or false if the room's member set isn't cached.
+# the offset buckets are worked out in the script, fine with a single redis but not a cluster
+ONLINE_USERS = """
+local users = ARGV
+local first = 2
+if KEYS[3] then
+    users = redis.call('SMEMBERS', KEYS[3])
+    if #users == 0 then
+        return false
+    end
+    first = 1
+end
+
+local digits = tonumber(ARGV[1])
+local online = {}
+for i = first, #users do
+    local user = users[i]
+    local bucket = 'presence:offsets:' .. string.sub(user, -digits)
+    local offset = redis.call('HGET', bucket, user)
+    if offset and (redis.call('GETBIT', KEYS[1], offset) == 1
+        or redis.call('GETBIT', KEYS[2], offset) == 1) then
+        online[#online + 1] = user
+    end
+end
+return online
+"""
+
+
+def offset_bucket(user_id: int) -> str:
+    # the same as ONLINE_USERS works out, string.sub(user, -digits)
+    return f"presence:offsets:{str(user_id)[-OFFSET_BUCKET_DIGITS:]}"
+
+
+def slot_key(slot: int) -> str:
+    return f"presence:slot:{slot}"
+
+
+class Presence:
+    """
+    Parameters:
+        redis (Redis): The redis connection presence is kept in
+        slot_length (int): Seconds per slot, the gateway heartbeat interval
+        flush_interval (float): Seconds heartbeats are collected for before being written
+
+    Attributes:
+        pending (set[int]): Users that sent a heartbeat since the last flush
+        writes (int): Bits set by this worker, one per user per slot at most
+    """
+
+    def __init__(
+        self, redis: Redis, slot_length: int = 30, flush_interval: float = 1.0
+    ) -> None:
+        self.redis = redis
+        self.slot_length = slot_length
+        self.flush_interval = flush_interval
+
+        self.offsets: dict[int, int] = {}
+        self.pending: set[int] = set()
+        self.marked: set[int] = set()
+        self.marked_slot = -1
+
+        self.heartbeats = 0
+        self.writes = 0
+        self.flusher: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.flusher = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self.flusher is not None:
+            self.flusher.cancel()
+        await self.flush()
+
+    def beat(self, user_id: int) -> None:
+        """Mark a user as online, written with the next flush"""
+
+        self.heartbeats += 1
+        self.pending.add(user_id)
+
+    def slot(self) -> int:
+        return int(time.time()) // self.slot_length
+
+    async def flush(self) -> None:
+        slot = self.slot()
+        if slot != self.marked_slot:
+            self.marked, self.marked_slot = set(), slot
+
+        users = self.pending - self.marked
+        self.pending = set()
+        if not users:
+            return
+
+        offsets = await self.resolve_offsets(users)
+        key = slot_key(slot)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for offset in offsets.values():
+                pipe.setbit(key, offset, 1)
+            # the slot is read while it is the current and the previous one
+            pipe.expire(key, self.slot_length * 3)
+            await pipe.execute()
+
+        self.marked.update(users)
+        self.writes += len(users)
+
+    async def resolve_offsets(self, user_ids: set[int]) -> dict[int, int]:
+        """
+        Get the offsets of users, giving the ones that don't have one yet a new one
+
+        Returns:
+            dict[int, int]: user id -> offset
+        """
+
+        offsets = {
+            user_id: self.offsets[user_id]
+            for user_id in user_ids
+            if user_id in self.offsets
+        }
+        missing = [user_id for user_id in user_ids if user_id not in offsets]
+        if not missing:
+            return offsets
+
+        script = self.redis.register_script(ALLOCATE_OFFSET)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for user_id in missing:
+                await script(
+                    keys=[offset_bucket(user_id), OFFSET_COUNTER],
+                    args=[user_id],
+                    client=pipe,
+                )
+            results = await pipe.execute()
+
+        # offsets never change so they can be kept, the cache is only dropped when it gets big
+        if len(self.offsets) > OFFSET_CACHE_SIZE:
+            self.offsets.clear()
+        for user_id, offset in zip(missing, results):
+            self.offsets[user_id] = offsets[user_id] = int(offset)
+
+        return offsets
+
+    async def online(self, user_ids: list[int]) -> list[int]:
+        """
+        Check which of the given users are online, one round trip
+
+        Parameters:
+            user_ids (list[int]): The users
+
+        Returns:
+            list[int]: The ones that are online
+        """
+
+        slot = self.slot()
+        script = self.redis.register_script(ONLINE_USERS)
+        online = await script(
+            keys=[slot_key(slot), slot_key(slot - 1)],
+            args=[OFFSET_BUCKET_DIGITS, *user_ids],
+        )
+        return [int(user_id) for user_id in online]
+
+    async def online_members(self, room_id: int) -> list[int]:
+        """
+        Get the members of a room that are online, one round trip when the member set is cached
+
+        Parameters:
+            room_id (int): The room
+
+        Returns:
+            list[int]: The online members
+        """
+
+        slot = self.slot()
+        script = self.redis.register_script(ONLINE_USERS)
+        keys = [slot_key(slot), slot_key(slot - 1), members_key(room_id)]
+        args = [OFFSET_BUCKET_DIGITS]
+
+        online = await script(keys=keys, args=args)
+        if online is None:
+            # not cached, loading the members caches them for the next call
+            if not await get_members(self.redis, room_id):
+                return []
+            online = await script(keys=keys, args=args) or []
+
+        return [int(user_id) for user_id in online]
+
+    def stats(self) -> dict:
+        return {
+            "heartbeats": self.heartbeats,
+            "writes": self.writes,
+            "pending": len(self.pending),
+        }
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except aioredis.exceptions.ConnectionError:
+                logger.warning("Couldn't write presence heartbeats")
@@ -0,0 +1,224 @@
+""" (module) rooms
+Room membership, stored in the room_members table and cached in redis
+
+Each room's members are cached as a redis set so fan-out and membership checks
+don't hit postgres. Writes go to postgres first and then patch the cached set if there is one.
+
+Every write also replaces the room's generation, a random token. A read that misses the cache
+notes the generation before querying postgres and only fills the cache if it is still the same,
+so a member list read before a write can't be cached after it.
+"""
+
+__all__ = [
+    "add_members",
+    "remove_members",
+    "get_members",
+    "get_rooms",
+    "get_role",
+    "is_member",
+    "members_key",
+    "bump_generations",
+]
+
+import secrets
+from typing import Final, Optional
+
+from aioredis import Redis
+from tortoise import connections
+
+MEMBER_CACHE_TTL: Final = 60 * 10  # seconds
+CACHE_CHUNK_SIZE: Final = 1000  # max members per redis command
+
+# only patch a cached set, patching a missing one would cache a partial member list
+ADD_IF_CACHED = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return redis.call('SADD', KEYS[1], unpack(ARGV))
+end
+return 0
+"""
+
+# KEYS: members, generation
+# ARGV: generation read before the query, ttl, members...
+FILL_IF_UNCHANGED = """
+if (redis.call('GET', KEYS[2]) or '') ~= ARGV[1] then
+    return 0
+end
+redis.call('DEL', KEYS[1])
+for start = 3, #ARGV, 1000 do
+    redis.call('SADD', KEYS[1], unpack(ARGV, start, math.min(start + 999, #ARGV)))
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
+
+
+def chunked(items: list[int]) -> list[list[int]]:
+    chunks = []
+    for start in range(0, len(items), CACHE_CHUNK_SIZE):
+        end = start + CACHE_CHUNK_SIZE
+        chunks.append(items[start:end])
+    return chunks
+
+
+def members_key(room_id: int) -> str:
+    return f"room:{room_id}:members"
+
+
+def generation_key(room_id: int) -> str:
+    return f"room:{room_id}:members:generation"
+
+
+async def bump_generations(redis: Redis, room_ids: list[int]) -> None:
+    """Call after changing the members of rooms, cache fills that started before are dropped"""
+
+    # outlives any cache fill, a fill that sees it expire just doesn't cache
+    async with redis.pipeline(transaction=False) as pipe:
+        for room_id in room_ids:
+            pipe.set(generation_key(room_id), secrets.token_hex(8), ex=MEMBER_CACHE_TTL)
+        await pipe.execute()
+
+
+async def add_members(
+    redis: Redis, room_id: int, user_ids: list[int], role: str = "member"
+) -> list[int]:
+    """
+    Add users to a room in bulk, users that don't exist or are already members are skipped
+
+    Parameters:
+        redis (Redis): The redis connection holding the member cache
+        room_id (int): The room to add the users to
+        user_ids (list[int]): The users to add
+        role (str): The role the new members get
+
+    Returns:
+        list[int]: The users that were added
+    """
+
+    rows = await connections.get("default").execute_query_dict(
+        'INSERT INTO "room_members" ("room_id", "user_id", "role") '
+        'SELECT $1, "id", $3 FROM "users" WHERE "id" = ANY($2::BIGINT[]) '
+        'ON CONFLICT DO NOTHING RETURNING "user_id"',
+        [room_id, user_ids, role],
+    )
+    added = [row["user_id"] for row in rows]
+    if added:
+        await bump_generations(redis, [room_id])
+
+    script = redis.register_script(ADD_IF_CACHED)
+    for chunk in chunked(added):
+        await script(keys=[members_key(room_id)], args=chunk)
+
+    return added
+
+
+async def remove_members(redis: Redis, room_id: int, user_ids: list[int]) -> list[int]:
+    """
+    Remove users from a room in bulk
+
+    Parameters:
+        redis (Redis): The redis connection holding the member cache
+        room_id (int): The room to remove the users from
+        user_ids (list[int]): The users to remove
+
+    Returns:
+        list[int]: The users that were members and have been removed
+    """
+
+    rows = await connections.get("default").execute_query_dict(
+        'DELETE FROM "room_members" WHERE "room_id" = $1 AND "user_id" = ANY($2::BIGINT[]) '
+        'RETURNING "user_id"',
+        [room_id, user_ids],
+    )
+    removed = [row["user_id"] for row in rows]
+    if removed:
+        await bump_generations(redis, [room_id])
+
+    for chunk in chunked(removed):
+        await redis.srem(members_key(room_id), *chunk)
+
+    return removed
+
+
+async def get_members(redis: Redis, room_id: int) -> set[int]:
+    """
+    Get every member of a room, from the cache if possible
+
+    Parameters:
+        redis (Redis): The redis connection holding the member cache
+        room_id (int): The room
+
+    Returns:
+        set[int]: The user ids of the members
+    """
+
+    key = members_key(room_id)
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.smembers(key)
+        pipe.get(generation_key(room_id))
+        cached, generation = await pipe.execute()
+    if cached:
+        return {int(member) for member in cached}
+
+    rows = await connections.get("default").execute_query_dict(
+        'SELECT "user_id" FROM "room_members" WHERE "room_id" = $1', [room_id]
+    )
+    members = [row["user_id"] for row in rows]
+    if not members:
+        return set()
+
+    # skipped if members were added or removed since the generation was read
+    script = redis.register_script(FILL_IF_UNCHANGED)
+    await script(
+        keys=[key, generation_key(room_id)],
+        args=[generation or "", MEMBER_CACHE_TTL, *members],
+    )
+
+    return set(members)
+
+
+async def is_member(redis: Redis, room_id: int, user_id: int) -> bool:
+    """
+    Check if a user is in a room, one redis round trip when the room is cached
+
+    Returns:
+        bool: If the user is a member of the room
+    """
+
+    if await redis.sismember(members_key(room_id), user_id):
+        return True
+    if await redis.exists(members_key(room_id)):
+        return False
+
+    return user_id in await get_members(redis, room_id)
+
+
+async def get_rooms(user_id: int) -> list[int]:
+    """
+    Get the rooms a user is a member of
+
+    Parameters:
+        user_id (int): The user
+
+    Returns:
+        list[int]: The room ids
+    """
+
+    rows = await connections.get("default").execute_query_dict(
+        'SELECT "room_id" FROM "room_members" WHERE "user_id" = $1', [user_id]
+    )
+    return [row["room_id"] for row in rows]
+
+
+async def get_role(room_id: int, user_id: int) -> Optional[str]:
+    """
+    Get the role of a member in a room
+
+    Returns:
+        Optional[str]: The role or None if the user is not a member
+    """
+
+    rows = await connections.get("default").execute_query_dict(
+        'SELECT "role" FROM "room_members" WHERE "room_id" = $1 AND "user_id" = $2',
+        [room_id, user_id],
+    )
+    return rows[0]["role"] if rows else None
@@ -0,0 +1,57 @@
+""" (module) routing
+Routes read only ORM queries to the read replicas
+
+Reads are spread round robin over the replicas until the current request writes something.
+After that the request is pinned to the primary so it always reads its own writes.
+"""
+
+__all__ = ["ReadReplicaRouter", "RequestScope", "request_scope"]
+
+from itertools import cycle
+from typing import Optional
+from contextvars import ContextVar
+
+from .utils import REPLICA_CONNECTIONS
+
+PRIMARY_CONNECTION = "default"
+
+
+class RequestScope:
+    """
+    Per request routing state. Created by the DatabasePinningMiddleware for every request
+
+    Attributes:
+        pinned (bool): If the request has written to the primary and must keep reading from it
+    """
+
+    __slots__ = ("pinned",)
+
+    def __init__(self) -> None:
+        self.pinned = False
+
+
+request_scope: ContextVar[Optional[RequestScope]] = ContextVar(
+    "request_scope", default=None
+)
+_replicas = cycle(REPLICA_CONNECTIONS)
+
+
+class ReadReplicaRouter:
+    """
+    Tortoise database router that sends reads to the replicas
+    Anything running outside of a request (eg: the rabbitmq consumer) always uses the primary
+    """
+
+    def db_for_read(self, model) -> str:
+        scope = request_scope.get()
+        if scope is None or scope.pinned or not REPLICA_CONNECTIONS:
+            return PRIMARY_CONNECTION
+
+        return next(_replicas)
+
+    def db_for_write(self, model) -> str:
+        scope = request_scope.get()
+        if scope is not None:
+            scope.pinned = True
+
+        return PRIMARY_CONNECTION
@@ -0,0 +1,443 @@
+""" (module) uploads
+Resumable, chunked uploads of attachments into the blob store
+
+An upload starts as a session in redis and a sparse file of its final size, disk space is only
+allocated for a chunk when it arrives so abandoned uploads don't hold any. Chunks have
+a fixed size so each one knows its offset, can arrive in any order, in parallel and be retried.
+A chunk is streamed from the request straight into its place in the file in small pieces,
+so memory use per upload stays the same whatever the size of the attachment.
+The chunks received are a set in redis, which is what a client resuming an upload asks for.
+
+Each chunk is hashed as it arrives and checked against X-Chunk-SHA256 when the client sends one.
+While chunks arrive in order the sha256 of the whole file is built up as they are written,
+uploads that went out of order, moved between workers or had a chunk sent twice are hashed
+once more when finalized.
+Finalizing moves the file into the blob store under its digest. Chunks being written are
+counted in the session and finalizing waits for none to be in flight, so the file can't change
+while it is hashed and moved.
+"""
+
+__all__ = [
+    "UploadStore",
+    "upload_options",
+    "InvalidChunk",
+    "UploadNotFound",
+    "UploadIncomplete",
+]
+
+import os
+import time
+import asyncio
+import hashlib
+import logging
+import secrets
+from os.path import join
+from typing import AsyncIterator, Final, Optional
+
+from aioredis import Redis
+
+from core.helpers.blobstore import blob_store
+
+WRITE_SIZE: Final = 1024 * 1024  # bytes buffered before each write
+HASH_READ_SIZE: Final = 1024 * 1024
+MAX_RUNNING_HASHES: Final = 10000
+SWEEP_INTERVAL: Final = 60 * 60  # seconds
+
+logger = logging.getLogger(__name__)
+
+# KEYS: session
+START_WRITE = """
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('HEXISTS', KEYS[1], 'finalizing') == 1 then
+    return 0
+end
+redis.call('HINCRBY', KEYS[1], 'writers', 1)
+return 1
+"""
+
+# KEYS: session
+END_WRITE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBY', KEYS[1], 'writers', -1)
+end
+"""
+
+# KEYS: session
+# 1 if claimed, 0 if gone or already finalizing, -1 if chunks are still being written
+CLAIM_FINALIZE = """
+if redis.call('EXISTS', KEYS[1]) == 0 or redis.call('HEXISTS', KEYS[1], 'finalizing') == 1 then
+    return 0
+end
+if tonumber(redis.call('HGET', KEYS[1], 'writers') or '0') > 0 then
+    return -1
+end
+redis.call('HSET', KEYS[1], 'finalizing', 1)
+return 1
+"""
+
+
+class InvalidChunk(Exception):
+    pass
+
+
+class UploadNotFound(Exception):
+    pass
+
+
+class UploadIncomplete(Exception):
+    def __init__(self, missing: list[int]) -> None:
+        super().__init__(f"{len(missing)} chunks have not been uploaded")
+        self.missing = missing
+
+
+def upload_options() -> dict:
+    """
+    Reads the upload settings from the environment
+
+    Returns:
+        dict: Keyword arguments for UploadStore
+    """
+
+    return {
+        "chunk_size": int(os.environ.get("ATTACHMENT_CHUNK_SIZE", 8 * 1024 * 1024)),
+        "max_size": int(os.environ.get("ATTACHMENT_MAX_SIZE", 1024 * 1024 * 1024)),
+        "ttl": int(os.environ.get("ATTACHMENT_UPLOAD_TTL", 24 * 60 * 60)),
+    }
+
+
+def session_key(upload_id: str) -> str:
+    return f"upload:{upload_id}"
+
+
+def received_key(upload_id: str) -> str:
+    return f"upload:{upload_id}:received"
+
+
+def write_at(fd: int, data: bytes, position: int, hashers: list) -> None:
+    for hasher in hashers:
+        hasher.update(data)
+
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, position)
+        view, position = view[written:], position + written
+
+
+def hash_file(path: str) -> str:
+    hasher = hashlib.sha256()
+    with open(path, "rb") as f:
+        while data := f.read(HASH_READ_SIZE):
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def create_sparse(path: str, size: int) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+
+
+def allocate(fd: int, offset: int, length: int) -> None:
+    # a full disk fails the chunk before its body is read instead of halfway through
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(fd, offset, length)
+
+
+class UploadStore:
+    """
+    Parameters:
+        redis (Redis): The redis connection the sessions are kept in
+        root (str): Directory for files being uploaded,
+            on the same filesystem as the blob store so finalizing is a rename
+        chunk_size (int): Bytes in every chunk but the last
+        max_size (int): The largest attachment that can be uploaded
+        ttl (int): Seconds an upload can go without a chunk before it is abandoned
+
+    Attributes:
+        running (dict[str, tuple]): upload id -> (sha256 of the chunks so far, next chunk,
+            time.monotonic() of the last chunk), for uploads arriving in order on this worker
+    """
+
+    def __init__(
+        self,
+        redis: Redis,
+        root: str,
+        chunk_size: int = 8 * 1024 * 1024,
+        max_size: int = 1024 * 1024 * 1024,
+        ttl: int = 24 * 60 * 60,
+    ) -> None:
+        self.redis = redis
+        self.root = root
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.running: dict[str, tuple] = {}
+        self.rehashed = 0
+        self.sweeper: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        self.sweeper = asyncio.create_task(self._sweep())
+
+    async def close(self) -> None:
+        if self.sweeper is not None:
+            self.sweeper.cancel()
+
+    def path(self, upload_id: str) -> str:
+        return join(self.root, f"{upload_id}.part")
+
+    async def create(
+        self, owner_id: int, size: int, sha256: Optional[str] = None
+    ) -> dict:
+        """
+        Start an upload
+
+        Parameters:
+            owner_id (int): The user uploading
+            size (int): The size of the attachment in bytes
+            sha256 (Optional[str]): The digest the finished file has to have, if the client knows it
+
+        Returns:
+            dict: upload_id, chunk_size and chunks (how many chunks there are)
+
+        Raises:
+            InvalidChunk: If the size is too big
+        """
+
+        if not 0 < size <= self.max_size:
+            raise InvalidChunk(f"size must be between 1 and {self.max_size} bytes")
+
+        upload_id = secrets.token_urlsafe(18)
+        chunks = -(-size // self.chunk_size)
+        await asyncio.to_thread(create_sparse, self.path(upload_id), size)
+
+        session = {
+            "owner_id": owner_id,
+            "size": size,
+            "chunk_size": self.chunk_size,
+            "chunks": chunks,
+        }
+        if sha256 is not None:
+            session["sha256"] = sha256
+
+        async with self.redis.pipeline(transaction=True) as pipe:
+            pipe.hset(session_key(upload_id), mapping=session)
+            pipe.expire(session_key(upload_id), self.ttl)
+            await pipe.execute()
+
+        return {"upload_id": upload_id, "chunk_size": self.chunk_size, "chunks": chunks}
+
+    async def session(self, upload_id: str, owner_id: int) -> dict:
+        """
+        Get an upload's session
+
+        Raises:
+            UploadNotFound: If there is no such upload or it belongs to someone else
+        """
+
+        session = await self.redis.hgetall(session_key(upload_id))
+        if not session or int(session["owner_id"]) != owner_id:
+            raise UploadNotFound(upload_id)
+
+        return {
+            key: value if key == "sha256" else int(value)
+            for key, value in session.items()
+        }
+
+    async def missing(self, upload_id: str, session: dict) -> list[int]:
+        """
+        Get the chunks that still have to be uploaded
+
+        Returns:
+            list[int]: The indexes of the missing chunks
+        """
+
+        received = await self.redis.smembers(received_key(upload_id))
+        received = {int(index) for index in received}
+        return [index for index in range(session["chunks"]) if index not in received]
+
+    async def write_chunk(
+        self,
+        upload_id: str,
+        session: dict,
+        index: int,
+        stream: AsyncIterator[bytes],
+        checksum: Optional[str] = None,
+    ) -> None:
+        """
+        Stream a chunk into its place in the upload
+
+        Parameters:
+            upload_id (str): The upload
+            session (dict): The upload's session, from session
+            index (int): The index of the chunk
+            stream (AsyncIterator[bytes]): The chunk's bytes, eg: request.stream()
+            checksum (Optional[str]): The sha256 the chunk should have
+
+        Raises:
+            InvalidChunk: If the chunk is out of range, the wrong size or doesn't match the checksum
+            UploadNotFound: If the upload is being finalized
+        """
+
+        if not 0 <= index < session["chunks"]:
+            raise InvalidChunk(f"chunk must be between 0 and {session['chunks'] - 1}")
+
+        # counted as in flight until it is done, finalize waits for every chunk being written
+        start_write = self.redis.register_script(START_WRITE)
+        if not await start_write(keys=[session_key(upload_id)]):
+            raise UploadNotFound(upload_id)
+
+        try:
+            await self._write_chunk(upload_id, session, index, stream, checksum)
+        finally:
+            end_write = self.redis.register_script(END_WRITE)
+            await end_write(keys=[session_key(upload_id)])
+
+    async def _write_chunk(
+        self,
+        upload_id: str,
+        session: dict,
+        index: int,
+        stream: AsyncIterator[bytes],
+        checksum: Optional[str],
+    ) -> None:
+        offset = index * session["chunk_size"]
+        expected = min(session["chunk_size"], session["size"] - offset)
+
+        chunk_hasher = hashlib.sha256()
+        hashers = [chunk_hasher]
+        # the chunk carries on the running hash of the whole file if it is the next one
+        running = None
+        if index == 0 and len(self.running) < MAX_RUNNING_HASHES:
+            running = hashlib.sha256()
+        elif self.running.get(upload_id, (None, -1, 0))[1] == index:
+            running = self.running.pop(upload_id)[0]
+        if running is not None:
+            hashers.append(running)
+
+        try:
+            fd = await asyncio.to_thread(os.open, self.path(upload_id), os.O_WRONLY)
+        except FileNotFoundError as e:  # finalized or swept while the session was read
+            raise UploadNotFound(upload_id) from e
+
+        try:
+            await asyncio.to_thread(allocate, fd, offset, expected)
+
+            written = 0
+            buffer = bytearray()
+            async for piece in stream:
+                if written + len(buffer) + len(piece) > expected:
+                    raise InvalidChunk(f"chunk {index} must be {expected} bytes")
+
+                buffer += piece
+                if len(buffer) >= WRITE_SIZE:
+                    data = bytes(buffer)
+                    buffer.clear()
+                    await asyncio.to_thread(
+                        write_at, fd, data, offset + written, hashers
+                    )
+                    written += len(data)
+
+            if buffer:
+                await asyncio.to_thread(
+                    write_at, fd, bytes(buffer), offset + written, hashers
+                )
+                written += len(buffer)
+        finally:
+            await asyncio.to_thread(os.close, fd)
+
+        if written != expected:
+            raise InvalidChunk(f"chunk {index} must be {expected} bytes, got {written}")
+        if checksum is not None and chunk_hasher.hexdigest() != checksum.lower():
+            raise InvalidChunk(f"chunk {index} doesn't match its checksum")
+
+        if running is not None:
+            self.running[upload_id] = (running, index + 1, time.monotonic())
+
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.sadd(received_key(upload_id), index)
+            pipe.expire(received_key(upload_id), self.ttl)
+            pipe.expire(session_key(upload_id), self.ttl)
+            added, _, _ = await pipe.execute()
+
+        # a chunk sent again may have changed bytes the running hash already covers
+        if not added:
+            self.running.pop(upload_id, None)
+            await self.redis.hset(session_key(upload_id), "rehash", 1)
+
+    async def finalize(self, upload_id: str, session: dict) -> str:
+        """
+        Finish an upload and move it into the blob store
+
+        Returns:
+            str: The sha256 digest the attachment is stored under
+
+        Raises:
+            UploadIncomplete: If chunks are missing or still being written
+            UploadNotFound: If the upload is already being finalized
+            InvalidChunk: If the file doesn't match the sha256 given when the upload was created
+        """
+
+        missing = await self.missing(upload_id, session)
+        if missing:
+            raise UploadIncomplete(missing)
+
+        # only one request gets to finalize, and only once no chunk is being written
+        claim = self.redis.register_script(CLAIM_FINALIZE)
+        claimed = await claim(keys=[session_key(upload_id)])
+        if claimed == -1:
+            # every chunk has arrived once but one is being sent again
+            raise UploadIncomplete([])
+        if not claimed:
+            raise UploadNotFound(upload_id)
+
+        path = self.path(upload_id)
+        hasher, next_index, _ = self.running.pop(upload_id, (None, -1, 0))
+        rehash = await self.redis.hexists(session_key(upload_id), "rehash")
+        if hasher is not None and next_index == session["chunks"] and not rehash:
+            digest = hasher.hexdigest()
+        else:
+            self.rehashed += 1
+            digest = await asyncio.to_thread(hash_file, path)
+
+        try:
+            if "sha256" in session and session["sha256"].lower() != digest:
+                await asyncio.to_thread(os.remove, path)
+                raise InvalidChunk(
+                    "the upload doesn't match the sha256 it was created with"
+                )
+
+            await asyncio.to_thread(blob_store.adopt, path, digest)
+        finally:
+            await self.redis.delete(session_key(upload_id), received_key(upload_id))
+
+        return digest
+
+    def stats(self) -> dict:
+        return {"running_hashes": len(self.running), "rehashed": self.rehashed}
+
+    def _remove_abandoned(self) -> int:
+        cutoff = time.time() - self.ttl
+        removed = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if entry.name.endswith(".part") and entry.stat().st_mtime < cutoff:
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+    async def _sweep(self) -> None:
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL)
+            # the session expired with the ttl, nobody can finish these uploads now
+            removed = await asyncio.to_thread(self._remove_abandoned)
+            if removed:
+                logger.info("Removed %d abandoned uploads", removed)
+
+            # and their running hashes
+            cutoff = time.monotonic() - self.ttl
+            for upload_id, (_, _, touched) in list(self.running.items()):
+                if touched < cutoff:
+                    del self.running[upload_id]
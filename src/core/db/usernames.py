@@ -0,0 +1,238 @@
+""" (module) usernames
+User discovery by username prefix and the availability filter used by signup
+
+Search is a keyset paginated range scan over the users_username_search_idx index
+(lower(username) in the C collation, then id), so every page costs the same however deep it is.
+
+The availability filter is a bloom filter of every username and email in use, built when the
+worker starts and kept up to date over redis pubsub. Signup checks it before hashing the password:
+"definitely free" skips the database entirely, "maybe taken" is confirmed with an indexed lookup.
+The unique constraints are still what guarantees uniqueness, the filter only saves work
+"""
+
+__all__ = ["AvailabilityIndex", "search_users", "parse_cursor", "SEARCH_PREFIX"]
+
+import re
+import json
+import asyncio
+import logging
+from typing import Final, Optional
+
+import aioredis.exceptions
+from aioredis import Redis
+from tortoise import connections
+
+from core.helpers import BloomFilter
+from .routing import ReadReplicaRouter
+
+TAKEN_CHANNEL: Final = "usernames:taken"
+LOAD_BATCH_SIZE: Final = 10000
+# the same characters usernames are allowed to have, so a prefix can't contain LIKE wildcards other than _
+SEARCH_PREFIX: Final = re.compile(r"^[a-zA-Z0-9._]{1,32}$")
+MAX_USER_ID: Final = 2**63 - 1  # users.id is a BIGINT
+
+logger = logging.getLogger(__name__)
+
+
+def escape_like(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def parse_cursor(cursor: str) -> tuple[str, int]:
+    """
+    Split a search cursor, eg: "alice:123" into the username and id to continue after
+
+    Raises:
+        ValueError: If the cursor is malformed or the id doesn't fit in a BIGINT
+    """
+
+    username, _, user_id = cursor.rpartition(":")
+    after_id = int(user_id)
+    if not 0 <= after_id <= MAX_USER_ID:
+        raise ValueError(f"{after_id} is not a valid user id")
+    return username, after_id
+
+
+async def search_users(
+    prefix: str, limit: int, after: Optional[tuple[str, int]] = None
+) -> tuple[list[dict], Optional[str]]:
+    """
+    Find verified users whose username starts with a prefix, ignoring case
+
+    Parameters:
+        prefix (str): The start of the username, checked against SEARCH_PREFIX by the caller
+        limit (int): Users per page
+        after (Optional[tuple[str, int]]): The cursor of the previous page, from parse_cursor
+
+    Returns:
+        tuple[list[dict], Optional[str]]: The users (id, username, display_name, avatar)
+            and the cursor of the next page, None on the last page
+    """
+
+    prefix = prefix.lower()
+    after_username, after_id = after if after is not None else ("", 0)
+
+    conn = connections.get(ReadReplicaRouter().db_for_read(None))
+    rows = await conn.execute_query_dict(
+        'SELECT "id", "username", "display_name", "avatar" FROM "users" '
+        'WHERE "verified" AND "deleted_at" IS NULL '
+        'AND lower("username") COLLATE "C" LIKE $1 '
+        'AND (lower("username") COLLATE "C", "id") > ($2, $3) '
+        'ORDER BY lower("username") COLLATE "C", "id" LIMIT $4',
+        [escape_like(prefix) + "%", after_username, after_id, limit + 1],
+    )
+
+    # one extra row is fetched to know if there is another page
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['username'].lower()}:{rows[-1]['id']}"
+
+    users = []
+    for row in rows:
+        avatar = row["avatar"]
+        users.append(
+            {
+                "id": str(row["id"]),
+                "username": row["username"],
+                "display_name": row["display_name"],
+                "avatar": json.loads(avatar) if isinstance(avatar, str) else avatar,
+            }
+        )
+
+    return users, next_cursor
+
+
+class AvailabilityIndex:
+    """
+    Parameters:
+        redis (Redis): The redis connection new names are announced on
+        capacity (int): The least names the filter is sized for,
+            it is sized for twice the current number of users when that is bigger
+        error_rate (float): How often a free name is reported as maybe taken
+
+    Attributes:
+        filter (Optional[BloomFilter]): None until it has loaded (or after losing the subscription),
+            everything is reported as maybe taken until then
+        checks (dict[str, int]): Checks answered as free and as maybe taken
+    """
+
+    def __init__(
+        self, redis: Redis, capacity: int = 1_000_000, error_rate: float = 0.01
+    ) -> None:
+        self.redis = redis
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        self.filter: Optional[BloomFilter] = None
+        self.loading: Optional[BloomFilter] = None
+        self.checks = {"free": 0, "maybe_taken": 0}
+        self.listener: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self.listener = asyncio.create_task(self._listen())
+
+    async def close(self) -> None:
+        if self.listener is not None:
+            self.listener.cancel()
+
+    def maybe_taken(self, field: str, value: str) -> bool:
+        """
+        Check if a username or email might already be in use
+
+        Parameters:
+            field (str): username or email
+            value (str): The username or email
+
+        Returns:
+            bool: False if it is definitely free, True if the database has to be asked
+        """
+
+        if self.filter is None or f"{field}:{value}" in self.filter:
+            self.checks["maybe_taken"] += 1
+            return True
+
+        self.checks["free"] += 1
+        return False
+
+    async def add(self, username: str, email: str) -> None:
+        """
+        Announce a new user's username and email to every worker, call once the user is committed
+        """
+
+        await self.redis.publish(TAKEN_CHANNEL, json.dumps([username, email]))
+
+    def stats(self) -> dict:
+        return {
+            "ready": self.filter is not None,
+            "filter": self.filter.stats() if self.filter is not None else None,
+            "checks": self.checks,
+        }
+
+    def _remember(self, username: str, email: str) -> None:
+        for bloom in (self.filter, self.loading):
+            if bloom is not None:
+                bloom.add(f"username:{username}")
+                bloom.add(f"email:{email}")
+
+    async def _load(self) -> None:
+        conn = connections.get("default")
+        rows = await conn.execute_query_dict(
+            "SELECT reltuples::BIGINT AS \"estimate\" FROM pg_class WHERE relname = 'users'"
+        )
+        estimate = max(rows[0]["estimate"], 0) if rows else 0
+
+        # names announced while this runs are added to it too, see _remember
+        # a username and an email per user, with room for the users to double
+        bloom = BloomFilter(max(self.capacity, estimate * 4), self.error_rate)
+        self.loading = bloom
+
+        last_id = 0
+        while True:
+            rows = await conn.execute_query_dict(
+                'SELECT "id", "username", "email" FROM "users" '
+                'WHERE "id" > $1 ORDER BY "id" LIMIT $2',
+                [last_id, LOAD_BATCH_SIZE],
+            )
+            for row in rows:
+                bloom.add(f"username:{row['username']}")
+                bloom.add(f"email:{row['email']}")
+
+            if len(rows) < LOAD_BATCH_SIZE:
+                break
+            last_id = rows[-1]["id"]
+
+        self.filter, self.loading = bloom, None
+
+    async def _listen(self) -> None:
+        while True:
+            pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+            loader: Optional[asyncio.Task] = None
+            try:
+                # subscribed before loading so nothing signed up in between is missed
+                await pubsub.subscribe(TAKEN_CHANNEL)
+                loader = asyncio.create_task(self._load())
+
+                while True:
+                    message = await pubsub.get_message(timeout=1.0)
+                    failed = loader.done() and loader.exception() is not None
+                    if failed:
+                        logger.warning(
+                            "Loading the availability filter failed: %r",
+                            loader.exception(),
+                        )
+                        loader = asyncio.create_task(self._load())
+
+                    if message is not None:
+                        self._remember(*json.loads(message["data"]))
+            except aioredis.exceptions.ConnectionError:
+                logger.warning("Lost the availability subscription, reloading")
+            finally:
+                if loader is not None:
+                    loader.cancel()
+                await pubsub.close()
+
+            # names may have been missed while disconnected
+            self.filter = None
+            self.loading = None
+            await asyncio.sleep(1)
@@ -1,16 +1,76 @@
 import os
 from dotenv import load_dotenv
+from tortoise.backends.base.config_generator import expand_db_url
 
 load_dotenv()
 
+
+def pool_options() -> dict:
+    """
+    Reads the asyncpg pool settings from the environment
+
+    Returns:
+        dict: Extra credentials passed through tortoise to asyncpg.create_pool
+    """
+
+    return {
+        "minsize": int(os.environ.get("DB_POOL_MIN_SIZE", 2)),
+        "maxsize": int(os.environ.get("DB_POOL_MAX_SIZE", 10)),
+        "max_queries": int(os.environ.get("DB_POOL_MAX_QUERIES", 50000)),
+        "max_inactive_connection_lifetime": float(
+            os.environ.get("DB_POOL_MAX_INACTIVE_LIFETIME", 300)
+        ),
+        "statement_cache_size": int(os.environ.get("DB_STATEMENT_CACHE_SIZE", 1024)),
+        "timeout": float(os.environ.get("DB_CONNECT_TIMEOUT", 10)),
+        "command_timeout": float(os.environ.get("DB_COMMAND_TIMEOUT", 30)),
+    }
+
+
+def connection_config(db_url: str) -> dict:
+    """
+    Expands a database url into a tortoise connection with the pool settings applied
+
+    Parameters:
+        db_url (str): The postgres connection url
+
+    Returns:
+        dict: The tortoise connection config
+    """
+
+    config = expand_db_url(db_url)
+    config["credentials"].update(pool_options())
+    return config
+
+
+def replica_urls() -> list[str]:
+    """
+    Get the read replica urls. These are set as a comma seperated list in DATABASE_REPLICA_URLS
+
+    Returns:
+        list[str]: The connection urls for each replica
+    """
+
+    urls = os.environ.get("DATABASE_REPLICA_URLS", "")
+    return [url.strip() for url in urls.split(",") if url.strip()]
+
+
+REPLICA_CONNECTIONS = [f"replica_{i}" for i in range(len(replica_urls()))]
+
 TORTOISE_CONFIG = {
-    "connections": {"default": os.environ["DATABASE_URL"]},
+    "connections": {
+        "default": connection_config(os.environ["DATABASE_URL"]),
+        **{
+            name: connection_config(url)
+            for name, url in zip(REPLICA_CONNECTIONS, replica_urls())
+        },
+    },
     "apps": {
         "models": {
             "models": ["core.models.users"],
             "default_connection": "default",
         }
     },
+    "routers": ["core.db.routing.ReadReplicaRouter"] if REPLICA_CONNECTIONS else [],
     "use_tz": False,
     "timezone": "UTC",
 }
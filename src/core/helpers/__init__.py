@@ -7,19 +7,60 @@ __all__ = [
     "argon2_verify",
     "generate_id",
     "parse_id",
+    "id_from_datetime",
     "rate_limit_exceeded_handler",
     "user_is_banned",
+    "server_overloaded",
     "UCHTTPExceptions",
     "InvalidDevmodeValue",
+    "OutdatedDatabaseSchema",
+    "SingleFlight",
+    "user_flight",
+    "ban_flight",
+    "key_flight",
+    "AdmissionController",
+    "Priority",
+    "admission_options",
+    "client_ip",
+    "rate_limit_key",
+    "is_admin",
+    "require_admin",
+    "LoopMonitor",
+    "SamplingProfiler",
+    "loop_monitor_options",
+    "profile_dir",
+    "encode_key",
+    "decode_key",
+    "PUBLIC_KEY_LENGTHS",
+    "SIGNATURE_LENGTHS",
+    "BloomFilter",
 ]
 
 from .exceptions import (
     InvalidRedisPassword,
     InvalidRedisURL,
     InvalidDevmodeValue,
+    OutdatedDatabaseSchema,
     rate_limit_exceeded_handler,
     user_is_banned,
+    server_overloaded,
     UCHTTPExceptions,
 )
 from .hashing import argon2_hash, bcrypt_hash, bcrypt_verify, argon2_verify
-from .snowflake_id import generate_id, parse_id
+from .snowflake_id import generate_id, parse_id, id_from_datetime
+from .singleflight import SingleFlight, user_flight, ban_flight, key_flight
+from .admission import AdmissionController, Priority, admission_options
+from .clients import client_ip, rate_limit_key, is_admin, require_admin
+from .loop_health import (
+    LoopMonitor,
+    SamplingProfiler,
+    loop_monitor_options,
+    profile_dir,
+)
+from .key_encoding import (
+    encode_key,
+    decode_key,
+    PUBLIC_KEY_LENGTHS,
+    SIGNATURE_LENGTHS,
+)
+from .bloom import BloomFilter
@@ -0,0 +1,210 @@
+""" (module) admission
+Adaptive concurrency limit used to shed load before queues build up
+
+The limit follows the gradient between the long term and the recent request latency.
+While recent requests are about as fast as usual the limit keeps growing, once they slow
+down (requests are queueing somewhere: the event loop, the db pool, argon2 threads) it shrinks.
+Every request has a priority and lower priorities may only use part of the limit,
+so a flood of logins or signups is rejected while chat requests still have room.
+"""
+
+__all__ = [
+    "AdmissionController",
+    "Priority",
+    "admission_options",
+]
+
+import os
+import math
+import time
+from enum import IntEnum
+
+
+class Priority(IntEnum):
+    CRITICAL = 0  # the core chat endpoints
+    NORMAL = 1
+    LOW = 2  # expensive and retryable, eg: argon2 on login and signup
+
+
+# the share of the limit each priority can use
+PRIORITY_SHARE = {
+    Priority.CRITICAL: 1.0,
+    Priority.NORMAL: 0.8,
+    Priority.LOW: 0.5,
+}
+
+# seconds a client is told to wait before retrying, per priority
+RETRY_AFTER = {
+    Priority.CRITICAL: 1,
+    Priority.NORMAL: 2,
+    Priority.LOW: 5,
+}
+
+
+def admission_options() -> dict:
+    """
+    Reads the admission controller settings from the environment
+
+    Returns:
+        dict: Keyword arguments for AdmissionController
+    """
+
+    return {
+        "initial_limit": int(os.environ.get("ADMISSION_INITIAL_LIMIT", 64)),
+        "min_limit": int(os.environ.get("ADMISSION_MIN_LIMIT", 8)),
+        "max_limit": int(os.environ.get("ADMISSION_MAX_LIMIT", 512)),
+        "tolerance": float(os.environ.get("ADMISSION_LATENCY_TOLERANCE", 2.0)),
+    }
+
+
+class AdmissionController:
+    """
+    Parameters:
+        initial_limit (int): Requests allowed in flight at startup
+        min_limit (int): The limit never goes below this
+        max_limit (int): The limit never goes above this
+        tolerance (float): How many times slower than usual requests can get before the limit shrinks
+        smoothing (float): How much of each new limit estimate is applied at once
+        window (float): Seconds of requests averaged together before the limit is adjusted
+        min_window_samples (int): Requests a window needs before the limit is adjusted
+        long_window (int): Windows the long term latency is averaged over
+
+    Attributes:
+        limit (float): Requests currently allowed in flight
+        in_flight (int): Requests currently running
+        shed (dict[Priority, int]): Requests rejected per priority
+    """
+
+    def __init__(
+        self,
+        initial_limit: int = 64,
+        min_limit: int = 8,
+        max_limit: int = 512,
+        tolerance: float = 2.0,
+        smoothing: float = 0.2,
+        window: float = 0.5,
+        min_window_samples: int = 10,
+        long_window: int = 600,
+    ) -> None:
+        self.limit = float(initial_limit)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.tolerance = tolerance
+        self.smoothing = smoothing
+        self.window = window
+        self.min_window_samples = min_window_samples
+        self.long_window = long_window
+
+        self.in_flight = 0
+        self.long_latency = 0.0
+        self.short_latency = 0.0
+
+        self.window_start = time.perf_counter()
+        self.window_latency = 0.0
+        self.window_samples = 0
+        self.window_in_flight = 0
+
+        self.admitted = 0
+        self.shed = {priority: 0 for priority in Priority}
+
+    def try_acquire(self, priority: Priority) -> bool:
+        """
+        Admit a request if its priority still has room under the limit
+
+        Parameters:
+            priority (Priority): The priority of the request
+
+        Returns:
+            bool: If the request was admitted, if so release has to be called when it finishes
+        """
+
+        if self.in_flight >= max(self.limit * PRIORITY_SHARE[priority], 1):
+            self.shed[priority] += 1
+            return False
+
+        self.in_flight += 1
+        self.admitted += 1
+        return True
+
+    def release(self, started: float, measure: bool = True) -> None:
+        """
+        Mark an admitted request as finished and record how long it took
+
+        Parameters:
+            started (float): time.perf_counter() from when the request was admitted
+            measure (bool): If its latency should count towards adjusting the limit
+        """
+
+        now = time.perf_counter()
+        # sampled before decrementing so it counts the request itself
+        self.window_in_flight = max(self.window_in_flight, self.in_flight)
+        self.in_flight -= 1
+        if not measure:
+            return
+
+        self.window_latency += now - started
+        self.window_samples += 1
+
+        window_done = now - self.window_start >= self.window
+        if window_done and self.window_samples >= self.min_window_samples:
+            self.update(
+                self.window_latency / self.window_samples, self.window_in_flight
+            )
+
+            self.window_start = now
+            self.window_latency = 0.0
+            self.window_samples = 0
+            self.window_in_flight = 0
+
+    def update(self, latency: float, in_flight: int) -> None:
+        """
+        Adjust the limit after a window of requests
+
+        Parameters:
+            latency (float): The average latency over the window
+            in_flight (int): The most requests that were in flight during the window
+        """
+
+        self.short_latency = latency
+        if self.long_latency == 0:
+            self.long_latency = latency
+            return
+
+        if latency < self.long_latency or in_flight < self.limit / 2:
+            self.long_latency += (latency - self.long_latency) / self.long_window
+        else:
+            # busy, most of the extra latency is requests queueing. only let the baseline
+            # creep up slowly or it would follow the queue up and the limit would never shrink
+            self.long_latency += (latency - self.long_latency) / (self.long_window * 10)
+
+        # once things settle after a spike, let the baseline recover quicker
+        # or the limit stays low long after the overload is gone
+        if self.long_latency > latency * self.tolerance:
+            self.long_latency *= 0.95
+
+        gradient = max(0.5, min(1.0, self.tolerance * self.long_latency / latency))
+
+        # mostly idle, the latency says nothing about how much more we could handle
+        if gradient == 1.0 and in_flight < self.limit / 2:
+            return
+
+        estimate = self.limit * gradient + math.sqrt(self.limit)
+        limit = (1 - self.smoothing) * self.limit + self.smoothing * estimate
+        self.limit = max(self.min_limit, min(self.max_limit, limit))
+
+    def retry_after(self, priority: Priority) -> int:
+        return RETRY_AFTER[priority]
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 1),
+            "in_flight": self.in_flight,
+            "admitted": self.admitted,
+            "shed": {
+                priority.name.lower(): count for priority, count in self.shed.items()
+            },
+            "latency_ms": {
+                "long": round(self.long_latency * 1000, 2),
+                "short": round(self.short_latency * 1000, 2),
+            },
+        }
@@ -0,0 +1,34 @@
+""" (module) avatars
+Saving processed avatars in the blob store
+"""
+
+__all__ = ["AVATAR_FORMAT", "save_avatar", "avatar_url"]
+
+import os
+from typing import Final
+
+from .images import FORMATS
+from .blobstore import blob_store
+
+AVATAR_FORMAT: Final = os.environ.get("AVATAR_FORMAT", "WEBP").upper()
+
+
+def avatar_url(digest: str) -> str:
+    return f"/api/v1/avatars/{digest}.{FORMATS[AVATAR_FORMAT]}"
+
+
+async def save_avatar(outputs: dict[int, bytes]) -> dict[str, str]:
+    """
+    Store every size of an avatar
+
+    Parameters:
+        outputs (dict[int, bytes]): The encoded images keyed by size, from process_avatar
+
+    Returns:
+        dict[str, str]: The url of each size, keyed by size
+    """
+
+    return {
+        str(size): avatar_url(await blob_store.put(data))
+        for size, data in outputs.items()
+    }
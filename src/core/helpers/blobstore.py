@@ -0,0 +1,94 @@
+""" (module) blobstore
+Content addressed blob storage on the local filesystem
+
+Blobs are stored under their sha256 so the same bytes are only ever stored once,
+no matter how many users upload them. A blob never changes after it is written
+which is what lets it be served with strong etags and immutable caching.
+"""
+
+__all__ = ["BlobStore", "blob_store", "is_digest"]
+
+import os
+import re
+import asyncio
+import hashlib
+import tempfile
+from typing import Final
+from os.path import join, dirname, exists
+
+DIGEST: Final = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_digest(value: str) -> bool:
+    return DIGEST.match(value) is not None
+
+
+class BlobStore:
+    """
+    Parameters:
+        root (str): The directory blobs are stored in.
+            Blobs go in root/ab/cd/abcd... so no directory gets too big
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        return join(self.root, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return exists(self.path(digest))
+
+    def write(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.path(digest)
+        if exists(path):  # already stored, dedup
+            return digest
+
+        os.makedirs(dirname(path), exist_ok=True)
+        # write then rename so a reader never sees half a blob
+        fd, tmp_path = tempfile.mkstemp(dir=dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+        return digest
+
+    def adopt(self, tmp_path: str, digest: str) -> str:
+        """
+        Move an already written and hashed file into the store
+
+        Parameters:
+            tmp_path (str): The file, has to be on the same filesystem as the store
+            digest (str): The sha256 of the file
+
+        Returns:
+            str: The digest
+        """
+
+        path = self.path(digest)
+        if exists(path):
+            os.remove(tmp_path)
+            return digest
+
+        os.makedirs(dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        return digest
+
+    async def put(self, data: bytes) -> str:
+        """
+        Store a blob
+
+        Parameters:
+            data (bytes): The contents
+
+        Returns:
+            str: The sha256 hex digest the blob is stored under
+        """
+
+        return await asyncio.to_thread(self.write, data)
+
+
+blob_store = BlobStore(
+    os.environ.get("BLOB_DIR", join(dirname(__file__), "../../../data/blobs"))
+)
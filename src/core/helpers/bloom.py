@@ -0,0 +1,53 @@
+""" (module) bloom
+A bloom filter, answers "definitely not in the set" or "maybe in the set" in a few bytes per item
+"""
+
+__all__ = ["BloomFilter"]
+
+import math
+import hashlib
+
+
+class BloomFilter:
+    """
+    Parameters:
+        capacity (int): Items it is sized for, past this the false positive rate climbs
+        error_rate (float): The false positive rate at capacity
+
+    Attributes:
+        count (int): Items added
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01) -> None:
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(round(self.size / capacity * math.log(2)), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.capacity = capacity
+        self.count = 0
+
+    def _positions(self, item: str) -> list[int]:
+        # two halves of one digest combined into k positions (Kirsch-Mitzenmacher)
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little") | 1
+
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, item: str) -> None:
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    def stats(self) -> dict:
+        return {
+            "items": self.count,
+            "capacity": self.capacity,
+            "bytes": len(self.bits),
+        }
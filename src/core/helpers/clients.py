@@ -0,0 +1,102 @@
+""" (module) clients
+Works out who a request came from, for rate limiting and bans
+"""
+
+__all__ = ["client_ip", "rate_limit_key", "is_admin", "require_admin"]
+
+import os
+import hmac
+from typing import Optional
+
+from fastapi import Request
+from jose import jwt, JWTError
+
+from .exceptions import UCHTTPExceptions
+
+
+def client_ip(request: Request) -> Optional[str]:
+    """
+    Get the ip of the client that sent a request. Behind the proxy the peer is the proxy itself
+    so the first hop of X-Forwarded-For is used when the header is there
+
+    Parameters:
+        request (Request): The request
+
+    Returns:
+        Optional[str]: The client's ip, None if it is unknown
+    """
+
+    forwarded_for = request.headers.get("X-Forwarded-For")
+    if forwarded_for is not None:
+        first_hop = forwarded_for.split(",")[0].strip()
+        if first_hop:
+            return first_hop
+
+    return request.client.host if request.client else None
+
+
+def token_user_id(request: Request) -> Optional[int]:
+    authorization = request.headers.get("Authorization", "")
+    scheme, _, token = authorization.partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+
+    # only the signature and expiry are checked, whether the token was revoked doesn't
+    # matter here, it only decides whose bucket the request is counted against
+    try:
+        payload = jwt.decode(token, os.environ["JWT_SIGNING_KEY"], algorithms=["HS256"])
+    except JWTError:
+        return None
+
+    return payload.get("user_id")
+
+
+def rate_limit_key(request: Request) -> str:
+    """
+    The key a request is rate limited under. Signed in users get their own bucket
+    wherever they connect from, everyone else is limited per ip
+
+    Parameters:
+        request (Request): The request
+
+    Returns:
+        str: eg: user:123 or ip:1.2.3.4
+    """
+
+    user_id = token_user_id(request)
+    if user_id is not None:
+        return f"user:{user_id}"
+
+    return f"ip:{client_ip(request) or '127.0.0.1'}"
+
+
+def is_admin(request: Request) -> bool:
+    """
+    Check if a request has the admin token (ADMIN_TOKEN) in its X-Admin-Token header.
+    Admin only features are turned off when ADMIN_TOKEN isn't set
+
+    Parameters:
+        request (Request): The request
+
+    Returns:
+        bool: If the request came from an admin
+    """
+
+    admin_token = os.environ.get("ADMIN_TOKEN")
+    provided = request.headers.get("X-Admin-Token")
+    if not admin_token or provided is None:
+        return False
+
+    return hmac.compare_digest(provided.encode(), admin_token.encode())
+
+
+async def require_admin(request: Request) -> None:
+    """
+    Dependency for admin only routes
+
+    Raises:
+        NotAdmin: If the request doesn't have the admin token
+    """
+
+    if not is_admin(request):
+        raise UCHTTPExceptions.NOT_ADMIN()
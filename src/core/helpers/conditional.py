@@ -0,0 +1,116 @@
+""" (module) conditional
+ETags for polled read endpoints, so a client that already has the current version gets a 304
+before the database is touched
+
+Every cacheable thing (eg: a user's profile) has a version token in redis. A token is made up the
+first time it is asked for and writes "bump" it by deleting it, the next read then makes a new one.
+Tokens are random rather than counters, so a token that expired or was lost with redis can never
+come back and match a stale copy a client still has.
+
+Handlers read the version before reading the data, a write that lands in between only costs
+the client one more full response.
+"""
+
+__all__ = [
+    "current_version",
+    "bump_versions",
+    "make_etag",
+    "etag_matches",
+    "not_modified",
+    "etag_headers",
+]
+
+import secrets
+from typing import Final, Hashable, Iterable
+
+from aioredis import Redis
+from fastapi import Request, Response
+
+# seconds, an expired version only costs one full response
+VERSION_TTL: Final = 24 * 60 * 60
+CACHE_CONTROL: Final = "private, no-cache"  # always revalidate
+
+# KEYS: version
+# ARGV: new version, ttl
+GET_OR_CREATE = """
+local version = redis.call('GET', KEYS[1])
+if not version then
+    version = ARGV[1]
+    redis.call('SET', KEYS[1], version, 'EX', ARGV[2])
+end
+return version
+"""
+
+
+def version_key(kind: str, item_id: Hashable) -> str:
+    return f"version:{kind}:{item_id}"
+
+
+async def current_version(redis: Redis, kind: str, item_id: Hashable) -> str:
+    """
+    Get the version token of something, one round trip
+
+    Parameters:
+        redis (Redis): The redis connection
+        kind (str): What it is, eg: "user"
+        item_id (Hashable): Its id
+
+    Returns:
+        str: The version
+    """
+
+    script = redis.register_script(GET_OR_CREATE)
+    return await script(
+        keys=[version_key(kind, item_id)],
+        args=[secrets.token_hex(8), VERSION_TTL],
+    )
+
+
+async def bump_versions(redis: Redis, kind: str, item_ids: Iterable[Hashable]) -> None:
+    """
+    Call after changing things, once the change is committed
+
+    Parameters:
+        redis (Redis): The redis connection
+        kind (str): What they are, eg: "prekey"
+        item_ids (Iterable[Hashable]): Their ids
+    """
+
+    keys = [version_key(kind, item_id) for item_id in item_ids]
+    if keys:
+        await redis.delete(*keys)
+
+
+def make_etag(kind: str, version: str) -> str:
+    return f'"{kind}-{version}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Check if the If-None-Match header of a request has an etag
+
+    Parameters:
+        request (Request): The request
+        etag (str): The current etag
+
+    Returns:
+        bool: If the client already has the current version
+    """
+
+    header = request.headers.get("If-None-Match")
+    if header is None:
+        return False
+
+    # If-None-Match compares weakly, W/"x" matches "x". * isn't a match, these are checked
+    # before the resource is looked up and a missing one has to get its 404
+    return any(
+        candidate.strip().removeprefix("W/") == etag for candidate in header.split(",")
+    )
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers=etag_headers(etag))
+
+
+def etag_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": CACHE_CONTROL}
@@ -71,6 +71,16 @@ class InvalidDevmodeValue(RichBaseException):
         sys.exit(1)
 
 
+class OutdatedDatabaseSchema(RichBaseException):
+    def __init__(self, current: int, required: int) -> None:
+        super().__init__(
+            "OUTDATED DATABASE SCHEMA!!!",
+            f"Database schema is at version {current} but version {required} is required. "
+            "Run 'make migrate' to apply the migrations",
+        )
+        sys.exit(1)
+
+
 class InvalidUsernameError(HTTPException):
     def __init__(self, username: str) -> None:
         status_code = 422
@@ -204,14 +214,27 @@ class InvalidSignedKey(HTTPException):
             "tip": "please use the correct format for signed pre key",
             "format": {
                 "key_id": "integer",
-                "public_key": "string",
-                "signature": "string",
+                "public_key": "base64 string",
+                "signature": "base64 string",
             },
         }
 
         super().__init__(status_code, detail)
 
 
+class InvalidIdentityKey(HTTPException):
+    def __init__(self, reason: str) -> None:
+        status_code = 422
+
+        detail = {
+            "success": False,
+            "detail": f"Identity key provided is not a valid public key, it {reason}",
+            "tip": "send the identity key as base64",
+        }
+
+        super().__init__(status_code, detail)
+
+
 class NoPermission(HTTPException):
     def __init__(self, perms_needed: list[str]) -> None:
         status_code = 401
@@ -304,6 +327,123 @@ class SnowflakeGenerationFailed(HTTPException):
         super().__init__(status_code, detail)
 
 
+class NotRoomMember(HTTPException):
+    def __init__(self, room_id: int) -> None:
+        status_code = 403
+
+        detail = {
+            "success": False,
+            "detail": "You are not a member of this room",
+            "provided": room_id,
+            "tip": "Join the room first or double check the room id",
+        }
+
+        super().__init__(status_code, detail)
+
+
+class NotRoomAdmin(HTTPException):
+    def __init__(self, room_id: int) -> None:
+        status_code = 403
+
+        detail = {
+            "success": False,
+            "detail": "Only the owner or admins of this room can do this",
+            "provided": room_id,
+            "tip": "Ask an admin of the room to do it for you",
+        }
+
+        super().__init__(status_code, detail)
+
+
+class InvalidAvatar(HTTPException):
+    def __init__(self) -> None:
+        status_code = 422
+
+        detail = {
+            "success": False,
+            "detail": "The uploaded file is not an image that can be used as an avatar",
+            "tip": "Upload a png, jpeg or webp image",
+        }
+
+        super().__init__(status_code, detail)
+
+
+class InvalidChunk(HTTPException):
+    def __init__(self, reason: str) -> None:
+        status_code = 422
+
+        detail = {
+            "success": False,
+            "detail": f"The chunk was rejected: {reason}",
+            "tip": "Send the chunk again, the rest of the upload is kept",
+        }
+
+        super().__init__(status_code, detail)
+
+
+class UploadIncomplete(HTTPException):
+    def __init__(self, missing: list[int]) -> None:
+        status_code = 409
+
+        detail = {
+            "success": False,
+            "detail": "The upload can't be finalized until every chunk has been uploaded",
+            "missing": missing,
+        }
+
+        super().__init__(status_code, detail)
+
+
+class InvalidCursor(HTTPException):
+    def __init__(self) -> None:
+        status_code = 400
+
+        detail = {
+            "success": False,
+            "detail": "The cursor provided is not valid",
+            "tip": "Pass the next_cursor from the previous page as it was given",
+        }
+
+        super().__init__(status_code, detail)
+
+
+class UploadTooLarge(HTTPException):
+    def __init__(self, max_bytes: int) -> None:
+        status_code = 413
+
+        detail = {
+            "success": False,
+            "detail": "The uploaded file is too large",
+            "max_bytes": max_bytes,
+            "tip": "Compress or resize the file before uploading it",
+        }
+
+        super().__init__(status_code, detail)
+
+
+class NotAdmin(HTTPException):
+    def __init__(self) -> None:
+        status_code = 403
+        detail = {
+            "success": False,
+            "detail": "This endpoint is only for admins",
+            "tip": "Send the admin token in the X-Admin-Token header",
+        }
+        super().__init__(status_code, detail)
+
+
+class LookupTimedOut(HTTPException):
+    def __init__(self, retry_after: int = 1) -> None:
+        status_code = 503
+        detail = {
+            "success": False,
+            "detail": "A lookup this request needs is taking too long, try again later",
+            "retry_after": retry_after,
+            "tip": "Wait for the number of seconds in the Retry-After header before retrying",
+        }
+        super().__init__(status_code, detail, headers={"Retry-After": str(retry_after)})
+
+
 class UCHTTPExceptions:
     INVALID_USERNAME_ERROR = InvalidUsernameError
     SIGNUP_CONFLICT_ERROR = SignupConflictError
@@ -313,6 +453,7 @@ class UCHTTPExceptions:
     EXPIRED_TOKEN_ERROR = ExpiredTokenError
     INVALID_TOKEN_ERROR = InvalidTokenError
     INVALID_SIGNED_KEY = InvalidSignedKey
+    INVALID_IDENTITY_KEY = InvalidIdentityKey
     NO_PERMISSION = NoPermission
     KEY_NOT_FOUND = KeyNotFound
     PRE_KEY_BUNDLE_FETCH_ERROR = PreKeyBundleFetchError
@@ -320,6 +461,15 @@ class UCHTTPExceptions:
     INVALID_SNOWFLAKE_TYPE = InvalidSnowflakeType
     SNOWFLAKE_GENERATION_FAILED = SnowflakeGenerationFailed
     INVALID_KEY_TYPE = InvalidKeyType
+    NOT_ROOM_MEMBER = NotRoomMember
+    NOT_ROOM_ADMIN = NotRoomAdmin
+    INVALID_AVATAR = InvalidAvatar
+    UPLOAD_TOO_LARGE = UploadTooLarge
+    INVALID_CURSOR = InvalidCursor
+    INVALID_CHUNK = InvalidChunk
+    UPLOAD_INCOMPLETE = UploadIncomplete
+    NOT_ADMIN = NotAdmin
+    LOOKUP_TIMED_OUT = LookupTimedOut
 
 
 async def user_is_banned(request: Request):
@@ -345,3 +495,16 @@ def rate_limit_exceeded_handler(request: Request, exc: RateLimitExceeded) -> Res
         response, request.state.view_rate_limit
     )
     return response
+
+
+def server_overloaded(retry_after: int) -> Response:
+    return JSONResponse(
+        {
+            "success": False,
+            "detail": "The server is overloaded, try again later",
+            "retry_after": retry_after,
+            "tip": "Wait for the number of seconds in the Retry-After header before retrying",
+        },
+        status_code=503,
+        headers={"Retry-After": str(retry_after)},
+    )
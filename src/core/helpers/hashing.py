@@ -4,6 +4,8 @@ functions for hashing text and passwords
 
 __all__ = ["argon2_hash", "bcrypt_hash", "bcrypt_verify", "argon2_verify"]
 
+import asyncio
+
 from argon2 import PasswordHasher
 from bcrypt import gensalt, hashpw, checkpw
 from argon2.exceptions import VerifyMismatchError, VerificationError, InvalidHash
@@ -21,7 +23,7 @@ async def argon2_hash(text: str) -> str:
     """
 
     password_hasher = PasswordHasher()
-    return password_hasher.hash(text)
+    return await asyncio.to_thread(password_hasher.hash, text)
 
 
 async def bcrypt_hash(text: str) -> str:
@@ -36,7 +38,8 @@ async def bcrypt_hash(text: str) -> str:
     """
 
     salt = gensalt(13)
-    return hashpw(text.encode(), salt).decode()
+    hashed = await asyncio.to_thread(hashpw, text.encode(), salt)
+    return hashed.decode()
 
 
 async def bcrypt_verify(password: str, hashed: str) -> bool:
@@ -51,7 +54,7 @@ async def bcrypt_verify(password: str, hashed: str) -> bool:
         bool: If the hash is verified it returns true
     """
 
-    return checkpw(password.encode(), hashed.encode())
+    return await asyncio.to_thread(checkpw, password.encode(), hashed.encode())
 
 
 async def argon2_verify(password: str, hashed: str) -> bool:
@@ -68,7 +71,7 @@ async def argon2_verify(password: str, hashed: str) -> bool:
 
     password_hasher = PasswordHasher()
     try:
-        password_hasher.verify(hashed, password)
+        await asyncio.to_thread(password_hasher.verify, hashed, password)
     except (VerifyMismatchError, VerificationError, InvalidHash):
         return False
 
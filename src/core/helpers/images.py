@@ -0,0 +1,147 @@
+""" (module) images
+Avatar processing. Images are decoded once, cropped to a square and encoded at every size
+in a worker process so the event loop never runs any image code.
+Everything happens in memory buffers, nothing touches the disk.
+
+This module doesn't import anything from core so the benchmark can load it on its own
+"""
+
+__all__ = ["InvalidImage", "process_avatar", "process_avatar_async", "encode_under"]
+
+import os
+import asyncio
+from io import BytesIO
+from typing import Final, Optional
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+AVATAR_SIZE: Final = 1000
+THUMBNAIL_SIZES: Final = (256, 128, 64)
+MAX_AVATAR_BYTES: Final = 1_500_000
+MAX_ENCODES: Final = 7  # enough for a binary search over qualities 5-95
+THUMBNAIL_QUALITY: Final = 80
+MIN_QUALITY: Final = 5
+MAX_QUALITY: Final = 95
+FORMATS: Final = {"WEBP": "webp", "JPEG": "jpeg"}
+
+# decompression bomb guard, the upload size limit alone doesn't stop a tiny png with huge dimensions
+Image.MAX_IMAGE_PIXELS = 64_000_000
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+class InvalidImage(Exception):
+    """Raised when the uploaded bytes can't be decoded as an image"""
+
+    pass
+
+
+def encode(image: Image.Image, image_format: str, quality: int) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, image_format, quality=quality, optimize=image_format == "JPEG")
+    return buffer.getvalue()
+
+
+def encode_under(
+    image: Image.Image,
+    image_format: str,
+    max_bytes: int = MAX_AVATAR_BYTES,
+    max_encodes: int = MAX_ENCODES,
+) -> bytes:
+    """
+    Encode an image at the highest quality that fits in max_bytes.
+    Tries the max quality first (most avatars fit straight away) and binary searches the quality otherwise
+
+    Parameters:
+        image (Image.Image): The image to encode
+        image_format (str): WEBP or JPEG
+        max_bytes (int): The size the output has to be under
+        max_encodes (int): Upper bound on the number of encodes
+
+    Returns:
+        bytes: The encoded image, at MIN_QUALITY if nothing fit within the encode budget
+    """
+
+    data = encode(image, image_format, MAX_QUALITY)
+    if len(data) <= max_bytes:
+        return data
+
+    best = None
+    low, high = MIN_QUALITY, MAX_QUALITY - 1
+    for _ in range(max_encodes - 1):
+        if low > high:
+            break
+
+        quality = (low + high) // 2
+        data = encode(image, image_format, quality)
+        if len(data) <= max_bytes:
+            best, low = data, quality + 1
+        else:
+            high = quality - 1
+
+    return best if best is not None else encode(image, image_format, MIN_QUALITY)
+
+
+def process_avatar(data: bytes, image_format: str = "WEBP") -> dict[int, bytes]:
+    """
+    Turn an uploaded image into a square avatar plus thumbnails. Runs in a worker process
+
+    Parameters:
+        data (bytes): The uploaded image
+        image_format (str): WEBP or JPEG
+
+    Returns:
+        dict[int, bytes]: The encoded image for every size, keyed by size in pixels
+
+    Raises:
+        InvalidImage: If the data is not an image Pillow can decode
+    """
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            # lets the jpeg decoder downscale while decoding instead of decoding full size
+            image.draft("RGB", (AVATAR_SIZE, AVATAR_SIZE))
+            image = ImageOps.exif_transpose(image).convert("RGB")
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
+        raise InvalidImage from e
+
+    avatar = ImageOps.fit(image, (AVATAR_SIZE, AVATAR_SIZE), Image.LANCZOS)
+    outputs = {AVATAR_SIZE: encode_under(avatar, image_format)}
+
+    # thumbnails come from the already decoded avatar, largest first so each resize is small
+    thumbnail = avatar
+    for size in sorted(THUMBNAIL_SIZES, reverse=True):
+        thumbnail = thumbnail.resize((size, size), Image.LANCZOS)
+        outputs[size] = encode(thumbnail, image_format, THUMBNAIL_QUALITY)
+
+    return outputs
+
+
+def get_executor() -> ProcessPoolExecutor:
+    global _executor
+
+    if _executor is None:
+        workers = int(os.environ.get("AVATAR_PROCESS_WORKERS", 2))
+        _executor = ProcessPoolExecutor(max_workers=workers)
+    return _executor
+
+
+async def process_avatar_async(
+    data: bytes, image_format: str = "WEBP"
+) -> dict[int, bytes]:
+    """
+    Same as process_avatar but runs in the process pool
+
+    Parameters:
+        data (bytes): The uploaded image
+        image_format (str): WEBP or JPEG
+
+    Returns:
+        dict[int, bytes]: The encoded image for every size, keyed by size in pixels
+    """
+
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        get_executor(), process_avatar, data, image_format
+    )
@@ -0,0 +1,51 @@
+""" (module) key_encoding
+Public keys and signatures are stored as raw bytes (bytea) and sent as base64 in the api.
+These convert between the two at the api boundary
+"""
+
+__all__ = [
+    "encode_key",
+    "decode_key",
+    "PUBLIC_KEY_LENGTHS",
+    "SIGNATURE_LENGTHS",
+]
+
+import base64
+import binascii
+from typing import Final
+
+# curve25519 keys, with or without the leading key type byte
+PUBLIC_KEY_LENGTHS: Final = (32, 33)
+# xeddsa / ed25519 signatures
+SIGNATURE_LENGTHS: Final = (64,)
+
+
+def encode_key(raw: bytes) -> str:
+    return base64.b64encode(raw).decode()
+
+
+def decode_key(text: str, lengths: tuple[int, ...]) -> bytes:
+    """
+    Decode a base64 key or signature and check its length
+
+    Parameters:
+        text (str): The base64 text
+        lengths (tuple[int, ...]): The allowed lengths in bytes, eg: PUBLIC_KEY_LENGTHS
+
+    Returns:
+        bytes: The raw key
+
+    Raises:
+        ValueError: If it isn't valid base64 or has the wrong length
+    """
+
+    try:
+        raw = base64.b64decode(text, validate=True)
+    except binascii.Error as e:
+        raise ValueError("must be base64") from e
+
+    if len(raw) not in lengths:
+        allowed = " or ".join(str(length) for length in lengths)
+        raise ValueError(f"must be {allowed} bytes, got {len(raw)}")
+
+    return raw
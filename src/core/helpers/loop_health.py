@@ -0,0 +1,231 @@
+""" (module) loop_health
+Finds the code that blocks the event loop
+
+LoopMonitor measures how late the loop wakes up from a short sleep (the lag every
+request sees on top of its own work). A watchdog thread notices when the loop has
+stopped ticking for longer than a threshold and records the stack of whatever is
+running on it, which is the blocking call.
+
+SamplingProfiler samples the loop thread's stack while a request runs
+and writes it as folded stacks, the input format of flamegraph.pl and speedscope.
+"""
+
+__all__ = ["LoopMonitor", "SamplingProfiler", "loop_monitor_options", "profile_dir"]
+
+import os
+import sys
+import time
+import asyncio
+import logging
+import threading
+from types import FrameType
+from collections import Counter, deque
+from os.path import basename, join, dirname
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def loop_monitor_options() -> dict:
+    """
+    Reads the loop monitor settings from the environment
+
+    Returns:
+        dict: Keyword arguments for LoopMonitor
+    """
+
+    return {
+        "interval": float(os.environ.get("LOOP_MONITOR_INTERVAL", 0.1)),
+        "threshold": float(os.environ.get("LOOP_SLOW_CALLBACK_THRESHOLD", 0.1)),
+    }
+
+
+def profile_dir() -> str:
+    return os.environ.get(
+        "PROFILE_DIR", join(dirname(__file__), "../../../data/profiles")
+    )
+
+
+def fold_stack(frame: Optional[FrameType]) -> str:
+    """
+    Turn a frame into a folded stack, outermost call first, eg: run;handle;argon2_verify
+
+    Parameters:
+        frame (Optional[FrameType]): The innermost frame
+
+    Returns:
+        str: The frames joined with ;
+    """
+
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class LoopMonitor:
+    """
+    Parameters:
+        interval (float): Seconds between lag measurements
+        threshold (float): Seconds the loop can be blocked for before the stack is recorded
+        history (int): Lag measurements the percentiles are worked out from
+
+    Attributes:
+        slow_callbacks (deque[dict]): The most recent stalls, with how long they took and the stack
+    """
+
+    def __init__(
+        self, interval: float = 0.1, threshold: float = 0.1, history: int = 600
+    ) -> None:
+        self.interval = interval
+        self.threshold = threshold
+
+        self.lags: deque[float] = deque(maxlen=history)
+        self.max_lag = 0.0
+        self.slow_callbacks: deque[dict] = deque(maxlen=50)
+        self.slow_callback_count = 0
+
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.reported_heartbeat: Optional[float] = None
+
+        self.task: Optional[asyncio.Task] = None
+        self.stopped = threading.Event()
+
+    async def start(self) -> None:
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.stopped.clear()
+
+        self.task = asyncio.create_task(self.measure())
+        threading.Thread(
+            target=self.watchdog, name="loop-watchdog", daemon=True
+        ).start()
+
+    async def close(self) -> None:
+        self.stopped.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def measure(self) -> None:
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(time.perf_counter() - started - self.interval, 0.0)
+
+            self.lags.append(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            # the watchdog caught this stall while it was happening, now we know how long it was
+            if self.reported_heartbeat == self.heartbeat and self.slow_callbacks:
+                self.slow_callbacks[-1]["blocked_ms"] = round(lag * 1000, 2)
+
+            self.heartbeat = time.monotonic()
+
+    def watchdog(self) -> None:
+        while not self.stopped.wait(self.threshold / 2):
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            if blocked < self.threshold or self.reported_heartbeat == heartbeat:
+                continue
+
+            # one report per stall, the loop's stack right now is what is blocking it
+            self.reported_heartbeat = heartbeat
+            frame = sys._current_frames().get(self.loop_thread_id)
+            stack = fold_stack(frame)
+
+            self.slow_callback_count += 1
+            self.slow_callbacks.append(
+                {
+                    "at": time.time(),
+                    "blocked_ms": round(blocked * 1000, 2),
+                    "stack": stack,
+                }
+            )
+            logger.warning(
+                "Event loop blocked for over %.0fms in %s",
+                blocked * 1000,
+                stack.rsplit(";", 1)[-1],
+            )
+
+    def stats(self) -> dict:
+        lags = sorted(self.lags) or [0.0]
+        return {
+            "lag_ms": {
+                "current": round((self.lags[-1] if self.lags else 0.0) * 1000, 2),
+                "p50": round(lags[len(lags) // 2] * 1000, 2),
+                "p99": round(lags[int(len(lags) * 0.99)] * 1000, 2),
+                "max": round(self.max_lag * 1000, 2),
+            },
+            "slow_callbacks": self.slow_callback_count,
+            "recent_slow_callbacks": list(self.slow_callbacks)[-5:],
+        }
+
+
+class SamplingProfiler:
+    """
+    Samples the stack of the loop thread while requests are being profiled.
+    Everything running on the loop is sampled, so other requests handled at the same time
+    show up in a profile too. Profile on a quiet worker for a clean picture
+
+    Parameters:
+        interval (float): Seconds between samples
+    """
+
+    def __init__(self, interval: float = 0.005) -> None:
+        self.interval = interval
+        self.active: dict[int, Counter] = {}
+        self.lock = threading.Lock()
+        self.thread: Optional[threading.Thread] = None
+        self.loop_thread_id: Optional[int] = None
+
+    def begin(self, profile_id: int) -> None:
+        """
+        Start collecting samples for a request, must be called from the loop thread
+
+        Parameters:
+            profile_id (int): Identifies the profile, eg: the request id
+        """
+
+        with self.lock:
+            self.loop_thread_id = threading.get_ident()
+            self.active[profile_id] = Counter()
+
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self.sample, name="request-profiler", daemon=True
+                )
+                self.thread.start()
+
+    def end(self, profile_id: int) -> str:
+        """
+        Stop collecting samples for a request
+
+        Parameters:
+            profile_id (int): The id passed to begin
+
+        Returns:
+            str: The samples as folded stacks, one "stack count" per line
+        """
+
+        with self.lock:
+            samples = self.active.pop(profile_id)
+
+        return "".join(f"{stack} {count}\n" for stack, count in samples.items())
+
+    def sample(self) -> None:
+        while True:
+            time.sleep(self.interval)
+
+            with self.lock:
+                if not self.active:
+                    # nothing being profiled, let the thread exit until the next begin
+                    self.thread = None
+                    return
+
+                stack = fold_stack(sys._current_frames().get(self.loop_thread_id))
+                for samples in self.active.values():
+                    samples[stack] += 1
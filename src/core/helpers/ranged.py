@@ -0,0 +1,128 @@
+""" (module) ranged
+Serving part of a file for Range requests, so big downloads can be resumed
+"""
+
+__all__ = ["RangedFileResponse", "parse_range"]
+
+import os
+import asyncio
+from typing import Final, Optional
+
+from starlette.types import Receive, Scope, Send
+from starlette.responses import Response
+
+READ_SIZE: Final = 256 * 1024
+
+
+def parse_range(header: Optional[str], size: int) -> Optional[tuple[int, int]]:
+    """
+    Parse a single range Range header, eg: bytes=0-1023, bytes=1024- or bytes=-500
+
+    Parameters:
+        header (Optional[str]): The Range header
+        size (int): The size of the file
+
+    Returns:
+        Optional[tuple[int, int]]: The first and last byte (inclusive), None to send the whole file
+
+    Raises:
+        ValueError: If the range can't be satisfied
+    """
+
+    if header is None or not header.startswith("bytes="):
+        return None
+
+    spec = header.removeprefix("bytes=").strip()
+    # clients resuming a download only ever ask for one range, anything else gets the whole file
+    if "," in spec:
+        return None
+
+    first, _, last = spec.partition("-")
+    try:
+        if not first:  # the last n bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+
+    if start > end or start >= size:
+        raise ValueError(f"bytes */{size}")
+
+    return start, end
+
+
+class RangedFileResponse(Response):
+    """
+    Sends a file, or one range of it. The body is sent with the zerocopysend asgi extension
+    (sendfile) when the server supports it, otherwise it is read in pieces off the event loop
+
+    Parameters:
+        path (str): The file
+        size (int): The size of the file
+        byte_range (Optional[tuple[int, int]]): The first and last byte to send, from parse_range
+        media_type (str): The content type
+        headers (Optional[dict]): Extra headers
+    """
+
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        byte_range: Optional[tuple[int, int]] = None,
+        media_type: str = "application/octet-stream",
+        headers: Optional[dict] = None,
+    ) -> None:
+        super().__init__(status_code=200, headers=headers, media_type=media_type)
+        self.path = path
+        self.start, self.end = byte_range if byte_range is not None else (0, size - 1)
+
+        self.headers["accept-ranges"] = "bytes"
+        self.headers["content-length"] = str(max(self.end - self.start + 1, 0))
+        if byte_range is not None:
+            self.status_code = 206
+            self.headers["content-range"] = f"bytes {self.start}-{self.end}/{size}"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+
+        count = self.end - self.start + 1
+        if scope["method"] == "HEAD" or count <= 0:
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            if "http.response.zerocopysend" in scope.get("extensions", {}):
+                await send(
+                    {
+                        "type": "http.response.zerocopysend",
+                        "file": fd,
+                        "offset": self.start,
+                        "count": count,
+                    }
+                )
+                return
+
+            position, end = self.start, self.end + 1
+            while position < end:
+                size = min(READ_SIZE, end - position)
+                data = await asyncio.to_thread(os.pread, fd, size, position)
+                position += len(data)
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": data,
+                        "more_body": position < end and bool(data),
+                    }
+                )
+                if not data:  # the file is shorter than it was
+                    break
+        finally:
+            os.close(fd)
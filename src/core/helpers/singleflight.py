@@ -0,0 +1,85 @@
+""" (module) singleflight
+Coalesces concurrent identical lookups into one
+
+When a burst of requests miss a cache for the same key only the first one runs the load,
+everyone else awaits the same future and gets the same result (or exception).
+A caller that waits longer than the timeout gets a 503 instead of hanging on a slow load.
+"""
+
+__all__ = ["SingleFlight", "user_flight", "ban_flight", "key_flight"]
+
+import asyncio
+from typing import Any, Awaitable, Callable, Hashable, Optional
+
+from .exceptions import UCHTTPExceptions
+
+
+class SingleFlight:
+    """
+    Parameters:
+        name (str): Name used when reporting stats
+        timeout (Optional[float]): Seconds a caller waits for the shared call before giving up.
+            A timeout only cancels the wait, the shared call keeps running for the other callers
+
+    Attributes:
+        calls (int): Loads actually run
+        coalesced (int): Callers that shared a load another caller started
+    """
+
+    def __init__(self, name: str, timeout: Optional[float] = 5.0) -> None:
+        self.name = name
+        self.timeout = timeout
+        self.in_flight: dict[Hashable, asyncio.Future] = {}
+
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run load, or wait for the load already running for this key
+
+        Parameters:
+            key (Hashable): Identifies the lookup, eg: the user id
+            load (Callable[[], Awaitable[Any]]): Does the lookup
+
+        Returns:
+            Any: The result of the load
+
+        Raises:
+            LookupTimedOut: If the load takes longer than the timeout (a 503 with Retry-After)
+            Exception: Whatever the load raised
+        """
+
+        future = self.in_flight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            future = asyncio.ensure_future(self._run(key, load))
+            # mark the exception as retrieved in case every caller timed out
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.in_flight[key] = future
+
+        # shield so one caller timing out or being cancelled doesn't cancel it for the rest
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError as e:
+            raise UCHTTPExceptions.LOOKUP_TIMED_OUT() from e
+
+    async def _run(self, key: Hashable, load: Callable[[], Awaitable[Any]]) -> Any:
+        try:
+            return await load()
+        finally:
+            del self.in_flight[key]
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self.in_flight),
+        }
+
+
+user_flight = SingleFlight("users")
+ban_flight = SingleFlight("bans")
+key_flight = SingleFlight("keys")
@@ -1,6 +1,7 @@
-__all__ = ("generate_id", "parse_id")
+__all__ = ("generate_id", "parse_id", "id_from_datetime")
 
 from typing import Literal
+from datetime import datetime, timezone
 
 from snowflake import Snowflake, SnowflakeGenerator
 
@@ -76,3 +77,21 @@ def parse_id(id_to_parse: int):
     Parse an ID and return the useful stuff
     """
     return SnowflakeID.parse(id_to_parse, EPOCH)
+
+
+def id_from_datetime(when: datetime) -> int:
+    """
+    Get the smallest snowflake that could have been generated at a point in time.
+    Useful as a range bound since snowflakes are ordered by the time they were generated
+
+    Parameters:
+        when (datetime): The time, naive datetimes are treated as UTC
+
+    Returns:
+        int: The snowflake with that timestamp and everything else set to 0
+    """
+
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    # same arithmetic as SnowflakeGenerator, the timestamp is milliseconds since EPOCH
+    return max(int(when.timestamp() * 1000) - EPOCH, 0) << 22
@@ -0,0 +1,169 @@
+""" (module) token_families
+Refresh tokens are kept in redis as rotating token families
+
+Logging in starts a family. Every refresh swaps the family's current refresh token for a new one.
+Presenting a refresh token that isn't the current one means it was used before (stolen or replayed)
+so the whole family is revoked. Each rotation and login is a single script call, so a refresh costs
+one redis round trip and postgres isn't involved at all.
+"""
+
+__all__ = [
+    "start_family",
+    "rotate_family",
+    "revoke_user_families",
+    "FAMILY_ROTATED",
+    "FAMILY_NOT_FOUND",
+    "FAMILY_REUSED",
+]
+
+from typing import Final
+
+from aioredis import Redis
+
+FAMILY_ROTATED: Final = 1
+FAMILY_NOT_FOUND: Final = 0
+FAMILY_REUSED: Final = -1
+
+# KEYS: user's family set, new family, new access token
+# ARGV: user id, scopes, refresh token id, family id, refresh ttl, access ttl
+START_FAMILY = """
+for _, family in ipairs(redis.call('SMEMBERS', KEYS[1])) do
+    redis.call('DEL', 'refresh_family:' .. family)
+end
+redis.call('DEL', KEYS[1])
+redis.call('HSET', KEYS[2], 'user_id', ARGV[1], 'scopes', ARGV[2], 'current', ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+redis.call('SADD', KEYS[1], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('SET', KEYS[3], ARGV[1], 'EX', ARGV[6])
+return 1
+"""
+
+# KEYS: family, new access token, user's family set
+# ARGV: presented refresh token id, new refresh token id, refresh ttl, access ttl, user id, family id
+# the user's family set lives as long as the family does, so revoking can always find it
+ROTATE_FAMILY = """
+local current = redis.call('HGET', KEYS[1], 'current')
+if not current then
+    return 0
+end
+if current ~= ARGV[1] then
+    redis.call('DEL', KEYS[1])
+    redis.call('SREM', KEYS[3], ARGV[6])
+    return -1
+end
+redis.call('HSET', KEYS[1], 'current', ARGV[2])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[3])
+redis.call('SET', KEYS[2], ARGV[5], 'EX', ARGV[4])
+return 1
+"""
+
+
+def family_key(family_id: int) -> str:
+    return f"refresh_family:{family_id}"
+
+
+def user_families_key(user_id: int) -> str:
+    return f"refresh_families:{user_id}"
+
+
+async def start_family(
+    redis: Redis,
+    user_id: int,
+    scopes: str,
+    refresh_token_id: int,
+    access_token_id: int,
+    refresh_ttl: int,
+    access_ttl: int,
+) -> int:
+    """
+    Start a new token family for a login, revoking the user's other families
+
+    Parameters:
+        redis (Redis): The redis connection
+        user_id (int): The user logging in
+        scopes (str): The space seperated scopes the tokens grant
+        refresh_token_id (int): The id of the first refresh token, also used as the family id
+        access_token_id (int): The id of the access token issued with it
+        refresh_ttl (int): Seconds the family lives for without being used
+        access_ttl (int): Seconds the access token lives for
+
+    Returns:
+        int: The family id
+    """
+
+    family_id = refresh_token_id
+    script = redis.register_script(START_FAMILY)
+    await script(
+        keys=[
+            user_families_key(user_id),
+            family_key(family_id),
+            str(access_token_id),
+        ],
+        args=[user_id, scopes, refresh_token_id, family_id, refresh_ttl, access_ttl],
+    )
+    return family_id
+
+
+async def rotate_family(
+    redis: Redis,
+    family_id: int,
+    presented_token_id: int,
+    refresh_token_id: int,
+    access_token_id: int,
+    user_id: int,
+    refresh_ttl: int,
+    access_ttl: int,
+) -> int:
+    """
+    Swap the family's current refresh token for a new one and store the new access token
+
+    Parameters:
+        redis (Redis): The redis connection
+        family_id (int): The family of the presented refresh token
+        presented_token_id (int): The id of the refresh token being used
+        refresh_token_id (int): The id of the new refresh token
+        access_token_id (int): The id of the new access token
+        user_id (int): The user the family belongs to
+        refresh_ttl (int): Seconds the family lives for without being used
+        access_ttl (int): Seconds the access token lives for
+
+    Returns:
+        int: FAMILY_ROTATED, FAMILY_NOT_FOUND (expired or revoked)
+            or FAMILY_REUSED (an old token was presented, the family has been revoked)
+    """
+
+    script = redis.register_script(ROTATE_FAMILY)
+    return int(
+        await script(
+            keys=[
+                family_key(family_id),
+                str(access_token_id),
+                user_families_key(user_id),
+            ],
+            args=[
+                presented_token_id,
+                refresh_token_id,
+                refresh_ttl,
+                access_ttl,
+                user_id,
+                family_id,
+            ],
+        )
+    )
+
+
+async def revoke_user_families(redis: Redis, user_id: int) -> None:
+    """
+    Revoke every refresh token family a user has, eg: when their account is deleted
+
+    Parameters:
+        redis (Redis): The redis connection
+        user_id (int): The user
+    """
+
+    families = await redis.smembers(user_families_key(user_id))
+    await redis.delete(
+        user_families_key(user_id), *(family_key(family) for family in families)
+    )
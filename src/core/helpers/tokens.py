@@ -4,7 +4,7 @@ from datetime import datetime, timedelta
 
 from jose import jwt, ExpiredSignatureError, JWTError
 
-from core import UCHTTPExceptions, User, parse_id, Token
+from core import UCHTTPExceptions, User, parse_id, user_flight
 
 
 JWT_SIGNING_KEY = os.environ["JWT_SIGNING_KEY"]
@@ -35,12 +35,15 @@ async def create_access_token(
     return jwt.encode(encoded_data, JWT_SIGNING_KEY, algorithm="HS256")
 
 
-async def check_valid_token(token: str) -> tuple[User, list[str]]:
+def decode_token(token: str) -> tuple[dict, str]:
     """
-    Checks the token to see if its legit
+    Checks the signature and expiry of a token and works out what type of token it is
 
     Parameters:
-        token (str): The oauth2 JWT access token you got from the /token endpoint
+        token (str): The JWT token
+
+    Returns:
+        tuple[dict, str]: The payload and the token type, eg: REFRESH_TOK_ID
     """
 
     try:
@@ -55,21 +58,49 @@ async def check_valid_token(token: str) -> tuple[User, list[str]]:
     except (KeyError, ValueError, AttributeError) as exc:
         raise UCHTTPExceptions.INVALID_TOKEN_ERROR from exc
 
+    return payload, token_id.idtype
+
+
+def decode_refresh_token(token: str) -> dict:
+    """
+    Decodes a refresh token without touching any database.
+    Whether it has been rotated or revoked is checked against its token family in redis
+
+    Parameters:
+        token (str): The refresh token you got from the /token or /refresh endpoint
+
+    Returns:
+        dict: The payload, with user_id, scopes, tok_id and fam (the family id)
+    """
+
+    payload, token_type = decode_token(token)
+    if token_type != "REFRESH_TOK_ID":
+        raise UCHTTPExceptions.INVALID_TOKEN_ERROR
+
+    if not all(key in payload for key in ("user_id", "scopes", "fam")):
+        raise UCHTTPExceptions.INVALID_TOKEN_ERROR
+
+    return payload
+
+
+async def check_valid_token(token: str) -> tuple[User, list[str]]:
+    """
+    Checks a verification token to see if its legit.
+    Marking the user as verified is left to the caller so it can be done in a transaction
+
+    Parameters:
+        token (str): The JWT verification token that was emailed to the user
+    """
+
+    payload, token_type = decode_token(token)
+
     user_id = payload.get("user_id")
-    user = await User.filter(id=user_id).first()
+    user = await user_flight.do(user_id, User.filter(id=user_id).first)
 
     if user is None:
         raise UCHTTPExceptions.INVALID_TOKEN_ERROR
 
-    if token_id.idtype == "REFRESH_TOK_ID":
-        token_is_valid = await Token.exists(token_id=payload["tok_id"])
-        if token_is_valid:
-            scopes: list[str] = payload["scopes"].split()
-            return (user, scopes)
-
-    elif token_id.idtype == "VERIF_TOK_ID":
-        user.update_from_dict({"verified": True})
-        await user.save()
+    if token_type == "VERIF_TOK_ID":
         return (user, [])
 
     raise UCHTTPExceptions.INVALID_TOKEN_ERROR
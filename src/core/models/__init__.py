@@ -6,6 +6,8 @@ __all__ = (
     "ChatAPI",
     "NewUserForm",
     "limiter",
+    "route_cost",
+    "Cost",
     "User",
     "user_pyd",
     "UserCache",
@@ -23,9 +25,18 @@ __all__ = (
     "SignedPreKey",
     "PreKey",
     "PreKeyBundle",
+    "authenticate",
+    "Gateway",
+    "GatewayConnection",
+    "room_channel",
+    "user_channel",
+    "Message",
+    "InboxEnvelope",
+    "Device",
+    "OutboxEvent",
 )
 
-from .chatapp import ChatAPI, limiter
+from .chatapp import ChatAPI, limiter, route_cost, Cost
 from .users import (
     NewUserForm,
     User,
@@ -35,11 +46,16 @@ from .users import (
     BlacklistedIP,
     Token,
     check_auth_token,
+    authenticate,
     PasswordRequestForm,
     user_cache,
     AuthToken,
     Permissions,
     OneTimePreKeys,
     SignedPreKeys,
+    OutboxEvent,
+    Device,
 )
+from .gateway import Gateway, GatewayConnection, room_channel, user_channel
+from .messages import Message, InboxEnvelope
 from .kdc import KDCData, SignedPreKey, PreKey, PreKeyBundle
@@ -2,9 +2,10 @@
 This contains the ChatAPI class (FastAPI subclass)
 """
 
-__all__ = ["ChatAPI", "limiter"]
+__all__ = ["ChatAPI", "limiter", "route_cost", "Cost"]
 
 import os
+from enum import IntEnum
 from typing import Final
 from os.path import join, dirname
 
@@ -12,19 +13,68 @@ import aioredis
 from fastapi import FastAPI
 from dotenv import load_dotenv
 from slowapi.extension import Limiter
-from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
 from slowapi.middleware import SlowAPIMiddleware
 from fastapi.middleware.cors import CORSMiddleware
 
-from core.helpers import rate_limit_exceeded_handler
+from core.helpers import (
+    rate_limit_exceeded_handler,
+    rate_limit_key,
+    AdmissionController,
+    admission_options,
+    LoopMonitor,
+    SamplingProfiler,
+    loop_monitor_options,
+)
+from core.db.messages import MessageStore
+from core.db.keys import KeyDirectory
+from core.db.usernames import AvailabilityIndex
+from core.db.inbox import DeviceInbox, inbox_options
+from core.db.uploads import UploadStore, upload_options
+from core.db.presence import Presence
+from core.db.blocklists import BanCache
+from core.helpers.blobstore import blob_store
+from core.models.gateway import Gateway
 
 DEFAULT_RATELIMIT: Final = "30/minute"
 limiter = Limiter(
-    key_func=get_remote_address,
+    key_func=rate_limit_key,
     default_limits=[DEFAULT_RATELIMIT],
 )
 
+# points each user (or ip when signed out) can spend a minute across every route
+RESOURCE_BUDGET: Final = os.environ.get("RATE_LIMIT_BUDGET", "600/minute")
+
+
+class Cost(IntEnum):
+    """
+    Roughly how much cpu and database time a route takes, in budget points
+    """
+
+    CACHED = 1  # redis or in memory only
+    DB_READ = 2
+    DB_WRITE = 5
+    BULK_WRITE = 10
+    PASSWORD_HASH = 50  # argon2
+    IMAGE = 100  # decoding and encoding an avatar at every size
+
+
+def route_cost(cost: int):
+    """
+    Decorator that charges a route's cost against the caller's shared budget,
+    the route also still has the default per route limit
+
+    Parameters:
+        cost (int): The points a request costs, eg: Cost.DB_READ
+
+    Returns:
+        Callable: The slowapi decorator, put it under the route decorator
+    """
+
+    return limiter.shared_limit(
+        RESOURCE_BUDGET, scope="resources", cost=cost, override_defaults=False
+    )
+
 
 def get_description() -> str:
     """
@@ -76,6 +126,59 @@ class ChatAPI(FastAPI):
 
         self.redis = create_redis_connection()
 
+        # realtime events over websockets
+        self.gateway = Gateway(self.redis)
+        self.add_event_handler("shutdown", self.gateway.close)
+
+        # who is online, heartbeats are written in batches. a slot is one heartbeat interval
+        self.presence = Presence(self.redis, slot_length=30)
+        self.add_event_handler("startup", self.presence.start)
+        self.add_event_handler("shutdown", self.presence.close)
+
+        # batched message writes
+        self.messages = MessageStore()
+        self.add_event_handler("startup", self.messages.start)
+        self.add_event_handler("shutdown", self.messages.close)
+
+        # identity keys and signed prekeys, cached in process and in redis
+        self.key_directory = KeyDirectory(self.redis)
+        self.add_event_handler("startup", self.key_directory.start)
+        self.add_event_handler("shutdown", self.key_directory.close)
+
+        # envelopes waiting for offline devices
+        self.inbox = DeviceInbox(self.redis, **inbox_options())
+        self.add_event_handler("startup", self.inbox.start)
+        self.add_event_handler("shutdown", self.inbox.close)
+
+        # resumable attachment uploads, next to the blob store so finishing one is a rename
+        self.uploads = UploadStore(
+            self.redis, join(blob_store.root, "uploads"), **upload_options()
+        )
+        self.add_event_handler("startup", self.uploads.start)
+        self.add_event_handler("shutdown", self.uploads.close)
+
+        # usernames and emails in use, checked by signup before hashing the password
+        self.availability = AvailabilityIndex(
+            self.redis,
+            capacity=int(os.environ.get("AVAILABILITY_FILTER_CAPACITY", 1_000_000)),
+        )
+        self.add_event_handler("startup", self.availability.start)
+        self.add_event_handler("shutdown", self.availability.close)
+
+        # banned ips, read by routes/middleware/banned.py
+        self.bans = BanCache(self.redis)
+        self.add_event_handler("startup", self.bans.start)
+        self.add_event_handler("shutdown", self.bans.close)
+
+        # load shedding, see routes/middleware/shedding.py
+        self.admission = AdmissionController(**admission_options())
+
+        # event loop lag and blocking calls, per request profiles (routes/middleware/profiling.py)
+        self.loop_monitor = LoopMonitor(**loop_monitor_options())
+        self.add_event_handler("startup", self.loop_monitor.start)
+        self.add_event_handler("shutdown", self.loop_monitor.close)
+        self.profiler = SamplingProfiler()
+
         # CORS
         cors_options = {
             "allow_origins": ["*"],
@@ -0,0 +1,289 @@
+""" (module) gateway
+Contains the Gateway class which fans real time events out to websocket connections
+
+Every worker holds one redis pub/sub connection and subscribes to a channel per room (and user)
+that has at least one local connection. Events published to a channel by any worker are
+serialized once and pushed onto the send queue of every local connection listening to it.
+"""
+
+__all__ = ["Gateway", "GatewayConnection", "room_channel", "user_channel"]
+
+import json
+import asyncio
+from typing import Optional, TYPE_CHECKING
+
+import aioredis
+from fastapi import WebSocket
+from aioredis.client import PubSub
+
+if TYPE_CHECKING:  # users imports chatapp which imports this module
+    from core.models.users import User, Permissions
+
+# close codes sent to clients
+CLOSE_SLOW_CONSUMER = 4008
+
+
+def room_channel(room_id: int) -> str:
+    return f"room:{room_id}"
+
+
+def user_channel(user_id: int) -> str:
+    return f"user:{user_id}"
+
+
+class GatewayConnection:
+    """
+    A single authenticated websocket connection
+
+    Attributes:
+        websocket (WebSocket): The underlying websocket
+        user (User): The user that identified on this connection
+        perms (Permissions): The permissions granted by the token used to identify
+        channels (set[str]): The pub/sub channels this connection receives events from
+        queue (asyncio.Queue[str]): Serialized events waiting to be sent
+        typing (dict[int, float]): room id -> time.monotonic() of the last typing event sent
+    """
+
+    __slots__ = ("websocket", "user", "perms", "channels", "queue", "writer", "typing")
+
+    def __init__(
+        self,
+        websocket: WebSocket,
+        user: "User",
+        perms: "Permissions",
+        channels: set[str],
+        queue_size: int,
+    ) -> None:
+        self.websocket = websocket
+        self.user = user
+        self.perms = perms
+        self.channels = channels
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=queue_size)
+        self.typing: dict[int, float] = {}
+        self.writer = asyncio.create_task(self._write())
+
+    def offer(self, payload: str) -> bool:
+        """
+        Queue a serialized event without waiting
+
+        Returns:
+            bool: False if the send queue is full and the client is not keeping up
+        """
+
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            return False
+        return True
+
+    async def _write(self) -> None:
+        while True:
+            payload = await self.queue.get()
+            await self.websocket.send_text(payload)
+
+
+class Gateway:
+    """
+    Keeps track of the websocket connections on this worker and the channels they listen to
+
+    Parameters:
+        redis (aioredis.Redis): The redis connection used for publishing and subscribing
+        queue_size (int): Max events buffered per connection before it is dropped as a slow consumer
+    """
+
+    def __init__(self, redis: aioredis.Redis, queue_size: int = 256) -> None:
+        self.redis = redis
+        self.queue_size = queue_size
+        self.connections: set[GatewayConnection] = set()
+        self.channels: dict[str, set[GatewayConnection]] = {}
+
+        self.pubsub: Optional[PubSub] = None
+        self.listener: Optional[asyncio.Task] = None
+
+        self.events_published = 0
+        self.events_delivered = 0
+        self.slow_consumers_dropped = 0
+
+    async def connect(
+        self,
+        websocket: WebSocket,
+        user: "User",
+        perms: "Permissions",
+        rooms: list[int],
+    ) -> GatewayConnection:
+        """
+        Register a connection and subscribe to the user's channel and the channels of their rooms
+        Room membership is read once here and kept up to date by room_added / room_removed events,
+        nothing is looked up per message
+
+        Returns:
+            GatewayConnection: The registered connection
+        """
+
+        channels = {user_channel(user.id)}
+        channels.update(room_channel(room_id) for room_id in rooms)
+
+        connection = GatewayConnection(
+            websocket, user, perms, channels, self.queue_size
+        )
+        self.connections.add(connection)
+        await self._subscribe(connection, channels)
+
+        return connection
+
+    async def disconnect(self, connection: GatewayConnection) -> None:
+        if connection not in self.connections:
+            return
+
+        self.connections.discard(connection)
+        connection.writer.cancel()
+
+        unused = []
+        for channel in connection.channels:
+            listeners = self.channels.get(channel)
+            if listeners is None:
+                continue
+            listeners.discard(connection)
+            if not listeners:
+                del self.channels[channel]
+                unused.append(channel)
+
+        if unused and self.pubsub is not None:
+            await self.pubsub.unsubscribe(*unused)
+
+    async def join(self, connection: GatewayConnection, channel: str) -> None:
+        """Start sending events from another channel to an existing connection"""
+
+        connection.channels.add(channel)
+        await self._subscribe(connection, {channel})
+
+    async def leave(self, connection: GatewayConnection, channel: str) -> None:
+        """Stop sending events from a channel to a connection"""
+
+        connection.channels.discard(channel)
+        listeners = self.channels.get(channel)
+        if listeners is None:
+            return
+
+        listeners.discard(connection)
+        if not listeners:
+            del self.channels[channel]
+            if self.pubsub is not None:
+                await self.pubsub.unsubscribe(channel)
+
+    async def publish(self, channel: str, event: dict) -> None:
+        """
+        Publish an event to every connection listening to the channel, on any worker
+
+        Parameters:
+            channel (str): The channel, see room_channel and user_channel
+            event (dict): The json serializable event
+        """
+
+        self.events_published += 1
+        await self.redis.publish(channel, json.dumps(event))
+
+    async def publish_many(self, events: list[tuple[str, dict]]) -> None:
+        """
+        Publish a batch of events in one round trip
+
+        Parameters:
+            events (list[tuple[str, dict]]): (channel, event) pairs
+        """
+
+        if not events:
+            return
+
+        self.events_published += len(events)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for channel, event in events:
+                pipe.publish(channel, json.dumps(event))
+            await pipe.execute()
+
+    def send(self, connection: GatewayConnection, event: dict) -> None:
+        """Send an event to a single local connection"""
+
+        self._deliver(connection, json.dumps(event))
+
+    def stats(self) -> dict:
+        return {
+            "connections": len(self.connections),
+            "channels": len(self.channels),
+            "events_published": self.events_published,
+            "events_delivered": self.events_delivered,
+            "slow_consumers_dropped": self.slow_consumers_dropped,
+        }
+
+    async def close(self) -> None:
+        for connection in list(self.connections):
+            await self.disconnect(connection)
+
+        if self.listener is not None:
+            self.listener.cancel()
+        if self.pubsub is not None:
+            await self.pubsub.close()
+
+    async def _subscribe(
+        self, connection: GatewayConnection, channels: set[str]
+    ) -> None:
+        new = []
+        for channel in channels:
+            listeners = self.channels.setdefault(channel, set())
+            if not listeners:
+                new.append(channel)
+            listeners.add(connection)
+
+        if not new:
+            return
+
+        if self.pubsub is None:
+            self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        await self.pubsub.subscribe(*new)
+
+        if self.listener is None or self.listener.done():
+            self.listener = asyncio.create_task(self._listen())
+
+    async def _listen(self) -> None:
+        assert self.pubsub is not None
+
+        while True:
+            message = await self.pubsub.get_message(timeout=1.0)
+            if message is None:
+                continue
+
+            channel, payload = message["channel"], message["data"]
+            if channel.startswith("user:"):
+                await self._membership_changed(channel, payload)
+
+            # the payload is already serialized, every listener gets the same string
+            listeners = self.channels.get(channel, ())
+            for connection in tuple(listeners):
+                self._deliver(connection, payload)
+
+    async def _membership_changed(self, channel: str, payload: str) -> None:
+        event = json.loads(payload)
+        if event.get("op") not in ("room_added", "room_removed"):
+            return
+
+        room = room_channel(int(event["room_id"]))
+        for connection in tuple(self.channels.get(channel, ())):
+            if event["op"] == "room_added":
+                await self.join(connection, room)
+            else:
+                await self.leave(connection, room)
+
+    def _deliver(self, connection: GatewayConnection, payload: str) -> None:
+        if connection.offer(payload):
+            self.events_delivered += 1
+            return
+
+        # backpressure: a client that can't keep up gets dropped instead of buffering forever
+        self.slow_consumers_dropped += 1
+        asyncio.create_task(self._drop(connection))
+
+    async def _drop(self, connection: GatewayConnection) -> None:
+        await self.disconnect(connection)
+        try:
+            await connection.websocket.close(code=CLOSE_SLOW_CONSUMER)
+        except RuntimeError:  # already closed
+            pass
@@ -1,4 +1,9 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, validator
+
+from core.helpers import decode_key, PUBLIC_KEY_LENGTHS, SIGNATURE_LENGTHS
+
+# keys are base64 in the api, checking they decode to the right length here
+# means the routes can store the raw bytes without checking again
 
 
 class SignedPreKey(BaseModel):
@@ -6,17 +11,41 @@ class SignedPreKey(BaseModel):
     public_key: str
     signature: str
 
+    @validator("public_key")
+    @classmethod
+    def validate_public_key(cls, public_key: str):
+        decode_key(public_key, PUBLIC_KEY_LENGTHS)
+        return public_key
+
+    @validator("signature")
+    @classmethod
+    def validate_signature(cls, signature: str):
+        decode_key(signature, SIGNATURE_LENGTHS)
+        return signature
+
 
 class PreKey(BaseModel):
     key_id: int
     public_key: str
 
+    @validator("public_key")
+    @classmethod
+    def validate_public_key(cls, public_key: str):
+        decode_key(public_key, PUBLIC_KEY_LENGTHS)
+        return public_key
+
 
 class KDCData(BaseModel):
     identity_key: str
     signed_prekey: SignedPreKey
     pre_keys: list[PreKey]
 
+    @validator("identity_key")
+    @classmethod
+    def validate_identity_key(cls, identity_key: str):
+        decode_key(identity_key, PUBLIC_KEY_LENGTHS)
+        return identity_key
+
 
 class PreKeyBundle(BaseModel):
     user_id: str
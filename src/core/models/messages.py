@@ -0,0 +1,24 @@
+from typing import Final
+
+from pydantic import BaseModel, validator
+
+MAX_ENVELOPE_SIZE: Final = 64 * 1024  # characters of ciphertext
+
+
+class Message(BaseModel):
+    id: str
+    room_id: str
+    author_id: str
+    envelope: str
+
+
+class InboxEnvelope(BaseModel):
+    device_id: int
+    envelope: str
+
+    @validator("envelope")
+    @classmethod
+    def validate_envelope(cls, envelope: str):
+        if len(envelope) > MAX_ENVELOPE_SIZE:
+            raise ValueError(f"must be at most {MAX_ENVELOPE_SIZE} characters")
+        return envelope
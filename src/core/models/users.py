@@ -12,7 +12,6 @@ from jose import jwt, ExpiredSignatureError, JWTError
 from tortoise import fields
 from tortoise.models import Model
 from fastapi import Form, Depends
-from tortoise.contrib.postgres.fields import ArrayField
 from tortoise.contrib.pydantic import pydantic_model_creator  # type: ignore
 from pydantic import BaseModel, SecretStr, EmailStr, EmailError, validator
 from fastapi.security import (
@@ -25,8 +24,11 @@ from core import (
     UCHTTPExceptions,
     argon2_hash,
     parse_id,
+    user_flight,
+    encode_key,
 )
 from core.models.chatapp import create_redis_connection
+from core.db.accounts import deleted_key
 
 
 redis_conn = create_redis_connection()
@@ -46,12 +48,11 @@ class User(Model):
         created_at (int): timestamp of when the user created their account
         verified (bool): indicator of if the user has verified their email
             and completed the signup process (default=false)
-        avatar (Optional[str]): link to the users profile picture
-            (or foreign key (uuid) to the user avatar table where the pfp is stored in bytes)
-        rooms (Optional[list[str]]): A list of rooms the user is the owner/admin of.
-            This list is a list of room ids aka foreign keys to the rooms table
+        avatar (Optional[dict]): links to the users profile picture keyed by size in pixels.
+            The pictures are in the content addressed blob store, not the database
         display_name (Optional[str]): The users chosen display name.
             By default this is none but if a user sets it they are displayed with that name
+        deleted_at (Optional[datetime]): When the account was deleted, it is purged soon after
     """
 
     id = fields.BigIntField(pk=True, null=False)
@@ -62,10 +63,10 @@ class User(Model):
     created_at = fields.DatetimeField(auto_now_add=True, null=False)
     verified = fields.BooleanField(default=False, null=False)
     lastname = fields.CharField(64, null=True)
-    avatar = fields.TextField(null=True)
-    rooms = ArrayField("BIGINT", null=True)
+    avatar = fields.JSONField(null=True)
     display_name = fields.TextField(null=True)
-    identity_key = fields.TextField(null=True)
+    identity_key = fields.BinaryField(null=True)
+    deleted_at = fields.DatetimeField(null=True)
 
     class Meta:
         table = "users"
@@ -73,6 +74,8 @@ class User(Model):
     async def to_pydantic(self):
         pydantic_user = await user_pyd.from_tortoise_orm(self)
         setattr(pydantic_user, "id", str(getattr(pydantic_user, "id")))
+        if self.identity_key is not None:
+            setattr(pydantic_user, "identity_key", encode_key(self.identity_key))
 
         return pydantic_user
 
@@ -97,7 +100,7 @@ class Token(Model):
 
 class OneTimePreKeys(Model):
     id = fields.BigIntField(pk=True, null=False)
-    public_key = fields.TextField(null=False)
+    public_key = fields.BinaryField(null=False)
     owner = fields.ForeignKeyField("models.User", "pre_key_users")
 
     class Meta:
@@ -106,14 +109,29 @@ class OneTimePreKeys(Model):
 
 class SignedPreKeys(Model):
     id = fields.BigIntField(pk=True, null=False)
-    public_key = fields.TextField(null=False)
-    signature = fields.TextField(null=False)
+    public_key = fields.BinaryField(null=False)
+    signature = fields.BinaryField(null=False)
     owner = fields.ForeignKeyField("models.User", "signed_key_users")
+    # set when the key is replaced, the old key is pruned once the grace period is over
+    superseded_at = fields.DatetimeField(null=True)
 
     class Meta:
         table = "signed_pre_keys"
 
 
+class Device(Model):
+    """
+    A device a user is signed in on, each one has its own inbox (see core.db.inbox)
+    """
+
+    id = fields.BigIntField(pk=True, null=False)
+    owner = fields.ForeignKeyField("models.User", "devices")
+    created_at = fields.DatetimeField(auto_now_add=True, null=False)
+
+    class Meta:
+        table = "devices"
+
+
 class BlacklistedEmail(Model):
     id = fields.BigIntField(pk=True, null=False, generated=True)
     email = fields.CharField(256, unique=True, null=False)
@@ -122,6 +140,25 @@ class BlacklistedEmail(Model):
         table = "blacklisted_emails"
 
 
+class OutboxEvent(Model):
+    """
+    A message waiting to be published to rabbitmq.
+    Written in the same transaction as the change it is about and published by the relay in rmq.outbox
+
+    Attributes:
+        channel (str): The queue the message goes to
+        payload (dict): The json body of the message
+    """
+
+    id = fields.BigIntField(pk=True, null=False, generated=True)
+    channel = fields.CharField(64, null=False)
+    payload = fields.JSONField(null=False)
+    created_at = fields.DatetimeField(auto_now_add=True, null=False)
+
+    class Meta:
+        table = "outbox"
+
+
 class NewUserForm(BaseModel):
     """
     Base model to represent the details of a new user
@@ -214,6 +251,9 @@ class UserCache:
         if len(self.users) > self.capacity:
             self.users.popitem(last=False)
 
+    def evict(self, user_id: int) -> None:
+        self.users.pop(user_id, None)
+
 
 class PasswordRequestForm(OAuth2PasswordRequestForm):
     def __init__(
@@ -261,7 +301,7 @@ class Permissions(BaseModel):
 
 
 user_cache = UserCache(50)
-user_pyd = pydantic_model_creator(User, name="User", exclude=("password",))
+user_pyd = pydantic_model_creator(User, name="User", exclude=("password", "deleted_at"))
 
 permissions = {
     "user:read": "Read information / get data for the user (@me)",
@@ -286,6 +326,24 @@ async def check_auth_token(
     required_permissions: SecurityScopes,
     token: str = Depends(oauth2_scheme),
 ) -> tuple[User, Permissions]:
+    return await authenticate(token, required_permissions.scopes)
+
+
+async def authenticate(
+    token: str, required_scopes: list[str]
+) -> tuple[User, Permissions]:
+    """
+    Validates an access token and checks it has the required scopes
+    Used by check_auth_token and by the gateway which authenticates once per connection
+
+    Parameters:
+        token (str): The JWT access token
+        required_scopes (list[str]): The permissions needed, eg: ["keys_read"]
+
+    Returns:
+        tuple[User, Permissions]: The user the token belongs to and the permissions it grants
+    """
+
     try:
         payload = jwt.decode(token, os.environ["JWT_SIGNING_KEY"], algorithms=["HS256"])
     except ExpiredSignatureError as e:
@@ -302,14 +360,21 @@ async def check_auth_token(
 
     user = user_cache.get(user_id)  # get user from cache
     if user is None:  # user is not in cache
-        user = await User.filter(id=user_id).first()  # try db
-        if user is None:  # user is not even in db
+        # try db, concurrent misses for the same user share one query
+        user = await user_flight.do(user_id, User.filter(id=user_id).first)
+        if user is None or user.deleted_at is not None:  # user is not even in db
             raise UCHTTPExceptions.INVALID_TOKEN_ERROR
         user_cache.set(user_id, user)
 
     if token_id.idtype == "AUTH_TOK_ID":
-        token = await redis_conn.get(str(payload["tok_id"]))
-        if token is None:
+        # deleted accounts are marked in redis, the cached user may be from before the deletion
+        token, deleted = await redis_conn.mget(
+            str(payload["tok_id"]), deleted_key(user_id)
+        )
+        if deleted is not None:
+            # so the deleted user isn't served from this worker's cache once the marker expires
+            user_cache.evict(user_id)
+        if token is None or deleted is not None:
             raise UCHTTPExceptions.INVALID_TOKEN_ERROR
 
         scopes: list[str] = payload["scopes"].split()
@@ -324,9 +389,9 @@ async def check_auth_token(
         perms = Permissions(**perms_dict)
 
         # check that user has all the perms
-        for permission in required_permissions.scopes:
+        for permission in required_scopes:
             if getattr(perms, permission) is False:
-                raise UCHTTPExceptions.NO_PERMISSION(required_permissions.scopes)
+                raise UCHTTPExceptions.NO_PERMISSION(required_scopes)
 
         return (user, perms)
 
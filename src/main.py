@@ -18,7 +18,14 @@ import aioredis.exceptions
 from tortoise.contrib.fastapi import register_tortoise
 
 from rmq import rabbitmq_server
-from routes import router_list, BannedUserMiddleware
+from core.db.migrate import verify_schema_version
+from routes import (
+    router_list,
+    BannedUserMiddleware,
+    DatabasePinningMiddleware,
+    LoadSheddingMiddleware,
+    ProfilingMiddleware,
+)
 from core import (
     ChatAPI,
     InvalidRedisURL,
@@ -39,7 +46,9 @@ async def startup_event():
     except aioredis.exceptions.ResponseError as e:
         raise InvalidRedisPassword from e
 
-    Thread(target=lambda: asyncio.run(rabbitmq_server()), daemon=True).start()
+    # in production the consumer runs as its own process (python src/worker.py)
+    if devmode == "true":
+        Thread(target=lambda: asyncio.run(rabbitmq_server()), daemon=True).start()
 
 
 # load routes
@@ -47,14 +56,26 @@ for route in router_list:
     app.include_router(router=route)
 
 app.add_middleware(BannedUserMiddleware)
+app.add_middleware(DatabasePinningMiddleware)
+app.add_middleware(ProfilingMiddleware)
+# added last so it runs first and rejects requests before any other work is done
+app.add_middleware(LoadSheddingMiddleware)
 
-# register tortoise orm
+# register tortoise orm, the schema is managed by migrations (make migrate)
 register_tortoise(
     app,
     config=TORTOISE_CONFIG,
-    generate_schemas=True,
+    generate_schemas=False,
     add_exception_handlers=True,
 )
+
+
+@app.on_event("startup")
+async def check_schema_version():
+    # registered after tortoise so the connections already exist
+    await verify_schema_version()
+
+
 PORT: Final = 8443
 SSL_CERTFILE_PATH: Final = join(dirname(__file__), "cert.pem")
 SSL_KEYFILE_PATH: Final = join(dirname(__file__), "key.pem")
@@ -0,0 +1,25 @@
+""" (script)
+python script to apply the database migrations
+run this before starting a new version of the api
+"""
+
+import asyncio
+
+from tortoise import Tortoise
+
+from core import TORTOISE_CONFIG
+from core.db.migrate import apply_migrations
+from core.db.messages import ensure_partitions
+
+
+async def migrate() -> None:
+    await Tortoise.init(config=TORTOISE_CONFIG)
+    try:
+        await apply_migrations()
+        await ensure_partitions()
+    finally:
+        await Tortoise.close_connections()
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate())
@@ -0,0 +1,92 @@
+""" (module) maintenance
+Periodic database housekeeping that runs alongside the rabbitmq consumer
+"""
+
+import os
+import asyncio
+import logging
+from typing import Final
+from datetime import datetime, timedelta
+
+from core.models.chatapp import create_redis_connection
+from core.db.keys import prune_signed_prekeys, reconcile_prekey_stock
+from core.db.inbox import prune_inbox_spill
+from core.db.accounts import purge_deleted_users
+from core.db.messages import ensure_partitions, drop_partitions_before
+
+MAINTENANCE_INTERVAL: Final = 60 * 60  # seconds
+
+logger = logging.getLogger(__name__)
+redis_conn = create_redis_connection()
+
+
+async def message_partitions() -> None:
+    await ensure_partitions()
+
+    # messages are kept forever unless a retention period is set
+    retention_days = os.environ.get("MESSAGE_RETENTION_DAYS")
+    if retention_days:
+        cutoff = datetime.utcnow() - timedelta(days=int(retention_days))
+        await drop_partitions_before(cutoff)
+
+
+async def signed_prekeys() -> None:
+    # replaced signed prekeys are kept this long for sessions that were started with them
+    grace_days = int(os.environ.get("SIGNED_PREKEY_GRACE_DAYS", 30))
+    cutoff = datetime.utcnow() - timedelta(days=grace_days)
+
+    pruned = await prune_signed_prekeys(cutoff)
+    if pruned:
+        logger.info("Pruned %d superseded signed prekeys", pruned)
+
+
+async def prekey_stock() -> None:
+    corrected = await reconcile_prekey_stock(redis_conn)
+    if corrected:
+        logger.info("Corrected %d prekey counters", corrected)
+
+
+async def inbox_spill() -> None:
+    # the same expiry the redis side of the inboxes has
+    ttl_days = int(os.environ.get("INBOX_TTL_DAYS", 30))
+    cutoff = datetime.utcnow() - timedelta(days=ttl_days)
+
+    pruned = await prune_inbox_spill(cutoff)
+    if pruned:
+        logger.info("Pruned %d expired inbox envelopes", pruned)
+
+
+async def deleted_accounts() -> None:
+    purged = await purge_deleted_users(redis_conn)
+    if purged:
+        logger.info("Purged %d deleted accounts", purged)
+
+
+async def run_maintenance() -> None:
+    while True:
+        try:
+            await message_partitions()
+        except Exception:
+            logger.exception("Message partition maintenance failed")
+
+        try:
+            await signed_prekeys()
+        except Exception:
+            logger.exception("Signed prekey pruning failed")
+
+        try:
+            await prekey_stock()
+        except Exception:
+            logger.exception("Prekey counter reconciliation failed")
+
+        try:
+            await inbox_spill()
+        except Exception:
+            logger.exception("Inbox spill pruning failed")
+
+        try:
+            await deleted_accounts()
+        except Exception:
+            logger.exception("Purging deleted accounts failed")
+
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
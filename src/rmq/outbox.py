@@ -0,0 +1,82 @@
+""" (module) outbox
+Relays the outbox table to rabbitmq
+
+Rows are claimed in batches with SKIP LOCKED so several relays can run at once,
+published with publisher confirms and only deleted once rabbitmq has confirmed every one.
+If the relay dies between publishing and deleting the batch is sent again, so delivery is at least once.
+"""
+
+import json
+import asyncio
+import logging
+from typing import Final
+
+from tortoise.transactions import in_transaction
+from aio_pika import Message, DeliveryMode
+from aio_pika.abc import AbstractConnection, AbstractChannel
+
+BATCH_SIZE: Final = 100
+POLL_INTERVAL: Final = 0.5  # seconds to wait when the outbox is empty
+
+logger = logging.getLogger(__name__)
+
+
+async def relay_batch(channel: AbstractChannel, declared: set[str]) -> int:
+    """
+    Publish and delete one batch of outbox rows
+
+    Returns:
+        int: The number of rows relayed
+    """
+
+    async with in_transaction("default") as connection:
+        rows = await connection.execute_query_dict(
+            'SELECT "id", "channel", "payload" FROM "outbox" '
+            'ORDER BY "id" LIMIT $1 FOR UPDATE SKIP LOCKED',
+            [BATCH_SIZE],
+        )
+        if not rows:
+            return 0
+
+        for name in {row["channel"] for row in rows} - declared:
+            await channel.declare_queue(name)
+            declared.add(name)
+
+        # with publisher confirms each publish resolves once the broker has the message
+        await asyncio.gather(
+            *(
+                channel.default_exchange.publish(
+                    Message(
+                        row["payload"].encode()
+                        if isinstance(row["payload"], str)
+                        else json.dumps(row["payload"]).encode(),
+                        delivery_mode=DeliveryMode.PERSISTENT,
+                    ),
+                    routing_key=row["channel"],
+                )
+                for row in rows
+            )
+        )
+
+        await connection.execute_query(
+            'DELETE FROM "outbox" WHERE "id" = ANY($1::BIGINT[])',
+            [[row["id"] for row in rows]],
+        )
+
+    return len(rows)
+
+
+async def relay_outbox(rmq_connection: AbstractConnection) -> None:
+    channel = await rmq_connection.channel(publisher_confirms=True)
+    declared: set[str] = set()
+
+    while True:
+        try:
+            relayed = await relay_batch(channel, declared)
+        except Exception:
+            logger.exception("Failed to relay outbox batch")
+            relayed = 0
+
+        # a full batch means there is probably more waiting
+        if relayed < BATCH_SIZE:
+            await asyncio.sleep(POLL_INTERVAL)
@@ -12,10 +12,15 @@ from dotenv import load_dotenv
 from aio_pika import connect, Message
 from aio_pika.abc import AbstractIncomingMessage
 
-from core import RMQ_CONN_URL, User, TORTOISE_CONFIG
+from core import RMQ_CONN_URL, TORTOISE_CONFIG, user_channel
+from core.models.chatapp import create_redis_connection
+from core.db.accounts import mark_deleted
+from .outbox import relay_outbox
+from .maintenance import run_maintenance
 
 load_dotenv()
 BASE_URL: Final = f"{os.environ['API_URL']}/api/v1"
+redis_conn = create_redis_connection()
 
 
 async def sendmail(message: MIMEMultipart):
@@ -65,8 +70,19 @@ async def send_welcome_email(msg: AbstractIncomingMessage) -> None:
 async def delete_user_account(msg: AbstractIncomingMessage | Message) -> None:
     message = json.loads(msg.body)
     user_id = message["user_id"]
+    if user_id is None:
+        return
 
-    await User.filter(id=user_id).delete()
+    # only marked here, the maintenance job purges the account's rows in small batches
+    await mark_deleted(redis_conn, int(user_id))
+
+
+async def notify_prekeys_low(msg: AbstractIncomingMessage) -> None:
+    message = json.loads(msg.body)
+
+    # the gateway delivers this to every connection the user has open
+    event = {"op": "prekeys_low", "remaining": message["remaining"]}
+    await redis_conn.publish(user_channel(message["user_id"]), json.dumps(event))
 
 
 async def rabbitmq_server() -> None:
@@ -77,6 +93,7 @@ async def rabbitmq_server() -> None:
         {"name": "verification_email", "callback": send_verification_email},
         {"name": "welcome_email", "callback": send_welcome_email},
         {"name": "delete_account", "callback": delete_user_account},
+        {"name": "prekeys_low", "callback": notify_prekeys_low},
     ]
     connection = await connect(RMQ_CONN_URL)
     async with connection:
@@ -85,4 +102,5 @@ async def rabbitmq_server() -> None:
             queue = await channel.declare_queue(channel_data["name"])
             await queue.consume(channel_data["callback"], no_ack=True)
 
-        await asyncio.Future()
+        # runs forever, the consumers are driven by the same event loop
+        await asyncio.gather(run_maintenance(), relay_outbox(connection))
@@ -1,6 +1,44 @@
-__all__ = ["router_list", "BannedUserMiddleware"]
+__all__ = [
+    "router_list",
+    "BannedUserMiddleware",
+    "DatabasePinningMiddleware",
+    "LoadSheddingMiddleware",
+    "ProfilingMiddleware",
+]
 
-from .middleware import BannedUserMiddleware
-from .users import signup_endpoint, authentication_endpoint, keys_endpoint, me_endpoint
+from .middleware import (
+    BannedUserMiddleware,
+    DatabasePinningMiddleware,
+    LoadSheddingMiddleware,
+    ProfilingMiddleware,
+)
+from .gateway import gateway_endpoint
+from .devices import inbox_endpoint
+from .attachments import attachments_endpoint
+from .status import status_endpoint
+from .admin import blocklists_endpoint
+from .rooms import messages_endpoint, members_endpoint
+from .users import (
+    signup_endpoint,
+    authentication_endpoint,
+    keys_endpoint,
+    me_endpoint,
+    avatars_endpoint,
+    search_endpoint,
+)
 
-router_list = [signup_endpoint, authentication_endpoint, keys_endpoint, me_endpoint]
+router_list = [
+    signup_endpoint,
+    authentication_endpoint,
+    keys_endpoint,
+    me_endpoint,
+    avatars_endpoint,
+    search_endpoint,
+    gateway_endpoint,
+    inbox_endpoint,
+    attachments_endpoint,
+    messages_endpoint,
+    members_endpoint,
+    status_endpoint,
+    blocklists_endpoint,
+]
@@ -0,0 +1,3 @@
+__all__ = ["blocklists_endpoint"]
+
+from .blocklists import blocklists_endpoint
@@ -0,0 +1,49 @@
+""" (module)
+Code for the admin endpoints to bulk load and dump the ip and email blocklists
+
+    POST /blocklists/{ips|emails}   body: one entry per line, or a csv with the entry first
+    GET /blocklists/{ips|emails}    -> the list, one entry per line
+
+Both stream, a feed of hundreds of thousands of entries is never held in memory.
+Every request needs the admin token in X-Admin-Token
+"""
+
+__all__ = ["blocklists_endpoint"]
+
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import StreamingResponse
+
+from core import require_admin, route_cost, Cost
+from core.db.blocklists import Blocklist, import_blocklist, export_blocklist
+
+blocklists_endpoint = APIRouter(
+    tags=[
+        "Admin",
+    ],
+    prefix="/api/v1/admin/blocklists",
+    dependencies=[Depends(require_admin)],
+)
+
+
+@blocklists_endpoint.post("/{blocklist}")
+@route_cost(Cost.BULK_WRITE)
+async def import_entries(request: Request, blocklist: Blocklist):
+    counts = await import_blocklist(blocklist, request.stream())
+
+    # ips banned before the import may be cached as not banned on any worker
+    if blocklist is Blocklist.ips and counts["added"]:
+        await request.app.bans.refresh_all()
+
+    return {"success": True, **counts}
+
+
+@blocklists_endpoint.get("/{blocklist}")
+@route_cost(Cost.BULK_WRITE)
+async def export_entries(request: Request, blocklist: Blocklist):
+    return StreamingResponse(
+        export_blocklist(blocklist),
+        media_type="text/plain",
+        headers={
+            "Content-Disposition": f'attachment; filename="{blocklist.value}.txt"'
+        },
+    )
@@ -0,0 +1,3 @@
+__all__ = ["attachments_endpoint"]
+
+from .uploads import attachments_endpoint
@@ -0,0 +1,184 @@
+""" (module)
+Code for the endpoints to upload attachments in resumable chunks and to download them
+
+Uploading:
+    POST /uploads {size, sha256?}              -> upload_id, chunk_size, chunks
+    PUT /uploads/{upload_id}/chunks/{index}    raw bytes of one chunk, X-Chunk-SHA256 optional
+    GET /uploads/{upload_id}                   -> the chunks still missing, to resume
+    POST /uploads/{upload_id}/finalize         -> sha256, the id of the attachment
+Downloading supports Range so a download can be resumed too
+"""
+
+__all__ = ["attachments_endpoint"]
+
+import os
+import asyncio
+from typing import Final, Optional
+
+from pydantic import BaseModel, conint, validator
+from fastapi import APIRouter, Request, Response, Security, Header
+
+from core import (
+    User,
+    Permissions,
+    check_auth_token,
+    UCHTTPExceptions,
+    route_cost,
+    Cost,
+)
+from core.helpers.blobstore import blob_store, is_digest
+from core.helpers.ranged import RangedFileResponse, parse_range
+from core.helpers.conditional import etag_matches
+from core.db.uploads import InvalidChunk, UploadNotFound, UploadIncomplete
+
+# attachments are encrypted and never change, only the client can read them
+CACHE_CONTROL: Final = "private, max-age=31536000, immutable"
+
+attachments_endpoint = APIRouter(
+    tags=[
+        "Attachments",
+    ],
+    prefix="/api/v1/attachments",
+)
+
+
+class NewUpload(BaseModel):
+    size: conint(gt=0)  # type: ignore
+    sha256: Optional[str] = None
+
+    @validator("sha256")
+    @classmethod
+    def validate_sha256(cls, sha256: Optional[str]):
+        if sha256 is not None and not is_digest(sha256.lower()):
+            raise ValueError("must be a hex sha256 digest")
+        return sha256
+
+
+async def get_session(request: Request, upload_id: str, user: User) -> dict:
+    try:
+        return await request.app.uploads.session(upload_id, user.id)
+    except UploadNotFound as e:
+        raise UCHTTPExceptions.KEY_NOT_FOUND(upload_id, "upload") from e
+
+
+@attachments_endpoint.post("/uploads")
+@route_cost(Cost.DB_WRITE)
+async def create_upload(
+    request: Request,
+    new_upload: NewUpload,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_write"]
+    ),
+):
+    user, _perms = auth_data
+    try:
+        upload = await request.app.uploads.create(
+            user.id, new_upload.size, new_upload.sha256
+        )
+    except InvalidChunk as e:
+        raise UCHTTPExceptions.INVALID_CHUNK(str(e)) from e
+
+    return {"success": True, **upload}
+
+
+@attachments_endpoint.put("/uploads/{upload_id}/chunks/{index}")
+@route_cost(Cost.BULK_WRITE)
+async def upload_chunk(
+    request: Request,
+    upload_id: str,
+    index: int,
+    checksum: Optional[str] = Header(None, alias="X-Chunk-SHA256"),
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_write"]
+    ),
+):
+    user, _perms = auth_data
+    session = await get_session(request, upload_id, user)
+
+    # the body is never read into memory as a whole, it is written as it arrives
+    try:
+        await request.app.uploads.write_chunk(
+            upload_id, session, index, request.stream(), checksum
+        )
+    except InvalidChunk as e:
+        raise UCHTTPExceptions.INVALID_CHUNK(str(e)) from e
+    except UploadNotFound as e:
+        raise UCHTTPExceptions.KEY_NOT_FOUND(upload_id, "upload") from e
+
+    return {"success": True, "index": index}
+
+
+@attachments_endpoint.get("/uploads/{upload_id}")
+@route_cost(Cost.CACHED)
+async def get_upload(
+    request: Request,
+    upload_id: str,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_write"]
+    ),
+):
+    user, _perms = auth_data
+    session = await get_session(request, upload_id, user)
+
+    return {
+        "success": True,
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "chunks": session["chunks"],
+        "missing": await request.app.uploads.missing(upload_id, session),
+    }
+
+
+@attachments_endpoint.post("/uploads/{upload_id}/finalize")
+@route_cost(Cost.BULK_WRITE)
+async def finalize_upload(
+    request: Request,
+    upload_id: str,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_write"]
+    ),
+):
+    user, _perms = auth_data
+    session = await get_session(request, upload_id, user)
+
+    try:
+        digest = await request.app.uploads.finalize(upload_id, session)
+    except UploadIncomplete as e:
+        raise UCHTTPExceptions.UPLOAD_INCOMPLETE(e.missing) from e
+    except InvalidChunk as e:
+        raise UCHTTPExceptions.INVALID_CHUNK(str(e)) from e
+    except UploadNotFound as e:
+        raise UCHTTPExceptions.KEY_NOT_FOUND(upload_id, "upload") from e
+
+    return {"success": True, "sha256": digest, "size": session["size"]}
+
+
+@attachments_endpoint.get("/{digest}")
+@route_cost(Cost.DB_READ)
+async def download_attachment(
+    request: Request,
+    digest: str,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_read"]
+    ),
+):
+    if not is_digest(digest):
+        raise UCHTTPExceptions.KEY_NOT_FOUND(digest, "attachment")
+
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    path = blob_store.path(digest)
+    try:
+        size = (await asyncio.to_thread(os.stat, path)).st_size
+    except FileNotFoundError as e:
+        raise UCHTTPExceptions.KEY_NOT_FOUND(digest, "attachment") from e
+
+    try:
+        byte_range = parse_range(request.headers.get("Range"), size)
+    except ValueError as e:
+        return Response(status_code=416, headers={"Content-Range": str(e)})
+
+    return RangedFileResponse(path, size, byte_range, headers=headers)
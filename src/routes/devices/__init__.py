@@ -0,0 +1,3 @@
+__all__ = ["inbox_endpoint"]
+
+from .inbox import inbox_endpoint
@@ -0,0 +1,142 @@
+""" (module)
+Code for the endpoints to register devices and to send to and collect from their inboxes
+
+A device collects what was sent while it was offline by reading its inbox in big pages,
+following the last id of each page, and acking the last id it has stored.
+Acks are cumulative so one ack per page is enough
+"""
+
+__all__ = ["inbox_endpoint"]
+
+from typing import Final
+
+from pydantic import conlist
+from fastapi import APIRouter, Request, Security, Query
+
+from core import (
+    User,
+    Device,
+    Permissions,
+    InboxEnvelope,
+    generate_id,
+    user_channel,
+    check_auth_token,
+    UCHTTPExceptions,
+    route_cost,
+    Cost,
+)
+from core.db.inbox import parse_entry_id
+
+MAX_BULK_ENVELOPES: Final = 1000
+
+inbox_endpoint = APIRouter(
+    tags=[
+        "Devices",
+    ],
+    prefix="/api/v1/devices",
+)
+
+
+async def check_device_owner(device_id: int, user: User) -> None:
+    if not await Device.exists(id=device_id, owner_id=user.id):
+        raise UCHTTPExceptions.KEY_NOT_FOUND(device_id, "device")
+
+
+def check_entry_id(entry_id: str) -> None:
+    try:
+        parse_entry_id(entry_id)
+    except ValueError as e:
+        raise UCHTTPExceptions.INVALID_CURSOR from e
+
+
+@inbox_endpoint.post("/")
+@route_cost(Cost.DB_WRITE)
+async def register_device(
+    request: Request,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["user_write"]
+    ),
+):
+    user, _perms = auth_data
+    device = await Device.create(id=generate_id("DEVICE_ID"), owner_id=user.id)
+
+    return {"success": True, "device_id": str(device.id)}
+
+
+@inbox_endpoint.post("/inbox")
+@route_cost(Cost.BULK_WRITE)
+async def send_to_devices(
+    request: Request,
+    envelopes: conlist(InboxEnvelope, min_items=1, max_items=MAX_BULK_ENVELOPES),  # type: ignore
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_write"]
+    ),
+):
+    user, _perms = auth_data
+
+    device_ids = {envelope.device_id for envelope in envelopes}
+    owners = dict(await Device.filter(id__in=device_ids).values_list("id", "owner_id"))
+
+    await request.app.inbox.push(
+        [
+            (envelope.device_id, user.id, envelope.envelope)
+            for envelope in envelopes
+            if envelope.device_id in owners
+        ]
+    )
+
+    # devices that are online fetch their inbox when told something arrived
+    await request.app.gateway.publish_many(
+        [
+            (user_channel(owner_id), {"op": "inbox", "device_id": str(device_id)})
+            for device_id, owner_id in owners.items()
+        ]
+    )
+
+    return {
+        "success": True,
+        "unknown_devices": [
+            str(device_id) for device_id in device_ids if device_id not in owners
+        ],
+    }
+
+
+@inbox_endpoint.get("/{device_id}/inbox")
+@route_cost(Cost.DB_READ)
+async def read_inbox(
+    request: Request,
+    device_id: int,
+    after: str = "0-0",
+    limit: int = Query(1000, ge=1, le=5000),
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_read"]
+    ),
+):
+    user, _perms = auth_data
+    check_entry_id(after)
+    await check_device_owner(device_id, user)
+
+    entries = await request.app.inbox.read(device_id, after, limit)
+    return {
+        "success": True,
+        "entries": entries,
+        "last_id": entries[-1]["id"] if entries else after,
+    }
+
+
+@inbox_endpoint.post("/{device_id}/inbox/ack")
+@route_cost(Cost.DB_WRITE)
+async def ack_inbox(
+    request: Request,
+    device_id: int,
+    up_to: str,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_read"]
+    ),
+):
+    user, _perms = auth_data
+    check_entry_id(up_to)
+    await check_device_owner(device_id, user)
+
+    await request.app.inbox.ack(device_id, up_to)
+    return {"success": True, "detail": f"Acknowledged everything up to {up_to}"}
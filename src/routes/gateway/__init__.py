@@ -0,0 +1,3 @@
+__all__ = ["gateway_endpoint"]
+
+from .websocket import gateway_endpoint
@@ -0,0 +1,215 @@
+""" (module)
+Code for the websocket gateway that delivers messages in real time
+
+Protocol (json text frames, every frame has an "op"):
+    server -> hello {heartbeat_interval}
+    client -> identify {token}  (an access token with the message:read scope)
+    server -> ready {user_id}
+    client -> heartbeat              server -> heartbeat_ack
+    client -> message {room_id, envelope, nonce?}
+    server -> message_ack {nonce, id}  and  message {id, room_id, author_id, envelope} to the room
+    server -> inbox {device_id}  when envelopes were queued for one of the user's devices
+    client -> typing {room_id}       server -> typing {room_id, user_id} to the room, never stored
+"""
+
+__all__ = ["gateway_endpoint"]
+
+import json
+import time
+import asyncio
+from typing import Final
+
+from fastapi import (
+    APIRouter,
+    Depends,
+    Request,
+    WebSocket,
+    WebSocketDisconnect,
+    HTTPException,
+)
+from fastapi.websockets import WebSocketState
+
+from core import (
+    Gateway,
+    GatewayConnection,
+    authenticate,
+    require_admin,
+    generate_id,
+    room_channel,
+    route_cost,
+    Cost,
+)
+from core.db.rooms import get_rooms
+from core.models.messages import MAX_ENVELOPE_SIZE
+
+HEARTBEAT_INTERVAL: Final = 30  # seconds
+IDENTIFY_TIMEOUT: Final = 10  # seconds
+TYPING_INTERVAL: Final = 3  # seconds between typing events per room per connection
+
+# close codes
+CLOSE_AUTHENTICATION_FAILED: Final = 4001
+CLOSE_HEARTBEAT_TIMEOUT: Final = 4009
+
+gateway_endpoint = APIRouter(
+    tags=[
+        "Gateway",
+    ],
+    prefix="/api/v1/gateway",
+)
+
+
+async def identify(websocket: WebSocket):
+    """
+    Waits for the identify frame and authenticates the token in it, this only happens once per connection
+
+    Returns:
+        tuple[User, Permissions] | None: The authenticated user and perms or None if identifying failed
+    """
+
+    try:
+        frame = json.loads(
+            await asyncio.wait_for(websocket.receive_text(), IDENTIFY_TIMEOUT)
+        )
+        if frame.get("op") != "identify":
+            return None
+        return await authenticate(str(frame.get("token")), ["message_read"])
+    except (
+        asyncio.TimeoutError,
+        ValueError,
+        AttributeError,
+        HTTPException,
+        WebSocketDisconnect,
+    ):
+        return None
+
+
+async def send_message(gateway: Gateway, connection: GatewayConnection, frame: dict):
+    if not connection.perms.message_write:
+        return gateway.send(
+            connection, {"op": "error", "detail": "Missing scope message:write"}
+        )
+
+    try:
+        room_id = int(frame["room_id"])
+        envelope = frame["envelope"]
+    except (KeyError, TypeError, ValueError):
+        return gateway.send(connection, {"op": "error", "detail": "Invalid message"})
+
+    if not isinstance(envelope, str) or len(envelope) > MAX_ENVELOPE_SIZE:
+        return gateway.send(connection, {"op": "error", "detail": "Invalid envelope"})
+
+    # membership comes from the rooms loaded at identify, no db lookup per message
+    if room_channel(room_id) not in connection.channels:
+        return gateway.send(
+            connection, {"op": "error", "detail": "Not a member of this room"}
+        )
+
+    message_id = generate_id("MESSAGE_ID")
+    # waits for the batch the message is in to be saved, so an ack means it is stored
+    try:
+        await connection.websocket.app.messages.append(
+            message_id, room_id, connection.user.id, envelope
+        )
+    except Exception:
+        return gateway.send(
+            connection,
+            {
+                "op": "error",
+                "detail": "Failed to save message",
+                "nonce": frame.get("nonce"),
+            },
+        )
+
+    await gateway.publish(
+        room_channel(room_id),
+        {
+            "op": "message",
+            "id": str(message_id),
+            "room_id": str(room_id),
+            "author_id": str(connection.user.id),
+            "envelope": envelope,
+        },
+    )
+    gateway.send(
+        connection,
+        {"op": "message_ack", "nonce": frame.get("nonce"), "id": str(message_id)},
+    )
+
+
+async def send_typing(gateway: Gateway, connection: GatewayConnection, frame: dict):
+    try:
+        room_id = int(frame["room_id"])
+    except (KeyError, TypeError, ValueError):
+        return gateway.send(connection, {"op": "error", "detail": "Invalid room"})
+
+    if room_channel(room_id) not in connection.channels:
+        return gateway.send(
+            connection, {"op": "error", "detail": "Not a member of this room"}
+        )
+
+    # clients send this on every key press, the room only needs to hear it every few seconds
+    now = time.monotonic()
+    if now - connection.typing.get(room_id, 0.0) < TYPING_INTERVAL:
+        return
+    connection.typing[room_id] = now
+
+    await gateway.publish(
+        room_channel(room_id),
+        {"op": "typing", "room_id": str(room_id), "user_id": str(connection.user.id)},
+    )
+
+
+@gateway_endpoint.websocket("/")
+async def gateway_connection(websocket: WebSocket):
+    gateway: Gateway = websocket.app.gateway
+
+    await websocket.accept()
+    await websocket.send_json({"op": "hello", "heartbeat_interval": HEARTBEAT_INTERVAL})
+
+    auth_data = await identify(websocket)
+    if auth_data is None:
+        # a client that hung up before identifying has nothing left to close
+        if websocket.client_state != WebSocketState.DISCONNECTED:
+            await websocket.close(code=CLOSE_AUTHENTICATION_FAILED)
+        return
+
+    user, perms = auth_data
+    rooms = await get_rooms(user.id)
+    connection = await gateway.connect(websocket, user, perms, rooms)
+    gateway.send(connection, {"op": "ready", "user_id": str(user.id)})
+    websocket.app.presence.beat(user.id)
+
+    try:
+        while True:
+            # a client that misses heartbeats gets disconnected
+            raw = await asyncio.wait_for(
+                websocket.receive_text(), HEARTBEAT_INTERVAL * 1.5
+            )
+            try:
+                frame = json.loads(raw)
+                op = frame.get("op")
+            except (ValueError, AttributeError):
+                gateway.send(connection, {"op": "error", "detail": "Invalid frame"})
+                continue
+
+            if op == "heartbeat":
+                websocket.app.presence.beat(user.id)
+                gateway.send(connection, {"op": "heartbeat_ack"})
+            elif op == "typing":
+                await send_typing(gateway, connection, frame)
+            elif op == "message":
+                await send_message(gateway, connection, frame)
+            else:
+                gateway.send(connection, {"op": "error", "detail": f"Unknown op: {op}"})
+    except asyncio.TimeoutError:
+        await websocket.close(code=CLOSE_HEARTBEAT_TIMEOUT)
+    except WebSocketDisconnect:
+        pass
+    finally:
+        await gateway.disconnect(connection)
+
+
+@gateway_endpoint.get("/stats", dependencies=[Depends(require_admin)])
+@route_cost(Cost.CACHED)
+async def gateway_stats(request: Request):
+    return {"success": True, "stats": request.app.gateway.stats()}
@@ -1,2 +1,10 @@
-__all__ = ("BannedUserMiddleware",)
+__all__ = (
+    "BannedUserMiddleware",
+    "DatabasePinningMiddleware",
+    "LoadSheddingMiddleware",
+    "ProfilingMiddleware",
+)
 from .banned import BannedUserMiddleware
+from .pinning import DatabasePinningMiddleware
+from .shedding import LoadSheddingMiddleware
+from .profiling import ProfilingMiddleware
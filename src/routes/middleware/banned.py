@@ -1,25 +1,24 @@
-from cache import AsyncLRU
-from fastapi import Request
+from fastapi import Request, HTTPException
 from starlette.middleware.base import BaseHTTPMiddleware
 
-from core import BlacklistedIP, user_is_banned
-
-
-@AsyncLRU(maxsize=128)
-async def check_if_banned(ip: str):
-    return await BlacklistedIP.exists(ip=ip)
+from core import user_is_banned, client_ip, server_overloaded
 
 
 class BannedUserMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
-        ip = request.headers.get("X-Forwarded-For")
+        ip = client_ip(request)
 
         if ip is None:
             return await call_next(request)
 
-        ip = ip.split(" ")[0]
+        # cached per worker, refreshed on every worker when the blocklist is imported
+        # exceptions raised here skip the exception handlers, so the 503 is built by hand
+        try:
+            banned = await request.app.bans.is_banned(ip)
+        except HTTPException:
+            return server_overloaded(1)
 
-        if await check_if_banned(ip):
+        if banned:
             return await user_is_banned(request)
 
         return await call_next(request)
@@ -0,0 +1,14 @@
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from core.db.routing import RequestScope, request_scope
+
+
+class DatabasePinningMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        token = request_scope.set(RequestScope())
+
+        try:
+            return await call_next(request)
+        finally:
+            request_scope.reset(token)
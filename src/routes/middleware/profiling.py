@@ -0,0 +1,47 @@
+import os
+import time
+import asyncio
+import itertools
+from os.path import join
+
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from core import is_admin, profile_dir
+
+profile_ids = itertools.count()
+
+
+def should_profile(request: Request) -> bool:
+    # PROFILE_REQUESTS profiles everything, only turn it on for a worker you are debugging
+    if os.environ.get("PROFILE_REQUESTS", "false").lower() == "true":
+        return True
+
+    return "X-Profile" in request.headers and is_admin(request)
+
+
+def write_profile(name: str, folded: str) -> None:
+    os.makedirs(profile_dir(), exist_ok=True)
+    with open(join(profile_dir(), name), "w") as f:
+        f.write(folded)
+
+
+class ProfilingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        if not should_profile(request):
+            return await call_next(request)
+
+        profiler = request.app.profiler
+        profile_id = next(profile_ids)
+        profiler.begin(profile_id)
+        try:
+            response = await call_next(request)
+        finally:
+            folded = profiler.end(profile_id)
+
+        # render with flamegraph.pl or drop it into speedscope.app
+        name = f"{int(time.time())}-{os.getpid()}-{profile_id}.folded"
+        await asyncio.to_thread(write_profile, name, folded)
+
+        response.headers["X-Profile-File"] = name
+        return response
@@ -0,0 +1,57 @@
+import time
+from typing import Final
+
+from fastapi import Request
+from starlette.middleware.base import BaseHTTPMiddleware
+
+from core import Priority, server_overloaded
+
+# (method, path prefix, priority), the first match wins. None matches any method
+ROUTE_PRIORITIES: Final = [
+    ("POST", "/api/v1/auth/token", Priority.LOW),  # argon2
+    ("POST", "/api/v1/users/", Priority.LOW),  # argon2 + db + amqp
+    ("PUT", "/api/v1/users/@me/avatar", Priority.LOW),  # image processing
+    ("PUT", "/api/v1/attachments/uploads", Priority.LOW),  # disk writes, retryable
+    (None, "/api/v1/admin/blocklists", Priority.LOW),  # bulk loads and dumps
+    (None, "/api/v1/rooms", Priority.CRITICAL),
+    (None, "/api/v1/keys", Priority.CRITICAL),
+    (None, "/api/v1/users/@me", Priority.CRITICAL),
+    (None, "/api/v1/auth/refresh", Priority.CRITICAL),
+    (None, "/api/v1/status", Priority.CRITICAL),
+]
+
+# routes that take as long as the client takes to send (or read) the body, their latency
+# says nothing about how loaded the server is so it isn't fed to the controller
+UNMEASURED_ROUTES: Final = [
+    ("PUT", "/api/v1/attachments/uploads"),
+    ("POST", "/api/v1/admin/blocklists"),
+    ("GET", "/api/v1/admin/blocklists"),
+]
+
+
+def route_priority(method: str, path: str) -> Priority:
+    for route_method, prefix, priority in ROUTE_PRIORITIES:
+        if (route_method is None or route_method == method) and path.startswith(prefix):
+            return priority
+
+    return Priority.NORMAL
+
+
+class LoadSheddingMiddleware(BaseHTTPMiddleware):
+    async def dispatch(self, request: Request, call_next):
+        admission = request.app.admission
+        priority = route_priority(request.method, request.url.path)
+
+        if not admission.try_acquire(priority):
+            return server_overloaded(admission.retry_after(priority))
+
+        measure = not any(
+            request.method == method and request.url.path.startswith(prefix)
+            for method, prefix in UNMEASURED_ROUTES
+        )
+
+        started = time.perf_counter()
+        try:
+            return await call_next(request)
+        finally:
+            admission.release(started, measure)
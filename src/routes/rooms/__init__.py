@@ -0,0 +1,4 @@
+__all__ = ["messages_endpoint", "members_endpoint"]
+
+from .members import members_endpoint
+from .messages import messages_endpoint
@@ -0,0 +1,165 @@
+""" (module)
+Code for the endpoints to create rooms and manage who is in them
+"""
+
+__all__ = ["members_endpoint"]
+
+from typing import Final
+
+from pydantic import BaseModel, conlist
+from fastapi import APIRouter, Request, Security
+
+from core import (
+    User,
+    Permissions,
+    generate_id,
+    user_channel,
+    check_auth_token,
+    UCHTTPExceptions,
+    route_cost,
+    Cost,
+)
+from core.db.rooms import (
+    add_members,
+    remove_members,
+    get_members,
+    get_rooms,
+    get_role,
+    is_member,
+)
+
+MAX_BULK_MEMBERS: Final = 1000
+ADMIN_ROLES: Final = ("owner", "admin")
+
+members_endpoint = APIRouter(
+    tags=[
+        "Rooms",
+    ],
+    prefix="/api/v1/rooms",
+)
+
+
+class MemberList(BaseModel):
+    user_ids: conlist(int, min_items=1, max_items=MAX_BULK_MEMBERS)  # type: ignore
+
+
+async def notify_members(request: Request, op: str, room_id: int, user_ids: list[int]):
+    """Tell the gateway connections of the users that they joined or left a room"""
+
+    await request.app.gateway.publish_many(
+        [
+            (user_channel(user_id), {"op": op, "room_id": str(room_id)})
+            for user_id in user_ids
+        ]
+    )
+
+
+async def check_room_admin(room_id: int, user_id: int):
+    if await get_role(room_id, user_id) not in ADMIN_ROLES:
+        raise UCHTTPExceptions.NOT_ROOM_ADMIN(room_id)
+
+
+@members_endpoint.post("/")
+@route_cost(Cost.DB_WRITE)
+async def create_room(
+    request: Request,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["room_write"]
+    ),
+):
+    user, _perms = auth_data
+    room_id = generate_id("ROOM_ID")
+
+    await add_members(request.app.redis, room_id, [user.id], role="owner")
+    await notify_members(request, "room_added", room_id, [user.id])
+
+    return {"success": True, "room_id": str(room_id)}
+
+
+@members_endpoint.get("/@me")
+@route_cost(Cost.DB_READ)
+async def get_own_rooms(
+    request: Request,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["room_read"]
+    ),
+):
+    user, _perms = auth_data
+    rooms = await get_rooms(user.id)
+
+    return {"success": True, "rooms": [str(room_id) for room_id in rooms]}
+
+
+@members_endpoint.get("/{room_id}/members")
+@route_cost(Cost.DB_READ)
+async def get_room_members(
+    request: Request,
+    room_id: int,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["room_read"]
+    ),
+):
+    user, _perms = auth_data
+    members = await get_members(request.app.redis, room_id)
+    if user.id not in members:
+        raise UCHTTPExceptions.NOT_ROOM_MEMBER(room_id)
+
+    return {"success": True, "members": [str(member) for member in members]}
+
+
+@members_endpoint.get("/{room_id}/presence")
+@route_cost(Cost.CACHED)
+async def get_room_presence(
+    request: Request,
+    room_id: int,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["room_read"]
+    ),
+):
+    user, _perms = auth_data
+    if not await is_member(request.app.redis, room_id, user.id):
+        raise UCHTTPExceptions.NOT_ROOM_MEMBER(room_id)
+
+    online = await request.app.presence.online_members(room_id)
+    return {"success": True, "online": [str(user_id) for user_id in online]}
+
+
+@members_endpoint.post("/{room_id}/members")
+@route_cost(Cost.BULK_WRITE)
+async def add_room_members(
+    request: Request,
+    room_id: int,
+    data: MemberList,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["room_write"]
+    ),
+):
+    user, _perms = auth_data
+    await check_room_admin(room_id, user.id)
+
+    added = await add_members(request.app.redis, room_id, data.user_ids)
+    await notify_members(request, "room_added", room_id, added)
+
+    return {"success": True, "added": [str(user_id) for user_id in added]}
+
+
+@members_endpoint.delete("/{room_id}/members")
+@route_cost(Cost.BULK_WRITE)
+async def remove_room_members(
+    request: Request,
+    room_id: int,
+    data: MemberList,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["room_write"]
+    ),
+):
+    user, _perms = auth_data
+
+    # anyone can remove themselves, removing others needs admin
+    if data.user_ids != [user.id]:
+        await check_room_admin(room_id, user.id)
+
+    removed = await remove_members(request.app.redis, room_id, data.user_ids)
+    await notify_members(request, "room_removed", room_id, removed)
+
+    return {"success": True, "removed": [str(user_id) for user_id in removed]}
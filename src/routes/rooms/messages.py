@@ -0,0 +1,60 @@
+""" (module)
+Code for the endpoint to read a room's message history
+"""
+
+__all__ = ["messages_endpoint"]
+
+from typing import Optional
+
+from fastapi import APIRouter, Request, Security, Query
+
+from core import (
+    User,
+    Message,
+    Permissions,
+    check_auth_token,
+    UCHTTPExceptions,
+    route_cost,
+    Cost,
+)
+from core.db.rooms import is_member
+from core.db.messages import fetch_history
+
+messages_endpoint = APIRouter(
+    tags=[
+        "Messages",
+    ],
+    prefix="/api/v1/rooms",
+)
+
+
+@messages_endpoint.get("/{room_id}/messages")
+@route_cost(Cost.DB_READ)
+async def get_message_history(
+    request: Request,
+    room_id: int,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: int = Query(50, ge=1, le=100),
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["message_read"]
+    ),
+):
+    user, _perms = auth_data
+    if not await is_member(request.app.redis, room_id, user.id):
+        raise UCHTTPExceptions.NOT_ROOM_MEMBER(room_id)
+
+    messages = await fetch_history(room_id, before=before, after=after, limit=limit)
+
+    return {
+        "success": True,
+        "messages": [
+            Message(
+                id=str(message["id"]),
+                room_id=str(message["room_id"]),
+                author_id=str(message["author_id"]),
+                envelope=message["envelope"],
+            )
+            for message in messages
+        ],
+    }
@@ -0,0 +1,3 @@
+__all__ = ["status_endpoint"]
+
+from .status import status_endpoint
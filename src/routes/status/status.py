@@ -0,0 +1,43 @@
+""" (module)
+Code for the endpoint that reports the internal counters of this worker.
+Anyone can use it as a health check, the counters are only sent to admins
+"""
+
+__all__ = ["status_endpoint"]
+
+from fastapi import APIRouter, Request
+
+from core import user_flight, ban_flight, key_flight, is_admin, route_cost, Cost
+
+status_endpoint = APIRouter(
+    tags=[
+        "Status",
+    ],
+    prefix="/api/v1/status",
+)
+
+
+@status_endpoint.get("/")
+@route_cost(Cost.CACHED)
+async def get_status(request: Request):
+    # the counters and slow callback stack traces say too much about the internals
+    if not is_admin(request):
+        return {"success": True, "version": request.app.version}
+
+    return {
+        "success": True,
+        "version": request.app.version,
+        "gateway": request.app.gateway.stats(),
+        "admission": request.app.admission.stats(),
+        "event_loop": request.app.loop_monitor.stats(),
+        "key_directory": request.app.key_directory.stats(),
+        "availability": request.app.availability.stats(),
+        "inbox": request.app.inbox.stats(),
+        "uploads": request.app.uploads.stats(),
+        "presence": request.app.presence.stats(),
+        "bans": request.app.bans.stats(),
+        "singleflight": {
+            flight.name: flight.stats()
+            for flight in (user_flight, ban_flight, key_flight)
+        },
+    }
@@ -1,6 +1,15 @@
-__all__ = ["signup_endpoint", "authentication_endpoint", "keys_endpoint", "me_endpoint"]
+__all__ = [
+    "signup_endpoint",
+    "authentication_endpoint",
+    "keys_endpoint",
+    "me_endpoint",
+    "avatars_endpoint",
+    "search_endpoint",
+]
 
 from .me import me_endpoint
+from .avatars import avatars_endpoint
 from .keys import keys_endpoint
+from .search import search_endpoint
 from .signup import signup_endpoint
 from .authentication import authentication_endpoint
@@ -4,6 +4,9 @@ Code for the endpoint to handle authenticating a user and supplying them with an
 
 __all__ = ["authentication_endpoint"]
 
+import os
+import asyncio
+from typing import Final
 from datetime import timedelta
 
 from aioredis import Redis
@@ -18,8 +21,19 @@ from core import (
     argon2_verify,
     PasswordRequestForm,
     UCHTTPExceptions,
+    route_cost,
+    Cost,
 )
-from core.helpers.tokens import create_access_token, check_valid_token
+from core.helpers.tokens import create_access_token, decode_refresh_token
+from core.helpers.token_families import start_family, rotate_family, FAMILY_ROTATED
+from core.db.accounts import deleted_key
+
+ACCESS_TOKEN_LIFESPAN: Final = timedelta(minutes=15)
+REFRESH_TOKEN_LIFESPAN: Final = timedelta(days=32)
+
+# postgres only gets a copy of issued tokens when this is turned on
+TOKEN_AUDIT_LOG: Final = os.environ.get("TOKEN_AUDIT_LOG", "false").lower() == "true"
+audit_tasks: set[asyncio.Task] = set()
 
 authentication_endpoint = APIRouter(
     tags=[
@@ -33,51 +47,82 @@ class RefreshToken(BaseModel):
     refresh_token: str
 
 
-async def tok_gen(user_id: int, scopes: str, redis: Redis):
-    ACCESS_TOKEN_LIFESPAN = timedelta(minutes=15)
-    REFRESH_TOKEN_LIFESPAN = timedelta(days=32)
+async def audit_tokens(user_id: int, access_token_id: int, refresh_token_id: int):
+    await Token.bulk_create(
+        [
+            Token(token_id=access_token_id, token_type="AUTH", owner_id=user_id),
+            Token(token_id=refresh_token_id, token_type="REFRESH", owner_id=user_id),
+        ]
+    )
+
+
+async def create_tokens(
+    user_id: int,
+    scopes: str,
+    family_id: int,
+    access_token_id: int,
+    refresh_token_id: int,
+) -> AuthToken:
+    """
+    Creates the JWTs for a pair of token ids that have already been stored in redis
+    """
 
-    # Generate access token
-    access_token_id = generate_id("AUTH_TOK_ID")
     access_token = await create_access_token(
         data={"user_id": user_id, "scopes": scopes},
         token_id=access_token_id,
         expires_delta=ACCESS_TOKEN_LIFESPAN,
     )
-    await redis.set(str(access_token_id), user_id, ex=ACCESS_TOKEN_LIFESPAN.seconds)
-
-    # Revoke all other existing refresh tokens
-    await Token.filter(owner_id=user_id, token_type="REFRESH").delete()
-
-    # generate refresh token
-    refresh_token_id = generate_id("REFRESH_TOK_ID")
     refresh_token = await create_access_token(
-        data={"user_id": user_id, "scopes": scopes},
+        data={"user_id": user_id, "scopes": scopes, "fam": family_id},
         token_id=refresh_token_id,
         expires_delta=REFRESH_TOKEN_LIFESPAN,
     )
 
-    await Token.create(token_id=access_token_id, token_type="AUTH", owner_id=user_id)
-    await Token.create(
-        token_id=refresh_token_id, token_type="REFRESH", owner_id=user_id
-    )
+    # off the request path, a failed audit write doesn't fail the login
+    if TOKEN_AUDIT_LOG:
+        task = asyncio.create_task(
+            audit_tokens(user_id, access_token_id, refresh_token_id)
+        )
+        audit_tasks.add(task)
+        task.add_done_callback(audit_tasks.discard)
 
     return AuthToken(
         access_token=access_token,
         token_type="Bearer",
-        expiry_min=ACCESS_TOKEN_LIFESPAN.seconds // 60,
+        expiry_min=int(ACCESS_TOKEN_LIFESPAN.total_seconds()) // 60,
         refresh_token=refresh_token,
     )
 
 
+async def tok_gen(user_id: int, scopes: str, redis: Redis):
+    access_token_id = generate_id("AUTH_TOK_ID")
+    refresh_token_id = generate_id("REFRESH_TOK_ID")
+
+    # starts a new token family and revokes all other existing refresh tokens
+    family_id = await start_family(
+        redis,
+        user_id,
+        scopes,
+        refresh_token_id,
+        access_token_id,
+        int(REFRESH_TOKEN_LIFESPAN.total_seconds()),
+        int(ACCESS_TOKEN_LIFESPAN.total_seconds()),
+    )
+
+    return await create_tokens(
+        user_id, scopes, family_id, access_token_id, refresh_token_id
+    )
+
+
 @authentication_endpoint.post("/token", response_model=AuthToken)
+@route_cost(Cost.PASSWORD_HASH)
 async def login_for_token(request: Request, form_data: PasswordRequestForm = Depends()):
     username = form_data.username
     password: str = form_data.password.get_secret_value()  # type: ignore
     scopes = " ".join(form_data.scopes)
 
     # make sure a user with the given username exists
-    user = await User.filter(username=username).first()
+    user = await User.filter(username=username, deleted_at=None).first()
     if user is None:
         raise UCHTTPExceptions.FAILED_TO_LOGIN
 
@@ -90,11 +135,33 @@ async def login_for_token(request: Request, form_data: PasswordRequestForm = Dep
 
 
 @authentication_endpoint.post("/refresh", response_model=AuthToken)
+@route_cost(Cost.CACHED)
 async def refresh(request: Request, data: RefreshToken):
-    token_data = await check_valid_token(data.refresh_token)
-    user, scopes = token_data
+    payload = decode_refresh_token(data.refresh_token)
+    user_id, scopes, family_id = payload["user_id"], payload["scopes"], payload["fam"]
 
-    user_id = user.id
-    scopes = " ".join(scopes)
+    # a refresh racing the deletion could otherwise rotate a family before it is revoked
+    if await request.app.redis.exists(deleted_key(user_id)):
+        raise UCHTTPExceptions.INVALID_TOKEN_ERROR
 
-    return await tok_gen(user_id, scopes, request.app.redis)
+    access_token_id = generate_id("AUTH_TOK_ID")
+    refresh_token_id = generate_id("REFRESH_TOK_ID")
+
+    # one round trip: checks the token is the family's current one, rotates it and stores the access token
+    result = await rotate_family(
+        request.app.redis,
+        family_id,
+        payload["tok_id"],
+        refresh_token_id,
+        access_token_id,
+        user_id,
+        int(REFRESH_TOKEN_LIFESPAN.total_seconds()),
+        int(ACCESS_TOKEN_LIFESPAN.total_seconds()),
+    )
+    # expired, revoked or reused (which revokes the family)
+    if result != FAMILY_ROTATED:
+        raise UCHTTPExceptions.INVALID_TOKEN_ERROR
+
+    return await create_tokens(
+        user_id, scopes, family_id, access_token_id, refresh_token_id
+    )
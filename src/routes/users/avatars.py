@@ -0,0 +1,48 @@
+""" (module)
+Code for the endpoint to get avatars from the blob store
+"""
+
+__all__ = ["avatars_endpoint"]
+
+from typing import Final
+
+from fastapi import APIRouter, Request, Response
+from fastapi.responses import FileResponse
+
+from core import UCHTTPExceptions, route_cost, Cost
+from core.helpers.images import FORMATS
+from core.helpers.blobstore import blob_store, is_digest
+from core.helpers.conditional import etag_matches
+
+# blobs never change so they can be cached forever
+CACHE_CONTROL: Final = "public, max-age=31536000, immutable"
+MEDIA_TYPES: Final = {extension: f"image/{extension}" for extension in FORMATS.values()}
+
+avatars_endpoint = APIRouter(
+    tags=[
+        "Users",
+    ],
+    prefix="/api/v1/avatars",
+)
+
+
+@avatars_endpoint.get("/{name}")
+@route_cost(Cost.CACHED)
+async def get_avatar(request: Request, name: str):
+    digest, _, extension = name.partition(".")
+    if not is_digest(digest) or extension not in MEDIA_TYPES:
+        raise UCHTTPExceptions.KEY_NOT_FOUND(name, "avatar")
+
+    etag = f'"{digest}"'
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL}
+
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    if not blob_store.exists(digest):
+        raise UCHTTPExceptions.KEY_NOT_FOUND(name, "avatar")
+
+    # FileResponse streams the file with sendfile when the server supports it
+    return FileResponse(
+        blob_store.path(digest), media_type=MEDIA_TYPES[extension], headers=headers
+    )
@@ -7,19 +7,39 @@ __all__ = ["keys_endpoint"]
 from typing import Literal
 
 from pydantic import ValidationError
-from fastapi import APIRouter, Request, Security
+from fastapi import APIRouter, Request, Response, Security
 
+from core.helpers import PUBLIC_KEY_LENGTHS, SIGNATURE_LENGTHS
 from core import (
     User,
     check_auth_token,
     Permissions,
     UCHTTPExceptions,
     OneTimePreKeys,
-    SignedPreKeys,
     PreKeyBundle,
     KDCData,
     SignedPreKey,
     PreKey,
+    key_flight,
+    encode_key,
+    decode_key,
+    route_cost,
+    Cost,
+)
+from core.helpers.conditional import (
+    current_version,
+    bump_versions,
+    make_etag,
+    etag_matches,
+    not_modified,
+    etag_headers,
+)
+from core.db.keys import (
+    consume_prekey,
+    add_prekeys,
+    rotate_signed_prekey,
+    prekey_stock,
+    adjust_prekey_stock,
 )
 
 keys_endpoint = APIRouter(
@@ -31,6 +51,7 @@ keys_endpoint = APIRouter(
 
 
 @keys_endpoint.post("/")
+@route_cost(Cost.BULK_WRITE)
 async def post_user_keys(
     request: Request,
     kdc_data: KDCData,
@@ -39,28 +60,41 @@ async def post_user_keys(
     ),
 ):
     user, _perms = auth_data
+    # KDCData already checked the keys decode, they are stored as raw bytes
 
     # save identity key
-    await user.update_from_dict({"identity_key": kdc_data.identity_key}).save()
-
-    # save signed pre keys
-    await SignedPreKeys.create(
-        id=kdc_data.signed_prekey.key_id,
-        public_key=kdc_data.signed_prekey.public_key,
-        signature=kdc_data.signed_prekey.signature,
-        owner_id=user.id,
+    identity_key = decode_key(kdc_data.identity_key, PUBLIC_KEY_LENGTHS)
+    await user.update_from_dict({"identity_key": identity_key}).save()
+    await bump_versions(request.app.redis, "user", [user.id])
+
+    # save signed pre key, replacing the current one if there is one
+    await rotate_signed_prekey(
+        user.id,
+        kdc_data.signed_prekey.key_id,
+        decode_key(kdc_data.signed_prekey.public_key, PUBLIC_KEY_LENGTHS),
+        decode_key(kdc_data.signed_prekey.signature, SIGNATURE_LENGTHS),
     )
 
+    await request.app.key_directory.invalidate(user.id)
+
     # save all the one time pre keys
-    for prekey in kdc_data.pre_keys:
-        await OneTimePreKeys.create(
-            id=prekey.key_id, public_key=prekey.public_key, owner_id=user.id
-        )
+    await add_prekeys(
+        request.app.redis,
+        user.id,
+        [
+            (prekey.key_id, decode_key(prekey.public_key, PUBLIC_KEY_LENGTHS))
+            for prekey in kdc_data.pre_keys
+        ],
+    )
+    await bump_versions(
+        request.app.redis, "prekey", (prekey.key_id for prekey in kdc_data.pre_keys)
+    )
 
     return {"success": True, "detail": "all keys saved!"}
 
 
 @keys_endpoint.patch("/")
+@route_cost(Cost.DB_WRITE)
 async def update_user_keys(
     request: Request,
     key_type: Literal["identity_key"] | Literal["signed_prekey"],
@@ -72,25 +106,35 @@ async def update_user_keys(
     user, _perms = auth_data
 
     if key_type == "identity_key" and isinstance(new_data, str):
-        await user.update_from_dict({"identity_key": new_data}).save()
+        try:
+            identity_key = decode_key(new_data, PUBLIC_KEY_LENGTHS)
+        except ValueError as e:
+            raise UCHTTPExceptions.INVALID_IDENTITY_KEY(str(e)) from e
+
+        await user.update_from_dict({"identity_key": identity_key}).save()
+        await bump_versions(request.app.redis, "user", [user.id])
     elif key_type == "signed_prekey" and isinstance(new_data, dict):
         try:
             data = SignedPreKey(**new_data)  # type: ignore
-            await SignedPreKeys.create(
-                id=data.key_id,
-                public_key=data.public_key,
-                signature=data.signature,
-                owner_id=user.id,
-            )
         except ValidationError as e:
             raise UCHTTPExceptions.INVALID_SIGNED_KEY from e
 
+        await rotate_signed_prekey(
+            user.id,
+            data.key_id,
+            decode_key(data.public_key, PUBLIC_KEY_LENGTHS),
+            decode_key(data.signature, SIGNATURE_LENGTHS),
+        )
+
     else:
         raise UCHTTPExceptions.INVALID_KEY_TYPE(key_type)
+
+    await request.app.key_directory.invalidate(user.id)
     return {"success": True, "detail": f"Updated {key_type} successfully!"}
 
 
 @keys_endpoint.get("/bundle")
+@route_cost(Cost.DB_WRITE)
 async def get_user_keys(
     request: Request,
     user_id: int,
@@ -98,52 +142,64 @@ async def get_user_keys(
         check_auth_token, scopes=["keys_read"]
     ),
 ):
-    key_owner = await User.filter(id=user_id).first()
-    signed_prekey = await SignedPreKeys.filter(owner_id=user_id).first()
-    prekey = await OneTimePreKeys.filter(owner_id=user_id).first()
-
-    if signed_prekey is None or key_owner is None or prekey is None:
+    # the identity key and signed prekey come from the key directory cache,
+    # taking the one time prekey is the only database query
+    keys = await request.app.key_directory.get(user_id)
+    if keys is None or keys["identity_key"] is None or keys["signed_prekey"] is None:
         raise UCHTTPExceptions.PRE_KEY_BUNDLE_FETCH_ERROR
 
-    identity_key = key_owner.identity_key
-    signed_pre_key = SignedPreKey(
-        key_id=signed_prekey.id,
-        public_key=signed_prekey.public_key,
-        signature=signed_prekey.signature,
-    )
-
-    pre_key = PreKey(key_id=prekey.id, public_key=prekey.public_key)
+    prekey = await consume_prekey(user_id)
+    if prekey is None:
+        raise UCHTTPExceptions.PRE_KEY_BUNDLE_FETCH_ERROR
+    await adjust_prekey_stock(request.app.redis, user_id, -1)
+    await bump_versions(request.app.redis, "prekey", [prekey["id"]])
 
+    # built without validation, the keys come from the database and the prekey is already taken,
+    # a key that doesn't pass the validators would otherwise throw it away with a 500
     return {
         "success": True,
-        "bundle": PreKeyBundle(
+        "bundle": PreKeyBundle.construct(
             user_id=str(user_id),
-            identity_key=identity_key,
-            signed_prekey=signed_pre_key,
-            pre_key=pre_key,
+            identity_key=keys["identity_key"],
+            signed_prekey=SignedPreKey.construct(**keys["signed_prekey"]),
+            pre_key=PreKey.construct(
+                key_id=prekey["id"], public_key=prekey["public_key"]
+            ),
         ),
     }
 
 
 @keys_endpoint.get("/prekeys")
+@route_cost(Cost.DB_READ)
 async def get_user_prekey(
     request: Request,
+    response: Response,
     key_id: int,
     auth_data: tuple[User, Permissions] = Security(
         check_auth_token, scopes=["keys_read"]
     ),
 ):
-    prekey = await OneTimePreKeys.filter(id=key_id).first()
+    # prekeys never change, the version moves when one is created or taken
+    version = await current_version(request.app.redis, "prekey", key_id)
+    etag = make_etag("prekey", version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    prekey = await key_flight.do(
+        ("prekey", key_id), OneTimePreKeys.filter(id=key_id).first
+    )
     if prekey is None:
         raise UCHTTPExceptions.KEY_NOT_FOUND(key_id, "prekey")
 
+    response.headers.update(etag_headers(etag))
     return {
         "success": True,
-        "prekey": {"id": str(prekey.id), "public_key": prekey.public_key},
+        "prekey": {"id": str(prekey.id), "public_key": encode_key(prekey.public_key)},
     }
 
 
 @keys_endpoint.post("/prekeys")
+@route_cost(Cost.BULK_WRITE)
 async def create_new_prekeys(
     request: Request,
     prekeys: list[PreKey],
@@ -152,15 +208,34 @@ async def create_new_prekeys(
     ),
 ):
     user, _perms = auth_data
-    for prekey in prekeys:
-        await OneTimePreKeys.create(
-            id=prekey.key_id, public_key=prekey.public_key, owner_id=user.id
-        )
+    remaining = await add_prekeys(
+        request.app.redis,
+        user.id,
+        [
+            (prekey.key_id, decode_key(prekey.public_key, PUBLIC_KEY_LENGTHS))
+            for prekey in prekeys
+        ],
+    )
+    await bump_versions(
+        request.app.redis, "prekey", (prekey.key_id for prekey in prekeys)
+    )
+    return {"success": True, "detail": "All prekeys saved!", "remaining": remaining}
 
-    return {"success": True, "detail": "All prekeys saved!"}
+
+@keys_endpoint.get("/prekeys/count")
+@route_cost(Cost.CACHED)
+async def get_prekey_count(
+    request: Request,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["keys_read"]
+    ),
+):
+    user, _perms = auth_data
+    return {"success": True, "count": await prekey_stock(request.app.redis, user.id)}
 
 
 @keys_endpoint.delete("/prekeys")
+@route_cost(Cost.DB_WRITE)
 async def delete_prekeys(
     request: Request,
     key_id: int,
@@ -168,9 +243,14 @@ async def delete_prekeys(
         check_auth_token, scopes=["keys_write"]
     ),
 ):
-    prekey = await OneTimePreKeys.filter(id=key_id).first()
+    user, _perms = auth_data
+
+    # only the owner can delete their prekeys
+    prekey = await OneTimePreKeys.filter(id=key_id, owner_id=user.id).first()
     if prekey is None:
         raise UCHTTPExceptions.KEY_NOT_FOUND(key_id, "prekey")
 
     await prekey.delete()
+    await adjust_prekey_stock(request.app.redis, user.id, -1)
+    await bump_versions(request.app.redis, "prekey", [key_id])
     return {"success": True, "detail": "Prekey has been successfully deleted!"}
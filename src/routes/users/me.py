@@ -1,12 +1,37 @@
 """ (module)
-Code for the endpoint to get data about the authorized user
+Code for the endpoints to get data about the authorized user, upload their avatar and delete their account
 """
 
 __all__ = ["me_endpoint"]
 
-from fastapi import APIRouter, Request, Security
+from typing import Final
 
-from core import User, check_auth_token, Permissions
+from tortoise import connections
+from fastapi import APIRouter, Request, Response, Security, UploadFile, File
+
+from core import (
+    User,
+    user_cache,
+    check_auth_token,
+    Permissions,
+    UCHTTPExceptions,
+    route_cost,
+    Cost,
+)
+from core.helpers.avatars import AVATAR_FORMAT, save_avatar
+from core.helpers.images import InvalidImage, process_avatar_async
+from core.helpers.conditional import (
+    current_version,
+    bump_versions,
+    make_etag,
+    etag_matches,
+    not_modified,
+    etag_headers,
+)
+from core.db.accounts import mark_deleted
+
+MAX_UPLOAD_BYTES: Final = 10 * 1024 * 1024
+READ_CHUNK_SIZE: Final = 64 * 1024
 
 me_endpoint = APIRouter(
     tags=[
@@ -17,11 +42,91 @@ me_endpoint = APIRouter(
 
 
 @me_endpoint.get("/")
+@route_cost(Cost.CACHED)
 async def get_self(
     request: Request,
+    response: Response,
     auth_data: tuple[User, Permissions] = Security(
         check_auth_token, scopes=["user_read"]
     ),
 ):
     user, _ = auth_data
+
+    # polling clients that are up to date cost one redis round trip
+    version = await current_version(request.app.redis, "user", user.id)
+    etag = make_etag("user", version)
+    if etag_matches(request, etag):
+        return not_modified(etag)
+
+    # the cached user may be older than the version, it is read again and recached.
+    # from the primary, a lagging replica could serve data from before the write under the new etag
+    fresh = (
+        await User.filter(id=user.id, deleted_at=None)
+        .using_db(connections.get("default"))
+        .first()
+    )
+    if fresh is not None:
+        user = fresh
+        user_cache.set(user.id, user)
+
+    response.headers.update(etag_headers(etag))
     return {"success": True, "user": await user.to_pydantic()}
+
+
+@me_endpoint.delete("/")
+@route_cost(Cost.DB_WRITE)
+async def delete_self(
+    request: Request,
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["user_delete"]
+    ),
+):
+    user, _ = auth_data
+
+    # the account stops working now, what it owns is purged in the background
+    await mark_deleted(request.app.redis, user.id)
+    user_cache.evict(user.id)
+    return {"success": True}
+
+
+async def read_upload(upload: UploadFile, max_bytes: int) -> bytes:
+    """
+    Read an uploaded file, stopping as soon as it goes over max_bytes
+
+    Raises:
+        UploadTooLarge: If the file is bigger than max_bytes
+    """
+
+    chunks, size = [], 0
+    while chunk := await upload.read(READ_CHUNK_SIZE):
+        size += len(chunk)
+        if size > max_bytes:
+            raise UCHTTPExceptions.UPLOAD_TOO_LARGE(max_bytes)
+        chunks.append(chunk)
+
+    return b"".join(chunks)
+
+
+@me_endpoint.put("/avatar")
+@route_cost(Cost.IMAGE)
+async def upload_avatar(
+    request: Request,
+    avatar: UploadFile = File(...),
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["user_write"]
+    ),
+):
+    user, _ = auth_data
+    data = await read_upload(avatar, MAX_UPLOAD_BYTES)
+
+    # decoding and encoding happen in the process pool
+    try:
+        outputs = await process_avatar_async(data, AVATAR_FORMAT)
+    except InvalidImage as e:
+        raise UCHTTPExceptions.INVALID_AVATAR from e
+
+    avatar = await save_avatar(outputs)
+    await user.update_from_dict({"avatar": avatar}).save()
+    await bump_versions(request.app.redis, "user", [user.id])
+
+    return {"success": True, "avatar": avatar}
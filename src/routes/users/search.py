@@ -0,0 +1,48 @@
+""" (module)
+Code for the endpoint to find other users by the start of their username
+"""
+
+__all__ = ["search_endpoint"]
+
+from typing import Optional
+
+from fastapi import APIRouter, Request, Security, Query
+
+from core import (
+    User,
+    check_auth_token,
+    Permissions,
+    UCHTTPExceptions,
+    route_cost,
+    Cost,
+)
+from core.db.usernames import search_users, parse_cursor, SEARCH_PREFIX
+
+search_endpoint = APIRouter(
+    tags=[
+        "Users",
+    ],
+    prefix="/api/v1/users",
+)
+
+
+@search_endpoint.get("/search")
+@route_cost(Cost.DB_READ)
+async def search_usernames(
+    request: Request,
+    prefix: str = Query(..., regex=SEARCH_PREFIX.pattern),
+    cursor: Optional[str] = None,
+    limit: int = Query(20, ge=1, le=50),
+    auth_data: tuple[User, Permissions] = Security(
+        check_auth_token, scopes=["users_read"]
+    ),
+):
+    after = None
+    if cursor is not None:
+        try:
+            after = parse_cursor(cursor)
+        except ValueError as e:
+            raise UCHTTPExceptions.INVALID_CURSOR from e
+
+    users, next_cursor = await search_users(prefix, limit, after)
+    return {"success": True, "users": users, "next_cursor": next_cursor}
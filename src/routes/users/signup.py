@@ -5,18 +5,22 @@ Code for the endpoint to signup/create a new user
 __all__ = ["signup_endpoint"]
 
 from fastapi import APIRouter, Request
+from tortoise.transactions import in_transaction
 from tortoise.exceptions import IntegrityError, ValidationError
 
-from rmq import send_to_channel
 from core import (
     User,
+    OutboxEvent,
     limiter,
+    route_cost,
+    Cost,
     user_cache,
     generate_id,
     NewUserForm,
     UCHTTPExceptions,
 )
 from core.helpers.tokens import create_access_token, check_valid_token
+from core.helpers.conditional import bump_versions
 
 signup_endpoint = APIRouter(
     tags=[
@@ -28,15 +32,40 @@ signup_endpoint = APIRouter(
 
 @signup_endpoint.post("/")
 @limiter.limit("1/hour")
+@route_cost(Cost.PASSWORD_HASH + Cost.DB_WRITE)
 async def create_account(
     request: Request,
     new_user: NewUserForm,
 ):
+    # most taken names are caught here before paying for the password hash, only names the
+    # filter says may be taken cost a query. one it missed still fails the unique check below
+    for field, value in (("username", new_user.username), ("email", new_user.email)):
+        maybe_taken = request.app.availability.maybe_taken(field, value)
+        if maybe_taken and await User.exists(**{field: value}):
+            raise UCHTTPExceptions.SIGNUP_CONFLICT_ERROR(field, value)
+
     await new_user.hashpass()
     user_id = generate_id("USER_ID")
 
+    # generate verification token
+    token_id = generate_id("VERIF_TOK_ID")  # id is currently useless
+    token = await create_access_token(data={"user_id": user_id}, token_id=token_id)
+
     try:
-        user = await User.create(id=user_id, **new_user.dict())
+        # the verification email is queued in the same transaction as the user so it can't get lost,
+        # the outbox relay publishes it to rabbitmq
+        async with in_transaction("default") as connection:
+            user = await User.create(id=user_id, **new_user.dict(), using_db=connection)
+            email_request_data = {
+                "user_id": user.id,
+                "email": user.email,
+                "token": token,
+            }
+            await OutboxEvent.create(
+                channel="verification_email",
+                payload=email_request_data,
+                using_db=connection,
+            )
     except IntegrityError as e:  # if there is a duplicate user
         conflicting_username = await User.exists(username=new_user.username)
         conflicting_email = await User.exists(email=new_user.email)
@@ -53,13 +82,7 @@ async def create_account(
     except ValidationError as e:  # user data entered was too long for some of the inputs
         raise UCHTTPExceptions.INPUT_TOO_LONG from e
 
-    # generate verification token
-    token_id = generate_id("VERIF_TOK_ID")  # id is currently useless
-    token = await create_access_token(data={"user_id": user.id}, token_id=token_id)
-
-    # send verification email to user
-    email_request_data = {"user_id": user.id, "email": user.email, "token": token}
-    await send_to_channel("verification_email", email_request_data)
+    await request.app.availability.add(user.username, user.email)
 
     return {
         "success": True,
@@ -72,11 +95,20 @@ async def create_account(
 
 
 @signup_endpoint.get("/verify")
+@route_cost(Cost.DB_WRITE)
 async def verify_user_account(request: Request, token: str):
     user = (await check_valid_token(token))[0]
-    user_cache.set(user.id, user)  # store user in cache
 
-    email_request_data = {"user_id": user.id, "email": user.email}
-    await send_to_channel("welcome_email", email_request_data)
+    async with in_transaction("default") as connection:
+        user.update_from_dict({"verified": True})
+        await user.save(using_db=connection)
+
+        email_request_data = {"user_id": user.id, "email": user.email}
+        await OutboxEvent.create(
+            channel="welcome_email", payload=email_request_data, using_db=connection
+        )
+
+    user_cache.set(user.id, user)  # store user in cache
+    await bump_versions(request.app.redis, "user", [user.id])
 
     return {"success": True, "detail": "verified successfuly!"}
@@ -0,0 +1,43 @@
+""" (script)
+production entry point for the rest api
+pre-forks WEB_CONCURRENCY workers running uvloop and httptools. TLS is expected to be terminated
+by the reverse proxy in front of it and the rabbitmq consumer runs on its own (python src/worker.py)
+"""
+
+import os
+
+import uvicorn
+
+
+def production_options(app: str = "main:app") -> dict:
+    """
+    Get the uvicorn options for running in production
+
+    Parameters:
+        app (str): The import string of the asgi app
+
+    Returns:
+        dict: Keyword arguments for uvicorn.run
+    """
+
+    return {
+        "app": app,
+        "host": os.environ.get("HOST", "0.0.0.0"),
+        "port": int(os.environ.get("PORT", 8443)),
+        "workers": int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1)),
+        "loop": "uvloop",
+        "http": "httptools",
+        "backlog": int(os.environ.get("BACKLOG", 2048)),
+        # longer than the proxy's idle timeout so the proxy is always the one closing idle connections
+        "timeout_keep_alive": int(os.environ.get("KEEP_ALIVE", 65)),
+        # on SIGTERM stop accepting and give in-flight requests this long to finish
+        "timeout_graceful_shutdown": int(os.environ.get("GRACEFUL_TIMEOUT", 30)),
+        "proxy_headers": True,
+        "forwarded_allow_ips": os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+        "access_log": False,
+    }
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("DEVMODE", "false")
+    uvicorn.run(**production_options())
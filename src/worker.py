@@ -0,0 +1,11 @@
+""" (script)
+python script to run the rabbitmq consumer, outbox relay and database maintenance
+in production this runs as its own process instead of a thread inside the api workers
+"""
+
+import asyncio
+
+from rmq import rabbitmq_server
+
+if __name__ == "__main__":
+    asyncio.run(rabbitmq_server())
@@ -1,62 +1,78 @@
 import os
+import sys
 import time
+import importlib.util
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy
 from PIL import Image
 
+# load the pipeline on its own, importing it through core needs the whole api config
+IMAGES_PATH = os.path.join(os.path.dirname(__file__), "../src/core/helpers/images.py")
+spec = importlib.util.spec_from_file_location("images", IMAGES_PATH)
+images = importlib.util.module_from_spec(spec)
+sys.modules["images"] = images  # so the worker processes can unpickle the function
+spec.loader.exec_module(images)
+
 
 def compress(input_filename, output_file_name):
     # for measuring run time
     start_time = time.perf_counter()
     start_size = os.stat(input_filename).st_size
 
-    # the compressed image result must be bellow this size:
-    MB_SIZE = 1500000  # this is in bytes
-
-    # open image and resize to 1000x1000
-    image = Image.open(input_filename).convert("RGB").resize((1000, 1000))
-    image.save(output_file_name, "JPEG")
-
-    # create numpy array with all pixels
-    pixel_values = numpy.asarray(image)
+    with open(input_filename, "rb") as f:
+        outputs = images.process_avatar(f.read(), "JPEG")
 
-    # check size of output image
-    filesize = os.stat(output_file_name).st_size
+    with open(output_file_name, "wb") as f:
+        f.write(outputs[images.AVATAR_SIZE])
 
-    # if after all that rounding the image is still not under the size:
-    if filesize > MB_SIZE:
-        # round each pixel down -1  eg 53 -> 50
-        new_pixel_values = numpy.round(pixel_values, -1)
-        image = Image.fromarray(new_pixel_values, "RGB")
+    # stats
+    print(
+        f"Image has been compressd!\nOld file size: {round(start_size / 1e6, 2)}mb\
+            \nNew file size: {round(len(outputs[images.AVATAR_SIZE]) / 1e6, 2)}mb",
+    )
+    print("Time Took:", round(time.perf_counter() - start_time, 2), "seconds")
 
-        # save image to file
-        image.save(output_file_name, "JPEG")
 
-    # check size of output image
-    filesize = os.stat(output_file_name).st_size
+def sample_image(seed: int, size: int = 2000) -> bytes:
+    # noise on top of a gradient, noise alone compresses unrealistically badly
+    rng = numpy.random.default_rng(seed)
+    gradient = numpy.linspace(0, 255, size, dtype=numpy.float32)
+    pixels = numpy.stack([numpy.add.outer(gradient, gradient) / 2] * 3, axis=-1)
+    pixels += rng.normal(0, 20, pixels.shape)
 
-    # if after all that rounding the image is still not under the size:
-    if filesize > MB_SIZE:
-        diff = filesize - MB_SIZE
+    buffer = BytesIO()
+    Image.fromarray(pixels.clip(0, 255).astype(numpy.uint8), "RGB").save(buffer, "PNG")
+    return buffer.getvalue()
 
-        # percentage needed to make image under size
-        percentage = 100 - int(diff / (filesize / 100))
 
-        # reduce quality of image by percentage to reach file size
-        image.save(output_file_name, optimize=True, quality=percentage)
+def benchmark(count: int = 32, workers: int = os.cpu_count() or 1):
+    inputs = [sample_image(i) for i in range(count)]
 
-    # new size of image
-    new_size = os.stat(output_file_name).st_size
+    for image_format in images.FORMATS:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # warm up the worker processes before timing
+            list(
+                executor.map(
+                    images.process_avatar, inputs[:workers], [image_format] * workers
+                )
+            )
 
-    image.close()
+            start_time = time.perf_counter()
+            list(executor.map(images.process_avatar, inputs, [image_format] * count))
+            elapsed = time.perf_counter() - start_time
 
-    # stats
-    print(
-        f"Image has been compressd!\nOld file size: {round(start_size / 1e6, 2)}mb\
-            \nNew file size: {round(new_size / 1e6, 2)}mb",
-    )
-    print("Time Took:", round(time.perf_counter() - start_time, 2), "seconds")
+        per_second = count / elapsed
+        print(
+            f"{image_format}: {count} images on {workers} cores in {round(elapsed, 2)}s, "
+            f"{round(per_second, 2)} images/s, {round(per_second / workers, 2)} images/s per core"
+        )
 
 
 if __name__ == "__main__":
-    # input image should be a square
-    compress("input.png", "output.jpeg")
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
+    else:
+        # input image should be a square
+        compress("input.png", "output.jpeg")
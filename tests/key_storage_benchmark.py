@@ -0,0 +1,143 @@
+"""
+Compares storing prekeys as base64 text (before migration 0008) with raw bytea (after)
+Fills a text and a bytea copy of the prekey tables with the same keys, then reports
+the size of each and the latency of the queries a bundle fetch runs
+
+Needs DATABASE_URL, the tables are temporary and dropped when the script finishes
+"""
+
+import os
+import sys
+import time
+import asyncio
+import statistics
+
+import asyncpg
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+from core.helpers.key_encoding import encode_key  # noqa: E402
+
+USERS = 2000
+PREKEYS_PER_USER = 100
+FETCHES = 5000
+
+LAYOUTS = {
+    "text": "TEXT",
+    "bytea": "BYTEA",
+}
+
+
+async def create_tables(conn: asyncpg.Connection, name: str, column_type: str) -> None:
+    await conn.execute(
+        f"""CREATE TEMPORARY TABLE "bench_{name}_one_time" (
+            "id" BIGSERIAL PRIMARY KEY,
+            "owner_id" BIGINT NOT NULL,
+            "public_key" {column_type} NOT NULL
+        )"""
+    )
+    await conn.execute(
+        f"""CREATE TEMPORARY TABLE "bench_{name}_signed" (
+            "id" BIGSERIAL PRIMARY KEY,
+            "owner_id" BIGINT NOT NULL,
+            "public_key" {column_type} NOT NULL,
+            "signature" {column_type} NOT NULL
+        )"""
+    )
+    await conn.execute(
+        f'CREATE INDEX ON "bench_{name}_one_time" ("owner_id")',
+    )
+    await conn.execute(
+        f'CREATE INDEX ON "bench_{name}_signed" ("owner_id")',
+    )
+
+
+async def fill_tables(conn: asyncpg.Connection, name: str, as_text: bool) -> None:
+    def key(length: int):
+        raw = os.urandom(length)
+        return encode_key(raw) if as_text else raw
+
+    await conn.copy_records_to_table(
+        f"bench_{name}_one_time",
+        records=(
+            (owner_id, key(33))
+            for owner_id in range(USERS)
+            for _ in range(PREKEYS_PER_USER)
+        ),
+        columns=["owner_id", "public_key"],
+    )
+    await conn.copy_records_to_table(
+        f"bench_{name}_signed",
+        records=((owner_id, key(33), key(64)) for owner_id in range(USERS)),
+        columns=["owner_id", "public_key", "signature"],
+    )
+    await conn.execute(f'ANALYZE "bench_{name}_one_time"')
+    await conn.execute(f'ANALYZE "bench_{name}_signed"')
+
+
+async def table_size(conn: asyncpg.Connection, name: str) -> int:
+    return await conn.fetchval(
+        f"""SELECT pg_total_relation_size('"bench_{name}_one_time"')
+        + pg_total_relation_size('"bench_{name}_signed"')"""
+    )
+
+
+async def fetch_latency(conn: asyncpg.Connection, name: str, as_text: bool) -> list:
+    signed = await conn.prepare(
+        f"""SELECT "id", "public_key", "signature" FROM "bench_{name}_signed"
+        WHERE "owner_id" = $1 ORDER BY "id" DESC LIMIT 1"""
+    )
+    one_time = await conn.prepare(
+        f"""SELECT "id", "public_key" FROM "bench_{name}_one_time"
+        WHERE "owner_id" = $1 LIMIT 1"""
+    )
+
+    latencies = []
+    for i in range(FETCHES):
+        owner_id = i % USERS
+        started = time.perf_counter()
+
+        signed_row = await signed.fetchrow(owner_id)
+        prekey_row = await one_time.fetchrow(owner_id)
+        # the api sends base64 either way, bytea pays for the encoding here instead
+        if not as_text:
+            encode_key(signed_row["public_key"])
+            encode_key(signed_row["signature"])
+            encode_key(prekey_row["public_key"])
+
+        latencies.append(time.perf_counter() - started)
+
+    return latencies
+
+
+async def main() -> None:
+    conn = await asyncpg.connect(os.environ["DATABASE_URL"])
+    results = {}
+
+    try:
+        for name, column_type in LAYOUTS.items():
+            as_text = column_type == "TEXT"
+            await create_tables(conn, name, column_type)
+            await fill_tables(conn, name, as_text)
+
+            latencies = sorted(await fetch_latency(conn, name, as_text))
+            results[name] = (await table_size(conn, name), latencies)
+    finally:
+        await conn.close()
+
+    rows = USERS * (PREKEYS_PER_USER + 1)
+    print(f"{USERS} users, {PREKEYS_PER_USER} prekeys each, {FETCHES} bundle fetches")
+    print(f"{'layout':<8}{'size':>12}{'per row':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    for name, (size, latencies) in results.items():
+        p50 = statistics.median(latencies) * 1000
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000
+        print(
+            f"{name:<8}{size / 1024 / 1024:>10.1f}MB{size / rows:>9.0f}B"
+            f"{p50:>10.3f}{p99:>10.3f}"
+        )
+
+    text_size, bytea_size = results["text"][0], results["bytea"][0]
+    print(f"bytea is {(1 - bytea_size / text_size) * 100:.1f}% smaller")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
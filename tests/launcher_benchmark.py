@@ -0,0 +1,122 @@
+"""
+Compares the throughput of the old single process launcher with the production launcher (src/serve.py)
+Both serve the same tiny asgi app so the numbers show the launcher overhead and not the database
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import subprocess
+from multiprocessing import Pool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+from serve import production_options  # noqa: E402
+
+PORT = 8765
+DURATION = 10  # seconds per launcher
+CLIENT_PROCESSES = max((os.cpu_count() or 2) // 2, 1)
+CONNECTIONS_PER_CLIENT = 32
+REQUEST = b"GET / HTTP/1.1\r\nHost: localhost\r\n\r\n"
+
+
+async def app(scope, receive, send):
+    if scope["type"] != "http":
+        return
+
+    body = b'{"success": true}'
+    await send(
+        {
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"application/json"),
+                (b"content-length", str(len(body)).encode()),
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def keep_alive_client(deadline: float) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", PORT)
+    completed = 0
+
+    while time.perf_counter() < deadline:
+        writer.write(REQUEST)
+        headers = await reader.readuntil(b"\r\n\r\n")
+        length = next(
+            int(line.split(b":")[1])
+            for line in headers.split(b"\r\n")
+            if line.lower().startswith(b"content-length")
+        )
+        await reader.readexactly(length)
+        completed += 1
+
+    writer.close()
+    return completed
+
+
+async def run_clients(duration: float) -> int:
+    deadline = time.perf_counter() + duration
+    results = await asyncio.gather(
+        *(keep_alive_client(deadline) for _ in range(CONNECTIONS_PER_CLIENT))
+    )
+    return sum(results)
+
+
+def client_process(duration: float) -> int:
+    return asyncio.run(run_clients(duration))
+
+
+def wait_for_port(timeout: float = 30) -> None:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", PORT), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError("server did not start")
+
+
+def benchmark(name: str, options: dict) -> None:
+    options = {
+        **options,
+        "app": "launcher_benchmark:app",
+        "port": PORT,
+        "host": "127.0.0.1",
+    }
+    server = subprocess.Popen(
+        [sys.executable, "-c", f"import uvicorn; uvicorn.run(**{options!r})"],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+    try:
+        wait_for_port()
+        time.sleep(1)  # let every worker finish starting
+
+        with Pool(CLIENT_PROCESSES) as pool:
+            requests = sum(pool.map(client_process, [DURATION] * CLIENT_PROCESSES))
+    finally:
+        server.terminate()
+        server.wait()
+
+    per_second = requests / DURATION
+    workers = options.get("workers") or 1
+    print(
+        f"{name}: {round(per_second)} requests/s with {workers} worker(s), "
+        f"{round(per_second / workers)} requests/s per core"
+    )
+
+
+if __name__ == "__main__":
+    # what main.py runs: one process, default event loop and http parser
+    benchmark("single process", {"loop": "asyncio", "http": "h11", "access_log": False})
+
+    production = production_options()
+    production["workers"] = max((os.cpu_count() or 2) - CLIENT_PROCESSES, 1)
+    benchmark("production", production)
@@ -0,0 +1,70 @@
+"""
+Checks that presence finds users by their real snowflake ids, the offset bucket worked out in
+python (offset_bucket) and in the ONLINE_USERS script have to be the same for every id.
+Uses ids with a nonzero sequence, the low bits a double can't hold above 2^53
+
+Needs REDIS_URL, use a scratch redis: it writes presence keys and a room member set
+"""
+
+import os
+import sys
+import asyncio
+
+import aioredis
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../src"))
+from core.helpers import generate_id  # noqa: E402
+from core.db.presence import Presence, offset_bucket  # noqa: E402
+from core.db.rooms import members_key  # noqa: E402
+
+SEQUENCES = [0, 1, 5, 600, 1023, 1025, 4095]
+ROOM_ID = 1
+
+
+def user_ids() -> list[int]:
+    base = generate_id("USER_ID") >> 12 << 12
+    return [base | seq for seq in SEQUENCES]
+
+
+async def main() -> None:
+    redis = aioredis.from_url(os.environ["REDIS_URL"], decode_responses=True)
+    presence = Presence(redis, slot_length=30)
+    users = user_ids()
+
+    for user_id in users:
+        presence.beat(user_id)
+    await presence.flush()
+
+    failed = False
+    for user_id in users:
+        if not await redis.hexists(offset_bucket(user_id), user_id):
+            print(f"{user_id}: no offset in {offset_bucket(user_id)}")
+            failed = True
+
+    online = set(await presence.online(users))
+    for user_id in users:
+        if user_id not in online:
+            print(f"{user_id} (seq {user_id & 0xFFF}) is online but online() missed it")
+            failed = True
+
+    await redis.delete(members_key(ROOM_ID))
+    await redis.sadd(members_key(ROOM_ID), *users)
+    try:
+        members = set(await presence.online_members(ROOM_ID))
+    finally:
+        await redis.delete(members_key(ROOM_ID))
+    for user_id in users:
+        if user_id not in members:
+            print(
+                f"{user_id} (seq {user_id & 0xFFF}) is online but online_members() missed it"
+            )
+            failed = True
+
+    await redis.close()
+    if failed:
+        sys.exit(1)
+    print(f"all {len(users)} users found")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())